@@ -249,12 +249,12 @@ for id in range(0, num_states):
 
     info = ServiceInfo(mdns_svc,
                        mdns_name,
-                       socket.inet_aton(ip), 
-                       port, 
-                       0, 
-                       0,
-                       desc, 
-                       mdns_host)
+                       addresses = [socket.inet_aton(ip)], 
+                       port = port, 
+                       weight = 0, 
+                       priority = 0,
+                       properties = desc, 
+                       server = mdns_host)
     
     zeroconf.register_service(info)
 
@@ -1,52 +1,213 @@
-# Simple Python3 script to 
+# Simple Python3 script to
 # use zeroconf to discover JBHASD devices on the LAN
-# and print their details and URLs
-# waits a long time and exits
+# and take a snapshot of the fleet
+#
+# Services are resolved concurrently and /status is
+# fetched from each device in parallel as it is found.
+# A record per device is streamed as NDJSON or CSV as
+# each device answers, with the fetch latency.
+# Exits once discovery settles and all fetches are done
+#
+# The output includes a url field per device and can
+# be used as a device seed file by the other tools
 
-from zeroconf import ServiceBrowser, Zeroconf
-import socket
+from jbhasd_discovery import add_discovery_args, discover_devices_from_args
 import time
 import requests
 import sys
-import os
 import json
+import csv
+import argparse
+import threading
+import urllib.parse
+import concurrent.futures
 
-class MyListener(object):  
-    def remove_service(self, zeroconf, type, name):
-        return
+# CSV columns and the order of fields in NDJSON
+field_list = [
+        'name',
+        'zone',
+        'url',
+        'ip',
+        'port',
+        'service',
+        'result',
+        'latency_ms',
+        'http_status',
+        'compile_date',
+        'flash_size',
+        'uptime_msecs',
+        'controls',
+        'error',
+        ]
 
-    def add_service(self, zeroconf, type, name):
 
-        info = zeroconf.get_service_info(type, name)
-        address = socket.inet_ntoa(info.addresses[0])
-        #address = socket.inet_ntoa(info.address)
-        port = info.port
-        url = 'http://%s:%d/status' % (address, port)
-        server = info.server
-        print("Discovered: %s URL: %s" % (server, url))
+def log_message(message):
+    # diagnostics go to stderr leaving
+    # stdout for the snapshot records
+    sys.stderr.write("%s %s\n" % (time.asctime(), message))
+    sys.stderr.flush()
 
-        response = None
-        api_session = requests.session()
 
-        try:
-            response = api_session.get(url)
-        except:
-            print("Error in urlopen (%s)" % (url))
+def fetch_device(service, url):
+    # fetch /status from a device and return
+    # its snapshot record
+    record = {}
+    record['service'] = service
+    record['url'] = url
+    parsed_url = urllib.parse.urlsplit(url)
+    record['ip'] = parsed_url.hostname
+    record['port'] = parsed_url.port
 
-        if response is not None:
-            response_dict = response.json()
-            print("json:\n%s" % (
-                json.dumps(
-                    response_dict, 
-                    indent = 4)))
+    status_url = '%s/status' % (url)
+    start_time = time.time()
+    try:
+        response = api_session.get(
+                status_url,
+                timeout = http_timeout_secs)
+        record['http_status'] = response.status_code
+        response.raise_for_status()
+        status_dict = response.json()
+        record['result'] = 'ok'
+    except Exception as ex:
+        status_dict = None
+        record['result'] = 'error'
+        record['error'] = str(ex)
 
-        sys.stdout.flush()
+    record['latency_ms'] = int((time.time() - start_time) * 1000)
 
+    if status_dict is not None:
+        system = status_dict.get('system', {})
+        record['name'] = status_dict.get('name')
+        record['zone'] = status_dict.get('zone')
+        record['compile_date'] = system.get('compile_date')
+        record['flash_size'] = system.get('flash_size')
+        # firmware reports uptime_msecs, API.md 
+        # documents it as millis
+        record['uptime_msecs'] = system.get(
+                'uptime_msecs', 
+                system.get('millis'))
+        record['controls'] = len(status_dict.get('controls', []))
+        if full_status:
+            record['status'] = status_dict
 
+    return record
 
-zeroconf = Zeroconf()  
-listener = MyListener()  
-browser = ServiceBrowser(zeroconf, "_JBHASD._tcp.local.", listener)  
-time.sleep(30)
-zeroconf.close()
 
+def write_record(record):
+    # stream a record to the output
+    # in the chosen format
+    with output_lock:
+        if output_format == 'csv':
+            csv_writer.writerow(record)
+        else:
+            ordered_record = {}
+            for field in field_list + ['status']:
+                if field in record:
+                    ordered_record[field] = record[field]
+            output_file.write(json.dumps(ordered_record) + '\n')
+        output_file.flush()
+
+
+def snapshot_device(service, url):
+    # Executor task to fetch and write
+    # a device record
+    record = fetch_device(service, url)
+    write_record(record)
+    return record
+
+
+def device_found(service, url):
+    # discovery callback
+    # hands the fetch to the executor so the
+    # discovery threads are not held up
+    future = executor.submit(snapshot_device, service, url)
+    with output_lock:
+        future_list.append(future)
+
+
+parser = argparse.ArgumentParser(
+        description='JBHASD Discover')
+
+parser.add_argument('--format',
+                    help = 'Output format (default ndjson)',
+                    choices = ['ndjson', 'csv'],
+                    default = 'ndjson')
+
+parser.add_argument('--output',
+                    help = 'Output file (default stdout)',
+                    default = None)
+
+parser.add_argument('--full',
+                    help = 'Include the full device status (ndjson only)',
+                    action = 'store_true')
+
+parser.add_argument('--concurrency',
+                    help = 'Parallel status fetches (default 20)',
+                    type = int,
+                    default = 20)
+
+parser.add_argument('--http_timeout',
+                    help = 'Status fetch timeout in seconds (default 5)',
+                    type = float,
+                    default = 5)
+
+add_discovery_args(parser)
+
+args = vars(parser.parse_args())
+
+output_format = args['format']
+full_status = args['full']
+http_timeout_secs = args['http_timeout']
+
+# pool sized to the fetch concurrency
+concurrency = max(1, args['concurrency'])
+api_session = requests.session()
+api_session.mount(
+        'http://',
+        requests.adapters.HTTPAdapter(
+            pool_connections = concurrency,
+            pool_maxsize = concurrency))
+
+if args['output'] is not None:
+    output_file = open(args['output'], 'w', newline = '')
+else:
+    output_file = sys.stdout
+
+output_lock = threading.Lock()
+future_list = []
+
+csv_writer = None
+if output_format == 'csv':
+    csv_writer = csv.DictWriter(
+            output_file,
+            fieldnames = field_list,
+            extrasaction = 'ignore')
+    csv_writer.writeheader()
+    output_file.flush()
+
+start_time = time.time()
+executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers = concurrency)
+
+discover_devices_from_args(args, callback = device_found)
+
+with output_lock:
+    wait_list = list(future_list)
+concurrent.futures.wait(wait_list)
+executor.shutdown()
+
+result_dict = {}
+for future in wait_list:
+    result = future.result()['result']
+    result_dict[result] = result_dict.get(result, 0) + 1
+
+log_message(
+        "Snapshot of %d devices in %.1f secs (%s)" % (
+            len(wait_list),
+            time.time() - start_time,
+            ', '.join(
+                '%s:%d' % (result, count)
+                for result, count in sorted(result_dict.items()))))
+
+if output_file is not sys.stdout:
+    output_file.close()
@@ -0,0 +1,187 @@
+# Shared zeroconf discovery for the JBHASD
+# command line tools
+#
+# Browses for _JBHASD._tcp services and returns as
+# soon as discovery has settled (no new services for
+# a settle window) or an expected number of devices
+# has been found, with a timeout as an upper bound
+
+from zeroconf import ServiceBrowser, Zeroconf
+import socket
+import sys
+import threading
+import time
+import concurrent.futures
+
+jbhasd_service_type = "_JBHASD._tcp.local."
+
+
+def log_message(message):
+    # discovery messages go to stderr so tools
+    # can stream their own output on stdout
+    sys.stderr.write("%s %s\n" % (time.asctime(), message))
+    sys.stderr.flush()
+
+
+class DiscoveryListener(object):
+    # Zeroconf listener recording the URL of each
+    # resolved service and the time of the last
+    # new service. Services are resolved on a
+    # thread pool so that a slow resolve does not
+    # hold up the others
+    def __init__(self, callback = None):
+        self.url_dict = {}
+        self.seen_set = set()
+        self.pending_count = 0
+        self.closed = False
+        self.last_added_time = time.time()
+        self.lock = threading.Lock()
+        self.added_event = threading.Event()
+        self.callback = callback
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers = 10)
+
+    def remove_service(self, zeroconf, type, name):
+        return
+
+    def update_service(self, zeroconf, type, name):
+        return
+
+    def add_service(self, zeroconf, type, name):
+        with self.lock:
+            if self.closed or name in self.seen_set:
+                return
+            self.seen_set.add(name)
+            self.pending_count += 1
+            self.last_added_time = time.time()
+
+        self.executor.submit(self.resolve_service, zeroconf, type, name)
+        return
+
+    def resolve_service(self, zeroconf, type, name):
+        url = None
+        if self.closed:
+            return
+        try:
+            info = zeroconf.get_service_info(type, name)
+            if info is not None and len(info.addresses) > 0:
+                address = socket.inet_ntoa(info.addresses[0])
+                url = 'http://%s:%d' % (address, info.port)
+        except Exception as ex:
+            if not self.closed:
+                log_message("Error resolving %s: %s" % (name, ex))
+
+        with self.lock:
+            # results after discovery has finished
+            # are dropped
+            if self.closed:
+                return
+            self.pending_count -= 1
+            if url is not None:
+                self.url_dict[name] = url
+
+        self.added_event.set()
+
+        if url is not None and self.callback is not None:
+            self.callback(name, url)
+
+        return
+
+
+def discover_devices(
+        settle_secs = 5,
+        expected_count = None,
+        timeout_secs = 60,
+        callback = None):
+    # Discover JBHASD devices
+    # returns a dict of service name to URL
+    # (http://ip:port) once either:
+    #   expected_count devices have been found
+    #   no new device has appeared for settle_secs
+    #   (only when no expected_count is given)
+    #   timeout_secs have elapsed
+    # The optional callback is called with the
+    # service name and URL of each device as found
+    zeroconf = Zeroconf()
+    listener = DiscoveryListener(callback)
+    browser = ServiceBrowser(zeroconf, jbhasd_service_type, listener)
+
+    start_time = time.time()
+    end_time = start_time + timeout_secs
+
+    while (1):
+        now = time.time()
+        with listener.lock:
+            found_count = len(listener.url_dict)
+            pending_count = listener.pending_count
+            settle_time = listener.last_added_time + settle_secs
+
+        if expected_count is not None and found_count >= expected_count:
+            reason = 'expected count reached'
+            break
+
+        # settled once no new services have appeared
+        # for the settle window and all have resolved
+        # when an expected count is given, we wait for
+        # that or the timeout instead
+        if (expected_count is None and
+                now >= settle_time and
+                pending_count == 0):
+            reason = 'settled'
+            break
+
+        if now >= end_time:
+            reason = 'timeout'
+            break
+
+        listener.added_event.clear()
+        listener.added_event.wait(max(0.1, min(settle_time, end_time) - now))
+
+    # stop taking new services before closing
+    # so no callbacks are made after we return
+    with listener.lock:
+        listener.closed = True
+        found_count = len(listener.url_dict)
+    browser.cancel()
+    zeroconf.close()
+    listener.executor.shutdown(wait = False, cancel_futures = True)
+
+    log_message("Discovered %d devices in %.1f secs (%s)" % (
+        found_count,
+        time.time() - start_time,
+        reason))
+
+    with listener.lock:
+        return dict(listener.url_dict)
+
+
+def add_discovery_args(parser):
+    # Common discovery command line args
+    parser.add_argument('--settle_secs',
+                        help = 'Finish discovery after no new devices '
+                               'for this many seconds (default 5)',
+                        type = float,
+                        default = 5)
+
+    parser.add_argument('--expected',
+                        help = 'Finish discovery once this many '
+                               'devices are found (no settle window)',
+                        type = int,
+                        default = None)
+
+    parser.add_argument('--discovery_secs',
+                        help = 'Maximum discovery time in seconds (default 60)',
+                        type = float,
+                        default = 60)
+
+    return
+
+
+def discover_devices_from_args(args, callback = None):
+    # discover_devices() using the args added
+    # by add_discovery_args()
+    return discover_devices(
+            settle_secs = args['settle_secs'],
+            expected_count = args['expected'],
+            timeout_secs = args['discovery_secs'],
+            callback = callback)
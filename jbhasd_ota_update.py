@@ -1,11 +1,13 @@
-# Simple Python3 script to 
+# Simple Python3 script to
 # use zeroconf to discover JBHASD devices on the LAN
-# and print their details and URLs
-# waits a long time and exits
+# and OTA update those matching a given flash size.
+# Devices are flashed in parallel and each is checked
+# to have come back on a new compile date. Results are
+# written to a JSON report which can be used to resume
+# a partly finished rollout
 
-from six.moves import input  
-from zeroconf import ServiceBrowser, Zeroconf
-import socket
+from six.moves import input
+from jbhasd_discovery import add_discovery_args, discover_devices_from_args
 import time
 import urllib
 import urllib.parse
@@ -14,6 +16,12 @@ import urllib.error
 import argparse
 import json
 import os
+import sys
+import shlex
+import subprocess
+import threading
+import hashlib
+import concurrent.futures
 
 def fetch_url(url, url_timeout, parse_json):
     # General purpoe URL fetcher
@@ -21,7 +29,7 @@ def fetch_url(url, url_timeout, parse_json):
     # if the parse_json arg is 1
     response_str = None
 
-    #print("%s Fetching URL:%s, timeout:%d" % (time.asctime(), url, url_timeout)) 
+    #print("%s Fetching URL:%s, timeout:%d" % (time.asctime(), url, url_timeout))
 
     response = None
     try:
@@ -29,7 +37,7 @@ def fetch_url(url, url_timeout, parse_json):
                                           timeout = url_timeout)
     except:
         print("%s Error in urlopen URL:%s" % (time.asctime(), url))
- 
+
     if response is not None:
         try:
             response_str = response.read()
@@ -42,78 +50,327 @@ def fetch_url(url, url_timeout, parse_json):
                 json_data = json.loads(response_str.decode('utf-8'))
             except:
                 print("%s Error in JSON parse.. URL:%s Data:%s" % (time.asctime(),
-                                                                   url, 
+                                                                   url,
                                                                    response_str))
                 return None
             return json_data
 
     return response_str
-     
 
 
-ip_set = set()
+def log_message(message):
+    print("%s %s" % (time.asctime(), message))
+    sys.stdout.flush()
+
+
+# guards the report and its file as devices
+# complete in parallel
+report_lock = threading.Lock()
+
+
+def save_report(report, report_file):
+    # Write report atomically so an interrupted
+    # rollout leaves a usable report to resume from.
+    # The lock is held until the report is in place so
+    # an older report can't replace a newer one
+    with report_lock:
+        report_str = json.dumps(
+                report,
+                indent = 4,
+                sort_keys = True)
+
+        tmp_file = '%s.tmp' % (report_file)
+        with open(tmp_file, 'w') as outfile:
+            outfile.write(report_str)
+        os.replace(tmp_file, report_file)
+
+
+def load_report(report_file):
+    # Previous report for a resume
+    # or None if there isn't one
+    if not os.path.isfile(report_file):
+        return None
+
+    with open(report_file) as infile:
+        return json.load(infile)
+
+
+def get_file_sha256(file_name):
+    # SHA-256 of a file so a report is tied
+    # to the firmware image and not just its name
+    sha256 = hashlib.sha256()
+    with open(file_name, 'rb') as infile:
+        for block in iter(lambda: infile.read(65536), b''):
+            sha256.update(block)
+
+    return sha256.hexdigest()
+
+
+def ota_update_device(url):
+    # OTA update a single device
+    # returns a result dict with a status of:
+    #   updated      flashed and back on a new compile date
+    #   current      already on the requested version
+    #   skipped      flash size does not match
+    #   unreachable  status not available
+    #   flash_failed OTA command failed
+    #   unverified   device not back on a new compile
+    #                date within the timeout
+    # Devices done in a resumed report keep their
+    # previous result marked as resumed
+    result = {}
+    result['url'] = url
+    result['start_time'] = int(time.time())
+
+    json_data = fetch_url(url + '/status', http_timeout_secs, 1)
+    if json_data is None:
+        result['status'] = 'unreachable'
+        return result
+
+    result['name'] = json_data['name']
+    result['zone'] = json_data['zone']
+    system = json_data.get('system', {})
+    result['old_compile_date'] = system.get('compile_date')
+    device_flash_size = system.get('flash_size')
+    log_message(
+            "Name:%s Zone:%s Flash:%s Version:%s" % (
+                result['name'],
+                result['zone'],
+                device_flash_size,
+                result['old_compile_date']))
+
+    # devices done in a resumed report are carried over
+    # they are keyed on name as URLs change under DHCP
+    previous_result = resume_dict.get(result['name'])
+    if previous_result is not None:
+        log_message("Already done.. %s (%s)" % (result['name'], url))
+        result = dict(previous_result)
+        result['url'] = url
+        result['resumed'] = 1
+        return result
+
+    if device_flash_size != flash_size:
+        result['status'] = 'skipped'
+        return result
+
+    if (version is not None and
+            result['old_compile_date'] == version):
+        result['status'] = 'current'
+        return result
+
+    # Flash
+    parsed_url = urllib.parse.urlsplit(url)
+    ota_cmd = espota_cmd.format(
+            ip = parsed_url.hostname,
+            url = url,
+            name = result['name'],
+            firmware = firmware)
+    log_message("OTA Updating %s.. %s" % (result['name'], ota_cmd))
+
+    try:
+        completed = subprocess.run(
+                shlex.split(ota_cmd),
+                stdout = subprocess.PIPE,
+                stderr = subprocess.STDOUT,
+                timeout = ota_timeout_secs)
+        result['ota_rc'] = completed.returncode
+        result['ota_output'] = completed.stdout.decode('utf-8', 'replace')[-2000:]
+    except Exception as ex:
+        result['ota_rc'] = None
+        result['ota_output'] = str(ex)
+
+    if result['ota_rc'] != 0:
+        result['status'] = 'flash_failed'
+        return result
+
+    # wait for device to come back on
+    # a new compile date
+    result['status'] = 'unverified'
+    end_time = time.time() + reboot_timeout_secs
+    while time.time() < end_time:
+        time.sleep(poll_secs)
+        json_data = fetch_url(url + '/status', http_timeout_secs, 1)
+        if json_data is None:
+            continue
+
+        new_compile_date = json_data.get('system', {}).get('compile_date')
+        result['new_compile_date'] = new_compile_date
+        if (new_compile_date != result['old_compile_date'] and
+                (version is None or new_compile_date == version)):
+            result['status'] = 'updated'
+            break
+
+    return result
+
+
+def run_device(url):
+    # Executor task recording the device
+    # result in the report as it completes
+    try:
+        result = ota_update_device(url)
+    except Exception as ex:
+        result = {}
+        result['url'] = url
+        result['status'] = 'error'
+        result['error'] = str(ex)
+
+    result['end_time'] = result.get('end_time', int(time.time()))
+
+    # keyed on device name where known
+    with report_lock:
+        report['devices'][result.get('name', url)] = result
+    save_report(report, report_file)
+
+    log_message(
+            "%s (%s) %s" % (
+                url,
+                result.get('name', 'Unknown'),
+                result['status']))
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description='JBHASD OTA Updater')
+
+    parser.add_argument('--flash_size',
+                        help = 'Flash size',
+                        type = int,
+                        required = True)
+
+    parser.add_argument('--firmware',
+                        help = 'Firmware',
+                        required = True)
+
+    parser.add_argument('--version',
+                        help = 'Expected compile_date after update '
+                               '(default is any change)',
+                        default = None)
+
+    parser.add_argument('--concurrency',
+                        help = 'Devices to flash in parallel (default 4)',
+                        type = int,
+                        default = 4)
+
+    parser.add_argument('--report',
+                        help = 'JSON report file (default ota_report.json)',
+                        default = 'ota_report.json')
+
+    parser.add_argument('--resume',
+                        help = 'Skip devices already done in the report',
+                        action = 'store_true')
+
+    parser.add_argument('--espota_cmd',
+                        help = 'OTA command template with {ip}, {url}, '
+                               '{name} and {firmware} fields',
+                        default = 'espota.py -i {ip} -f {firmware}')
+
+    parser.add_argument('--url',
+                        help = 'Device URL to update (skips discovery, repeatable)',
+                        action = 'append',
+                        default = [])
+
+    add_discovery_args(parser)
+
+    parser.add_argument('--reboot_timeout',
+                        help = 'Seconds to wait for each device to come back (default 120)',
+                        type = int,
+                        default = 120)
+
+    args = vars(parser.parse_args())
 
-class MyListener(object):  
-    def remove_service(self, zeroconf, type, name):
-        return
+    flash_size = args['flash_size']
+    firmware = args['firmware']
+    version = args['version']
+    concurrency = args['concurrency']
+    report_file = args['report']
+    espota_cmd = args['espota_cmd']
+    reboot_timeout_secs = args['reboot_timeout']
 
-    def add_service(self, zeroconf, type, name):
-        global ip_set
+    http_timeout_secs = 5
+    ota_timeout_secs = 300
+    poll_secs = 5
 
-        info = zeroconf.get_service_info(type, name)
-        if info is not None:
-            address = socket.inet_ntoa(info.addresses[0])
-            ip_set.add(address)
-        return
+    # report of per-device results keyed on device name
+    # on resume, devices already done are carried
+    # over and not flashed again. A report for a different
+    # firmware image, flash size or version is refused
+    firmware_sha256 = get_file_sha256(firmware)
+    done_status_set = {'updated', 'current', 'skipped'}
+    resume_dict = {}
 
-parser = argparse.ArgumentParser(
-        description='JBHASD OTA Updater')
+    report = None
+    if args['resume']:
+        report = load_report(report_file)
 
-parser.add_argument('--flash_size', 
-                    help = 'Flash size', 
-                    type = int,
-                    required = True)
+    if report is not None:
+        mismatch_list = []
+        if report.get('firmware_sha256') != firmware_sha256:
+            mismatch_list.append('firmware')
+        if report.get('flash_size') != flash_size:
+            mismatch_list.append('flash size')
+        if report.get('version') != version:
+            mismatch_list.append('version')
 
-parser.add_argument('--firmware', 
-                    help = 'Firmware', 
-                    required = True)
+        if len(mismatch_list) > 0:
+            print("Cannot resume.. report %s is for a different %s "
+                  "(use a new --report or the same settings)" % (
+                      report_file,
+                      ' and '.join(mismatch_list)))
+            sys.exit(2)
 
-args = vars(parser.parse_args())
+        # rekeyed on name for reports keyed on URL
+        device_dict = {}
+        for key, result in report['devices'].items():
+            device_dict[result.get('name', key)] = result
+            if (result.get('status') in done_status_set and
+                    'name' in result):
+                resume_dict[result['name']] = result
+        report['devices'] = device_dict
+        print("Resuming with %d devices already done" % (len(resume_dict)))
 
-flash_size = args['flash_size']
-firmware = args['firmware']
+    if report is None:
+        report = {}
+        report['devices'] = {}
+    report['firmware'] = firmware
+    report['firmware_sha256'] = firmware_sha256
+    report['flash_size'] = flash_size
+    report['version'] = version
+    report['start_time'] = int(time.time())
 
+    if len(args['url']) > 0:
+        ip_set = set(args['url'])
+    else:
+        print("Discovering devices for up to %d seconds.." % (args['discovery_secs']))
+        ip_set = set(discover_devices_from_args(args).values())
 
+    print("Discovered %d devices in total" % (len(ip_set)))
 
-zeroconf = Zeroconf()  
-listener = MyListener()  
-browser = ServiceBrowser(zeroconf, "_JBHASD._tcp.local.", listener)  
+    save_report(report, report_file)
 
-discovery_secs = 60
-http_timeout_secs = 5
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers = max(1, concurrency)) as executor:
+        result_list = list(executor.map(run_device, sorted(ip_set)))
 
-print("Giving %d seconds for discovery.." % (discovery_secs))
-time.sleep(discovery_secs)
+    report['end_time'] = int(time.time())
+    save_report(report, report_file)
 
-print("Discovered %d devices in total" % (len(ip_set)))
-flashed_total = 0
-for ip in ip_set:
-    url = 'http://%s' % (ip)
-    print( "Discovered.. %s" % (url))
+    # summary of devices in this rollout
+    status_dict = {}
+    for result in result_list:
+        status = result['status']
+        if result.get('resumed'):
+            status = 'resumed'
+        status_dict[status] = status_dict.get(status, 0) + 1
 
-    # get JSON data to check flash size
-    json_data = fetch_url(url, http_timeout_secs, 1)
-    if json_data is not None:
-        name = json_data['name']
-        zone = json_data['zone']
-        device_flash_size = json_data['system']['flash_size']
-        print( "Name:%s Zone:%s Flash:%d" % (name, zone, device_flash_size))
-        if device_flash_size == flash_size:
-            # Flash
-            print("OTA Updating..")
-            ota_cmd = "espota.py -i %s -f %s" % (ip, firmware)
-            print(ota_cmd)
-            os.system(ota_cmd)
-            flashed_total += 1
+    print("Flashed %d devices in total" % (status_dict.get('updated', 0)))
+    print("Results: %s" % (
+        ', '.join(
+            '%s:%d' % (status, count)
+            for status, count in sorted(status_dict.items()))))
+    print("Report written to %s" % (report_file))
 
-print("Flashed %d devices in total" % (flashed_total))
+    failed_total = sum(
+            count for status, count in status_dict.items()
+            if not status in done_status_set | {'resumed'})
+    sys.exit(1 if failed_total > 0 else 0)
@@ -1,41 +1,26 @@
 # Simple Python3 script to 
 # use zeroconf to discover JBHASD devices on the LAN
-# and print their details and URLs
-# waits a long time and exits
+# and reboot them
 
 from six.moves import input  
-from zeroconf import ServiceBrowser, Zeroconf
-import socket
-import time
+from jbhasd_discovery import add_discovery_args, discover_devices_from_args
 import urllib
 import urllib.parse
 import urllib.request
 import urllib.error
+import argparse
 
-url_set = set()
+parser = argparse.ArgumentParser(
+        description='JBHASD Reboot')
 
-class MyListener(object):  
-    def remove_service(self, zeroconf, type, name):
-        return
+add_discovery_args(parser)
 
-    def add_service(self, zeroconf, type, name):
-        info = zeroconf.get_service_info(type, name)
-        if info is not None:
-            address = socket.inet_ntoa(info.address)
-            port = info.port
-            url = 'http://%s:%d' % (address, port)
-            url_set.add(url)
-        return
+args = vars(parser.parse_args())
 
-zeroconf = Zeroconf()  
-listener = MyListener()  
-browser = ServiceBrowser(zeroconf, "_JBHASD._tcp.local.", listener)  
-
-discovery_secs = 60
 http_timeout_secs = 2
 
-print("Giving %d seconds for discovery.." % (discovery_secs))
-time.sleep(discovery_secs)
+print("Discovering devices for up to %d seconds.." % (args['discovery_secs']))
+url_set = set(discover_devices_from_args(args).values())
 
 print( "Discovered..")
 for url in url_set:
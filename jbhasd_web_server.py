@@ -26,6 +26,18 @@ from zeroconf import ServiceBrowser, Zeroconf
 import requests
 import argparse
 import concurrent.futures
+import threading
+import heapq
+import collections
+import re
+import asyncio
+import gzip
+import asyncio
+import ssl
+import secrets
+import traceback
+import csv
+import ipaddress
 import cherrypy
 
 # Config
@@ -59,7 +71,29 @@ def set_default_config():
     # discovery
     json_config['discovery'] = {}
     json_config['discovery']['device_probe_interval'] = 10
-    json_config['discovery']['device_purge_threshold'] = 120
+    json_config['discovery']['device_purge_timeout'] = 120
+    json_config['discovery']['probe_workers'] = 20
+    json_config['discovery']['probe_deadline'] = 10
+    json_config['discovery']['probe_jitter'] = 0.2
+    json_config['discovery']['probe_batch_window'] = 1
+    json_config['discovery']['min_probe_interval'] = 5
+    json_config['discovery']['max_probe_interval'] = 60
+    json_config['discovery']['device_probe_intervals'] = {}
+    json_config['discovery']['profile_probe_intervals'] = {}
+    json_config['discovery']['sensor_change_threshold'] = 0.5
+    json_config['discovery']['breaker_threshold'] = 3
+    json_config['discovery']['breaker_backoff'] = 10
+    json_config['discovery']['breaker_max_backoff'] = 300
+    json_config['discovery']['breaker_probe_timeout'] = 2
+    json_config['discovery']['resolve_workers'] = 4
+    json_config['discovery']['resolve_timeout'] = 3
+    json_config['discovery']['mode'] = 'zeroconf'
+    json_config['discovery']['rescan_interval'] = 60
+    json_config['discovery']['static_devices'] = []
+    json_config['discovery']['sweep_networks'] = []
+    json_config['discovery']['sweep_ports'] = [80]
+    json_config['discovery']['sweep_workers'] = 100
+    json_config['discovery']['sweep_timeout'] = 1
 
     # web
     json_config['web'] = {}
@@ -80,6 +114,7 @@ def set_default_config():
     # Timed & paired controls
     json_config['device_programs'] = []
     json_config['paired_switches'] = []
+    json_config['paired_switch_coalesce_secs'] = 0.2
 
     # Device config
     json_config['device_profiles'] = []
@@ -87,6 +122,25 @@ def set_default_config():
     json_config['rgb_programs'] = {}
     json_config['argb_programs'] = {}
 
+    # HTTP client
+    json_config['http'] = {}
+    json_config['http']['async_transport'] = 0
+    json_config['http']['device_connection_limit'] = 1
+    json_config['http']['latency_window'] = 100
+    json_config['http']['latency_min_samples'] = 10
+    json_config['http']['timeout_percentile'] = 99
+    json_config['http']['timeout_factor'] = 3
+    json_config['http']['min_timeout'] = 1
+    json_config['http']['max_timeout'] = 10
+
+    # Rolling fleet operations
+    json_config['fleet'] = {}
+    json_config['fleet']['rolling'] = 1
+    json_config['fleet']['wave_size'] = 5
+    json_config['fleet']['wave_timeout'] = 180
+    json_config['fleet']['wave_probe_interval'] = 5
+    json_config['fleet']['abort_on_failure'] = 1
+
     # Timezone
     json_config['timezone'] = 'Europe/Dublin'
 
@@ -110,6 +164,17 @@ def load_config(config_file):
     return json_config
 
 
+def get_config_value(section, key, default):
+    # Config lookup with a fallback default
+    # for fields that may not be present in
+    # config files saved by older versions
+    if (section in gv_json_config and
+            key in gv_json_config[section]):
+        return gv_json_config[section][key]
+
+    return default
+
+
 def save_config(json_config, config_file):
     log_message(
             1,
@@ -145,6 +210,8 @@ def config_agent():
             if json_config is not None:
                 gv_json_config = json_config
                 last_check = config_last_modified
+                compile_device_programs()
+                mark_data_changed()
 
 
         # Sunset calculations
@@ -162,6 +229,8 @@ def config_agent():
                     )
             json_data = get_url(gv_json_config['sunset']['url'], 20, 1)
             if json_data:
+                previous_solar_times = (gv_sunset_time, gv_sunrise_time)
+
                 # Sunset
                 sunset_str = json_data['results']['sunset']
                 sunset_ts = sunset_api_time_to_epoch(
@@ -203,6 +272,11 @@ def config_agent():
                             )
                         )
 
+                # re-resolve compiled sunset/sunrise events
+                if (gv_sunset_time, gv_sunrise_time) != previous_solar_times:
+                    resolve_solar_event_times()
+                    mark_data_changed()
+
             gv_last_sunset_check = now
 
         # standard config loop period
@@ -231,6 +305,241 @@ gv_actual_sunrise_time = "05:00"
 gv_sunset_time = get_event_time(gv_actual_sunset_time)
 gv_sunrise_time = get_event_time(gv_actual_sunrise_time)
 
+# Compiled device programs
+# dict keyed on (zone, control) tuple with a list
+# of compiled events for each. Events referencing
+# sunset/sunrise are also listed separately so they
+# can be re-resolved when those times change
+gv_program_index = {}
+gv_solar_event_list = []
+
+# Paired switches indexed on their b-side
+# and a-side (zone, control) tuples
+gv_paired_switch_index = {}
+gv_paired_switch_a_index = {}
+
+# Pending paired switch propagations keyed on 
+# b-side (zone, control) with the event used to 
+# wake the paired switch agent and its latency stats
+gv_paired_switch_pending_dict = {}
+gv_paired_switch_lock = threading.Lock()
+gv_paired_switch_wakeup = threading.Event()
+gv_paired_switch_stats = {}
+gv_paired_switch_stats['propagations'] = 0
+gv_paired_switch_stats['last_latency'] = 0
+gv_paired_switch_stats['max_latency'] = 0
+gv_paired_switch_stats['avg_latency'] = 0
+
+# valid hh:mm event time
+gv_event_time_regex = re.compile(r'^([01]?[0-9]|2[0-3]):[0-5][0-9]$')
+
+# Timer engine
+# heap of (due time, sequence, fire time, index version, 
+# zone/control key, compiled event) tuples.
+# The index version is bumped whenever programs are 
+# compiled or re-resolved so stale entries can be discarded
+gv_timer_heap = []
+gv_timer_lock = threading.Lock()
+gv_timer_wakeup = threading.Event()
+gv_timer_sequence = 0
+gv_program_index_version = 0
+
+# seconds after an event time within which a missed
+# or failed event may still fire and the retry 
+# interval within that window
+gv_timer_fire_window = 60
+gv_timer_retry_secs = 5
+
+
+def resolve_event_time(compiled_event):
+    # Set HHMM event time and relative seconds of
+    # day for compiled event
+    event_time = get_event_time(compiled_event['time_str'])
+    compiled_event['event_time'] = event_time
+    compiled_event['event_time_rel_secs'] = ((int(event_time / 100) * 60 * 60) + 
+            ((event_time % 100) * 60))
+    return
+
+
+def resolve_solar_event_times():
+    # Re-resolve compiled events referencing
+    # sunset or sunrise
+    log_message(
+            1,
+            "Re-resolving %d sunset/sunrise program events" % (
+                len(gv_solar_event_list)
+                )
+            )
+
+    for compiled_event in gv_solar_event_list:
+        resolve_event_time(compiled_event)
+
+    reset_timers()
+
+    return
+
+
+def reset_timers():
+    # Flag the compiled programs as changed and 
+    # wake the timer agent to rebuild its heap
+    global gv_program_index_version
+
+    with gv_timer_lock:
+        gv_program_index_version += 1
+    gv_timer_wakeup.set()
+
+    return
+
+
+def compile_device_programs():
+    # Compile device programs and paired switches from 
+    # config into indexes keyed on (zone, control).
+    # Event times are resolved to relative seconds of day
+    # and referenced RGB/ARGB programs are substituted.
+    # Config errors are reported here and the offending
+    # programs or events skipped
+    global gv_program_index
+    global gv_solar_event_list
+    global gv_paired_switch_index
+    global gv_paired_switch_a_index
+
+    program_index = {}
+    solar_event_list = []
+    error_count = 0
+    rgb_programs = gv_json_config.get('rgb_programs', {})
+    argb_programs = gv_json_config.get('argb_programs', {})
+
+    for program_id, device_program in enumerate(
+            gv_json_config.get('device_programs', [])):
+
+        if not device_program.get('enabled'):
+            continue
+
+        if (not 'zone' in device_program or 
+                not 'control' in device_program or
+                not 'events' in device_program):
+            log_message(
+                    1,
+                    "Config error: device program #%d requires zone, control & events" % (
+                        program_id
+                        )
+                    )
+            error_count += 1
+            continue
+
+        program_key = (device_program['zone'], device_program['control'])
+
+        for event in device_program['events']:
+
+            # Event times
+            # either a 'times' list or a single 'time'
+            if 'times' in event:
+                times_list = event['times']
+            elif 'time' in event:
+                times_list = [event['time']]
+            else:
+                times_list = []
+
+            if (len(times_list) == 0 or 
+                    not 'params' in event):
+                log_message(
+                        1,
+                        "Config error: event in program %s/%s requires time(s) & params" % (
+                            program_key
+                            )
+                        )
+                error_count += 1
+                continue
+
+            control_data = copy.deepcopy(event['params'])
+
+            # rgb/argb references
+            if ('program' in control_data and 
+                    type(control_data['program']) == str):
+                program_name = control_data['program']
+                if program_name in rgb_programs:
+                    control_data['program'] = rgb_programs[program_name]
+                elif program_name in argb_programs:
+                    control_data['program'] = argb_programs[program_name]
+                else:
+                    log_message(
+                            1,
+                            "Config error: program %s/%s references unknown program %s" % (
+                                program_key + (program_name,)
+                                )
+                            )
+                    error_count += 1
+
+            for event_time_str in times_list:
+                if (not event_time_str in ['sunset', 'sunrise'] and
+                        not gv_event_time_regex.match(str(event_time_str))):
+                    log_message(
+                            1,
+                            "Config error: program %s/%s has invalid event time '%s'" % (
+                                program_key + (event_time_str,)
+                                )
+                            )
+                    error_count += 1
+                    continue
+
+                compiled_event = {}
+                compiled_event['time_str'] = event_time_str
+                compiled_event['control_data'] = control_data
+                resolve_event_time(compiled_event)
+
+                if not program_key in program_index:
+                    program_index[program_key] = []
+                program_index[program_key].append(compiled_event)
+
+                if event_time_str in ['sunset', 'sunrise']:
+                    solar_event_list.append(compiled_event)
+
+    paired_switch_index = {}
+    paired_switch_a_index = {}
+    for paired_switch in gv_json_config.get('paired_switches', []):
+        missing_list = [
+                key for key in ['a_zone', 'a_control', 'b_zone', 'b_control'] 
+                if not key in paired_switch
+                ]
+        if len(missing_list) > 0:
+            log_message(
+                    1,
+                    "Config error: paired switch missing %s" % (
+                        ', '.join(missing_list)
+                        )
+                    )
+            error_count += 1
+            continue
+
+        paired_key = (paired_switch['b_zone'], paired_switch['b_control'])
+
+        if not paired_key in paired_switch_index:
+            paired_switch_index[paired_key] = []
+        paired_switch_index[paired_key].append(paired_switch)
+
+        paired_a_key = (paired_switch['a_zone'], paired_switch['a_control'])
+        if not paired_a_key in paired_switch_a_index:
+            paired_switch_a_index[paired_a_key] = []
+        paired_switch_a_index[paired_a_key].append(paired_switch)
+
+    gv_program_index = program_index
+    gv_solar_event_list = solar_event_list
+    gv_paired_switch_index = paired_switch_index
+    gv_paired_switch_a_index = paired_switch_a_index
+    reset_timers()
+
+    log_message(
+            1,
+            "Compiled programs for %d controls (%d events), %d paired switches, %d errors" % (
+                len(program_index),
+                sum(len(event_list) for event_list in program_index.values()),
+                sum(len(pair_list) for pair_list in paired_switch_index.values()),
+                error_count
+                )
+            )
+
+    return
+
 # device global dictionaries
 
 # device dict 
@@ -240,6 +549,160 @@ gv_device_dict = {}
 # timeout for all fetch calls
 gv_http_timeout_secs = 10
 
+# Optional asyncio transport for device I/O
+# None when using the pooled requests sessions
+gv_async_transport = None
+
+# Pooled keep-alive HTTP sessions keyed on device URL
+# and the reverse index of device URL to device name
+gv_device_session_dict = {}
+gv_url_name_dict = {}
+gv_session_lock = threading.Lock()
+
+# Rolling windows of request latencies
+# per device name and then per HTTP method so
+# status GETs and control POSTs are kept apart
+gv_latency_dict = {}
+gv_latency_lock = threading.Lock()
+
+# Probe engine
+# worker pool used to fan out device probes
+gv_probe_executor = None
+
+# Discovery
+# worker pool used to resolve zeroconf services
+# and the set of services waiting to be resolved
+gv_discovery_executor = None
+gv_resolve_pending_set = set()
+gv_resolve_lock = threading.Lock()
+
+# discovery mode, zeroconf, static or sweep
+gv_discovery_mode = 'zeroconf'
+
+# Executor for console and batch API fan-outs
+gv_command_executor = None
+gv_command_executor_lock = threading.Lock()
+
+# Device write queues
+# every control change or command sent to a device
+# goes through a per-device ordered queue keyed on 
+# device name with one request in flight per device. 
+# Queued changes to the same control are coalesced
+# with the latest winning and failed requests are 
+# retried with backoff until their delivery deadline
+gv_device_queue_dict = {}
+gv_device_queue_lock = threading.Lock()
+gv_device_queue_executor = None
+gv_delivery_id = 0
+
+# Rolling fleet operation
+# progress of the current or last rolling reboot 
+# or reconfigure shown in /data
+gv_fleet_operation = None
+gv_fleet_lock = threading.Lock()
+
+# API jobs
+# console and batch actions run as jobs on their
+# own executor. The dict of job records is keyed on 
+# job ID and limited to the most recent jobs
+gv_job_executor = None
+gv_job_dict = collections.OrderedDict()
+gv_job_lock = threading.Lock()
+gv_job_id = 0
+gv_job_history = 100
+gv_probe_workers = 0
+
+# Probe schedule
+# min-heap of (due time, device name) tuples 
+# and dict of the current due time per device.
+# Heap entries that no longer match the due dict
+# are stale (device purged or rescheduled) and 
+# are discarded when popped
+gv_probe_heap = []
+gv_probe_due_dict = {}
+gv_probe_lock = threading.Lock()
+gv_probe_wakeup = threading.Event()
+
+# min gap between a probe batch and the 
+# next probe of a device in that batch
+gv_probe_min_gap = 0.1
+
+# Control fields that change on every probe
+# and are ignored when detecting status changes.
+# The firmware reports last_activity_msecs and 
+# last_activity with API.md documenting them as 
+# last_activity_millis and last_activity_delta_secs
+# RGB controls report their program step and colour
+gv_volatile_control_fields = [
+        'last_activity_msecs',
+        'last_activity',
+        'last_activity_millis',
+        'last_activity_delta_secs',
+        'step',
+        'current_colour',
+        ]
+
+# Adaptive probe interval factors applied
+# when device status has changed (shrink) or 
+# remained the same (grow)
+gv_probe_interval_shrink = 0.5
+gv_probe_interval_grow = 1.25
+
+# max sleep for the probe agent between 
+# schedule checks so automated devices are 
+# still checked regularly
+gv_probe_housekeeping_secs = 2
+
+# Change event bus
+# list of (callback, event type set) subscriptions
+# A type set of None subscribes to all events
+gv_event_subscriber_list = []
+
+# /data snapshot
+# pre-serialized JSON and gzip bodies rebuilt only
+# when marked changed or older than the web 
+# data_max_age setting. The version increments 
+# on each rebuild and forms the ETag
+gv_data_lock = threading.Lock()
+gv_data_changed = True
+gv_data_version = 0
+gv_data_snapshot = None
+
+# /data change log
+# set of devices changed since the last rebuild and 
+# a bounded log of (version, device name, change) 
+# used to serve /data?since=N deltas. The floor is 
+# the oldest version a delta can be served from
+gv_data_changed_device_set = set()
+gv_data_change_log = collections.deque(maxlen = 1000)
+gv_data_change_log_floor = 0
+
+# /events SSE streams
+# change events are serialized once into a bounded
+# log of (event id, JSON) shared by all streams. 
+# Streams are served from a single asyncio event loop
+# and wait on its new event flag which is replaced 
+# each time it is set. Stream tokens are issued by 
+# the authenticated /events handler and map to their
+# expiry time. The stream count is only used on the 
+# event loop thread
+gv_sse_lock = threading.Lock()
+gv_sse_event_id = 0
+gv_sse_event_log = collections.deque(maxlen = 1000)
+gv_sse_token_dict = {}
+gv_sse_stream_count = 0
+gv_sse_loop = None
+gv_sse_new_event = None
+
+# Control index 
+# dict keyed on (zone, control name) tuple
+# with a dict of device name to control record
+# for each. Also the set of index keys per device
+# so entries can be removed on update or purge
+gv_control_index = {}
+gv_device_control_key_dict = {}
+gv_control_index_lock = threading.Lock()
+
 # Dict to map switch context to Unicode
 # symbol
 gv_context_symbol_dict = {
@@ -267,7 +730,36 @@ def purge_all_devices():
             1,
             "Resetting all device dictionaries")
 
+    device_name_list = list(gv_device_dict.keys())
     gv_device_dict = {}
+
+    with gv_probe_lock:
+        gv_probe_heap.clear()
+        gv_probe_due_dict.clear()
+
+    for url in list(gv_url_name_dict.keys()):
+        unregister_device_url(url)
+
+    with gv_latency_lock:
+        gv_latency_dict.clear()
+
+    with gv_control_index_lock:
+        gv_control_index.clear()
+        gv_device_control_key_dict.clear()
+
+    publish_events(
+            [
+                build_event(
+                    'device_purged', 
+                    device_name, 
+                    None, 
+                    None, 
+                    'reset', 
+                    None)
+                for device_name in device_name_list
+                ]
+            )
+
     return
 
 
@@ -284,980 +776,4248 @@ def purge_device(device_name, reason):
             )
 
     if (device_name in gv_device_dict):
+        unregister_device_url(gv_device_dict[device_name]['url'])
+        zone_name = gv_device_dict[device_name]['status'].get('zone')
         del gv_device_dict[device_name]
+        publish_events(
+                [
+                    build_event(
+                        'device_purged', 
+                        device_name, 
+                        zone_name, 
+                        None, 
+                        reason, 
+                        None)
+                    ]
+                )
 
-    return
+    with gv_latency_lock:
+        gv_latency_dict.pop(device_name, None)
 
+    update_control_index(device_name, None)
 
-def track_device_status(device_name, url, json_data):
-    # track device status data and timestamp
-    global gv_device_dict
+    # orphans any heap entry for the device
+    with gv_probe_lock:
+        if device_name in gv_probe_due_dict:
+            del gv_probe_due_dict[device_name]
 
-    # device might have been purged and no longer
-    # tracked in dict.. in which case.. skip
-    if device_name in gv_device_dict:
-        device = gv_device_dict[device_name]
-        device['status'] = json_data
-        device['last_updated'] = int(time.time())
-        device['failed_probes'] = 0
     return
 
 
-def track_control_program(device_name, control_name, event):
-    global gv_device_dict
+def get_url_base(url):
+    # Reduce URL to scheme://host:port
+    parsed_url = urllib.parse.urlsplit(url)
+    return '%s://%s' % (parsed_url.scheme, parsed_url.netloc)
 
-    device = gv_device_dict[device_name]
 
-    if not control_name in device['program_reg']:
-        device['program_reg'][control_name] = {}
+def register_device_url(device_name, url):
+    # Index device URL to its name
+    with gv_session_lock:
+        gv_url_name_dict[get_url_base(url)] = device_name
 
-    # Track the time we programmed the given control
-    device['program_reg'][control_name][event] = int(time.time())
     return
 
 
-def sunset_api_time_to_epoch(time_str, local_timezone):
-    # decode UTC time from string, strip last 6 chars first
-    ts_datetime = datetime.datetime.strptime(time_str[:-6], 
-                                             '%Y-%m-%dT%H:%M:%S')
-    # Adjust for UTC source timezone and local timezone
-    # Some odd stuff observed here in that tz.tzlocal() did
-    # not seem to react to actual local timezone on raspberry
-    # pi. So I used tz.gettz to explicitly get UTC and a parm
-    # string for local timezone and throw that into config
-    from_zone = tz.gettz('UTC')
-    to_zone = tz.gettz(local_timezone)
-    ts_datetime = ts_datetime.replace(tzinfo=from_zone)
-    ts_datetime = ts_datetime.astimezone(to_zone)
+def unregister_device_url(url):
+    # Remove device URL from index 
+    # and close any pooled session
+    url_base = get_url_base(url)
 
-    # Epoch extraction
-    epoch_time = int(time.mktime(ts_datetime.timetuple()))
+    with gv_session_lock:
+        if url_base in gv_url_name_dict:
+            del gv_url_name_dict[url_base]
+        session = gv_device_session_dict.pop(url_base, None)
 
-    return epoch_time
+    if session:
+        session.close()
 
+    if gv_async_transport:
+        gv_async_transport.close_pool(url_base)
 
-def check_control(
-        device_name,
-        zone_name, 
-        control_name):
+    return
 
-    global gv_device_dict
-    global gv_sunset_time
-    global gv_sunrise_time
-    global gv_json_config
 
-    log_message(
-            1,
-            'check_control(device=%s, zone=%s, control=%s' % (
-                device_name,
-                zone_name,
-                control_name)
-            )
+def get_device_session(url_base):
+    # Get pooled session for device URL
+    # created on first use. 
+    # Returns None for URLs not belonging
+    # to a discovered device
+    with gv_session_lock:
+        if not url_base in gv_url_name_dict:
+            return None
+
+        if not url_base in gv_device_session_dict:
+            adapter = requests.adapters.HTTPAdapter(
+                    pool_connections = 1,
+                    pool_maxsize = get_config_value(
+                        'http', 
+                        'device_connection_limit', 
+                        1))
+            session = requests.Session()
+            session.mount(url_base, adapter)
+            gv_device_session_dict[url_base] = session
 
-    current_time = int(time.strftime("%H%M", time.localtime()))
-    current_time_rel_secs = ((int(current_time / 100) * 60 * 60) + 
-            ((current_time % 100) * 60))
+        return gv_device_session_dict[url_base]
+
+
+def track_http_stats(device_name, num_requests, num_connections):
+    # Record request and connection counts 
+    # for device
+    if not device_name in gv_device_dict:
+        return
 
     device = gv_device_dict[device_name]
+    if not 'http_stats' in device:
+        device['http_stats'] = {}
+        device['http_stats']['requests'] = 0
+        device['http_stats']['connections'] = 0
+        device['http_stats']['reused_connections'] = 0
 
-    # device programs
-    for device_program in gv_json_config['device_programs']:
+    http_stats = device['http_stats']
+    http_stats['requests'] = num_requests
+    http_stats['connections'] = num_connections
+    http_stats['reused_connections'] = max(0, num_requests - num_connections)
 
-        # skip programs based on non-match of zone/control 
-        # and if they are disabled
-        if (device_program['zone'] != zone_name or 
-                device_program['control'] != control_name or
-                not device_program['enabled']):
-            continue
+    return
 
-        for event in device_program['events']:
 
-            # Event times
-            # either a 'times' list or a single 'time'
-            if 'times' in event:
-                times_list = event['times']
-            else:
-                times_list = []
-                times_list.append(event['time'])
+def get_percentile(sorted_list, percentile):
+    # Nearest-rank percentile of a sorted list
+    index = int(round((percentile / 100) * (len(sorted_list) - 1)))
+    return sorted_list[index]
 
-            for event_time_str in times_list:
-                event_time = get_event_time(event_time_str)
 
-                # Convert HHMM int values into relative seconds for day
-                event_time_rel_secs = ((int(event_time / 100) * 60 * 60) + 
-                        ((event_time % 100) * 60))
+def get_latency_list(device_name, method):
+    # Sorted copy of the latency window for device
+    # and HTTP method, empty if there is none
+    with gv_latency_lock:
+        latency_window = gv_latency_dict.get(device_name, {}).get(method, [])
+        latency_list = list(latency_window)
 
-                last_program_epoch = 0
-                if (control_name in device['program_reg'] and
-                        event_time in device['program_reg'][control_name]):
-                    last_program_epoch = device['program_reg'][control_name][event_time]
-                last_program_interval = int(time.time()) - last_program_epoch
+    return sorted(latency_list)
 
-                program_threshold = (current_time_rel_secs - event_time_rel_secs) % 86400 
-                log_message(
-                        1,
-                        'Event:%s ev_rel:%d now_rel:%d threshold:%d last_programmed_interval:%d' % (
-                            event_time,
-                            event_time_rel_secs,
-                            current_time_rel_secs,
-                            program_threshold,
-                            last_program_interval
-                            )
-                        )
 
-                if (program_threshold < 60):
-                    if (last_program_interval > 60):
-                        control_data = copy.deepcopy(event['params'])
-                        control_data['name'] = control_name
-
-                        # rgb/argb references
-                        if ('program' in control_data and 
-                                type(control_data['program']) == str):
-                            program_name = control_data['program']
-                            if program_name in gv_json_config['rgb_programs']:
-                                control_data['program'] = gv_json_config['rgb_programs'][program_name]
-                                log_message(
-                                        1,
-                                        'Substituted referenced RGB program %s' % (program_name
-                                                                                   )
-                                        )
-                            elif program_name in gv_json_config['argb_programs']:
-                                control_data['program'] = gv_json_config['argb_programs'][program_name]
-                                log_message(
-                                        1,
-                                        'Substituted referenced ARGB program %s' % (program_name
-                                                                                    )
-                                        )
-
-                        log_message(
-                                1,
-                                'Returning control data.. %s' % (control_data))
-                        return control_data, event_time
-                    else:
-                        log_message(
-                                1,
-                                'Already programmed %d seconds ago' % (
-                            last_program_interval))
+def track_device_latency(device_name, method, latency):
+    # Record request latency for device in its
+    # rolling window for the HTTP method and update
+    # the latency summary in the device record
+    #   latency       GET (status probes and commands)
+    #   post_latency  POST (control and configure)
+    if not device_name in gv_device_dict:
+        return
 
+    latency_window = get_config_value('http', 'latency_window', 100)
+    with gv_latency_lock:
+        method_dict = gv_latency_dict.setdefault(device_name, {})
+        if (not method in method_dict or 
+                method_dict[method].maxlen != latency_window):
+            method_dict[method] = collections.deque(
+                    method_dict.get(method, []),
+                    maxlen = latency_window)
+        method_dict[method].append(latency)
+
+    sorted_list = get_latency_list(device_name, method)
+    latency_dict = {}
+    latency_dict['samples'] = len(sorted_list)
+    latency_dict['p50'] = round(get_percentile(sorted_list, 50), 3)
+    latency_dict['p90'] = round(get_percentile(sorted_list, 90), 3)
+    latency_dict['p99'] = round(get_percentile(sorted_list, 99), 3)
+    latency_dict['max'] = round(sorted_list[-1], 3)
+    latency_dict['timeout'] = round(get_device_timeout(device_name, method), 3)
+
+    device = gv_device_dict.get(device_name)
+    if device is not None:
+        if method == 'POST':
+            device['post_latency'] = latency_dict
+        else:
+            device['latency'] = latency_dict
 
-    # paired switches
-    # anything found on the b-side of the
-    # will have its state to the state of the paired
-    # a-side
-    for paired_switch in gv_json_config['paired_switches']:
-        if (paired_switch['b_zone'] == zone_name and 
-                paired_switch['b_control'] == control_name):
-            a_state = get_control_state(
-                    paired_switch['a_zone'], 
-                    paired_switch['a_control'])
-            b_state = get_control_state(
-                    paired_switch['b_zone'], 
-                    paired_switch['b_control'])
-
-            if (a_state != -1 and 
-                    b_state != -1 and 
-                    a_state != b_state):
-                control_data = {}
-                control_data['name'] = control_name
-                control_data['state'] = a_state
-                log_message(
-                        1,
-                        'Returning paired switch control data.. %s:%s -> %s:%s .. %s' % (
-                            paired_switch['a_zone'], 
-                            paired_switch['a_control'],
-                            paired_switch['b_zone'], 
-                            paired_switch['b_control'],
-                            control_data
-                            )
-                        )
-                return control_data, None
+    return
 
-    # fall-through nothing to do
-    return None, None
 
+def get_device_timeout(device_name, method = 'GET'):
+    # HTTP timeout for device and HTTP method derived 
+    # from the configured percentile of its recent 
+    # latencies multiplied by a safety factor and 
+    # clamped to the min/max bounds. 
+    # The max timeout is used until enough samples have 
+    # been gathered or if the device's last probe failed
+    min_timeout = get_config_value('http', 'min_timeout', 1)
+    max_timeout = get_config_value('http', 'max_timeout', gv_http_timeout_secs)
 
-class ZeroConfListener(object):  
-    def remove_service(self, zeroconf, type, name):
-        # Can ignore this as we will self-purge
-        # unresponsive devices
-        return
+    device = gv_device_dict.get(device_name)
+    if device is None:
+        return max_timeout
 
-    def update_service(self, zeroconf, type, name):
-        # treat update as add
-        self.add_service(zeroconf, type, name)
-        return
+    if ('breaker' in device and 
+            device['breaker']['failures'] > 0):
+        return max_timeout
 
-    def add_service(self, zeroconf, type, name):
-        # extract dns-sd info, build URL
-        # and store in set
-
-        info = zeroconf.get_service_info(type, name)
-        if info:
-            # work around python 3.x variations on support of 
-            # addresses array in the zeroconf service info
-            if hasattr(info, 'addresses'):
-                address = socket.inet_ntoa(info.addresses[0])
-            else:
-                address = socket.inet_ntoa(info.address)
-            port = info.port
-            url = "http://%s:%d" % (address, port)
-            now = int(time.time())
-
-            # Name is formatted 
-            # JBHASD-XXXXXXXX._JBHASD._tcp.local.
-            # So split on '.' and isolate field field
-            fields = name.split('.')
-            device_name = fields[0]
-
-            # register in gloval device dict
-            if not device_name in gv_device_dict:
-                log_message(
-                        1,
-                        "Discovered %s (%s)" % (
-                            device_name,
-                            url
-                            )
-                        )
+    sorted_list = get_latency_list(device_name, method)
+    if len(sorted_list) < get_config_value('http', 'latency_min_samples', 10):
+        return max_timeout
 
-                # register empty device in global device dict
-                device = {}
-                device['name'] = device_name
-                device['url'] = url
-                device['failed_probes'] = 0
-                device['status'] = {}
-                device['status']['name'] = device_name
-                device['status']['zone'] = 'Unknown'
-                device['status']['controls'] = []
-                device['last_updated'] = now
-                device['program_reg'] = {}
-                gv_device_dict[device_name] = device
+    timeout = (get_percentile(
+        sorted_list, 
+        get_config_value('http', 'timeout_percentile', 99)) * 
+        get_config_value('http', 'timeout_factor', 3))
 
+    return min(max(timeout, min_timeout), max_timeout)
 
-        return
 
+def schedule_probe(device_name, delay):
+    # Schedule the next probe of a device 
+    # for delay seconds from now
+    due_time = time.time() + delay
 
-def discovery_agent():
+    with gv_probe_lock:
+        gv_probe_due_dict[device_name] = due_time
+        heapq.heappush(gv_probe_heap, (due_time, device_name))
 
-    zeroconf = None
-    while (1):
-        if zeroconf == None:
-            # Zeroconf service listener for JBHASD devices
-            zeroconf = Zeroconf()
-            listener = ZeroConfListener()  
-            zeroconf.add_service_listener(
-                    "_JBHASD._tcp.local.", 
-                    listener)
-
-        # let it run for 120 seconds
-        time.sleep(120)
-
-        # close all resources to it will 
-        # be recreated fresh
-        # We need to do this to ensure that 
-        # we continually refresh the set of URLs
-        # inb conjunction with the purging model
-        zeroconf.close()
-        zeroconf = None
+        # wake the probe agent if this is now
+        # the earliest due probe
+        if gv_probe_heap[0][1] == device_name:
+            gv_probe_wakeup.set()
 
     return
 
 
-def get_url(url, url_timeout, parse_json):
-    # General purpose URL GETer
-    # return contents of page and parsed as json
-    # if the parse_json arg is 1
+def get_probe_delay(device_name):
+    # Device probe interval plus a random 
+    # jitter to avoid probes bunching together
+    probe_interval = gv_json_config['discovery']['device_probe_interval']
+    if (device_name in gv_device_dict and
+            'probe_interval' in gv_device_dict[device_name]):
+        probe_interval = gv_device_dict[device_name]['probe_interval']
+    probe_jitter = get_config_value('discovery', 'probe_jitter', 0.2)
+
+    return probe_interval + random.uniform(0, probe_interval * probe_jitter)
+
+
+def get_probe_interval_bounds(device_name):
+    # Min and max adaptive probe intervals for device
+    # Settings for the device name override those for 
+    # its profile which in turn override the 
+    # discovery defaults
+    probe_interval = gv_json_config['discovery']['device_probe_interval']
+    min_interval = get_config_value(
+            'discovery', 
+            'min_probe_interval', 
+            probe_interval)
+    max_interval = get_config_value(
+            'discovery', 
+            'max_probe_interval', 
+            probe_interval * 4)
+
+    override_list = []
+    if (type(gv_json_config.get('devices')) == dict and
+            device_name in gv_json_config['devices']):
+        profile_name = gv_json_config['devices'][device_name].get('profile')
+        profile_intervals = get_config_value(
+                'discovery', 
+                'profile_probe_intervals', 
+                {})
+        if profile_name in profile_intervals:
+            override_list.append(profile_intervals[profile_name])
+
+    device_intervals = get_config_value(
+            'discovery', 
+            'device_probe_intervals', 
+            {})
+    if device_name in device_intervals:
+        override_list.append(device_intervals[device_name])
+
+    for override in override_list:
+        min_interval = override.get('min_probe_interval', min_interval)
+        max_interval = override.get('max_probe_interval', max_interval)
+
+    return min_interval, max(min_interval, max_interval)
+
+
+def is_activity_event(event):
+    # Whether a status change event counts as 
+    # device activity for the adaptive probe interval.
+    # Sensor readings count only when one moves by at
+    # least discovery/sensor_change_threshold so that 
+    # drift does not hold the interval down. 
+    # Volatile fields such as RGB program steps 
+    # don't raise events in the first place
+    if event['type'] != 'sensor':
+        return True
+
+    threshold = get_config_value('discovery', 'sensor_change_threshold', 0.5)
+    for key in event['new']:
+        try:
+            delta = abs(float(event['new'][key]) - float(event['old'][key]))
+        except (TypeError, ValueError):
+            # reading appeared, vanished or is not numeric
+            return True
 
-    global gv_device_dict
+        if delta >= threshold:
+            return True
 
-    # Try to determine the URL name
-    url_name = "Unknown"
-    for device_name in gv_device_dict:
-        if (url == gv_device_dict[device_name]):
-            url_name = device_name
+    return False
 
-    response_str = None
-    response = None
-    try:
-        response = requests.get(url,
-                                timeout = url_timeout)
-    except:
-        log_message(
-                1,
-                "Error in GET Name:%s URL:%s" % (
-            url_name, 
-            url
-            )
-                )
 
-    if response:
-        response_str = response.text
+def update_probe_interval(device_name, changed):
+    # Adapt the device probe interval to its rate
+    # of change. Devices with changing status have 
+    # their interval shortened while stable devices
+    # are stretched out
+    if not device_name in gv_device_dict:
+        return
 
-        if parse_json:
-            try:
-                json_data = response.json()
-            except:
-                log_message(
-                        1,
-                        "Error in JSON parse.. Name:%s URL:%s Data:%s" % (
-                            url_name, 
-                            url, 
-                            response_str
-                            )
-                        )
-                return None
-            return json_data
+    device = gv_device_dict[device_name]
+    min_interval, max_interval = get_probe_interval_bounds(device_name)
+    probe_interval = device.get(
+            'probe_interval', 
+            gv_json_config['discovery']['device_probe_interval'])
 
-    return response_str
-     
+    if changed:
+        probe_interval *= gv_probe_interval_shrink
+    else:
+        probe_interval *= gv_probe_interval_grow
 
-def post_url(url, json_data, url_timeout):
-    # General purpose URL POSTer
-    # for JSON payloads
-    # return contents parsed as json
+    probe_interval = min(max(probe_interval, min_interval), max_interval)
+    device['probe_interval'] = round(probe_interval, 1)
 
-    log_message(
-            1,
-            "POST %s \n%s\n" % (url, json_data))
+    return
 
-    response = None
-    try:
-        response = requests.post(url,
-                                 json = json_data,
-                                 timeout = url_timeout)
-    except:
-        log_message(
-                1,
-                "Error in POST URL:%s" % (url))
 
-    if response:
-        try:
-            json_data = response.json()
-        except:
+def get_breaker(device):
+    # Circuit breaker state for device
+    # created closed on first use
+    if not 'breaker' in device:
+        device['breaker'] = {}
+        device['breaker']['state'] = 'closed'
+        device['breaker']['failures'] = 0
+        device['breaker']['backoff'] = 0
+        device['breaker']['retry_time'] = 0
+
+    return device['breaker']
+
+
+def track_breaker_result(device_name, success):
+    # Update device circuit breaker after a probe
+    # Consecutive failures past the threshold open
+    # the breaker for a backoff period after which a 
+    # single half-open probe is permitted. A failed 
+    # half-open probe re-opens the breaker with double
+    # the backoff. Any success closes the breaker
+    # device might have been purged while the 
+    # request was in flight.. in which case.. skip
+    if not device_name in gv_device_dict:
+        return
+
+    device = gv_device_dict[device_name]
+    breaker = get_breaker(device)
+
+    if success:
+        if breaker['state'] != 'closed':
             log_message(
                     1,
-                    "Error in JSON parse.. URL:%s Data:%s" % (
-                        url, 
-                        response.text
-                        )
-                    )
-            return None
+                    "Closing circuit breaker for %s" % (device_name))
+            mark_device_changed(device_name)
+        breaker['state'] = 'closed'
+        breaker['failures'] = 0
+        breaker['backoff'] = 0
+        breaker['retry_time'] = 0
+        return
 
-        return json_data
+    breaker['failures'] += 1
+
+    if breaker['state'] == 'half-open':
+        breaker['backoff'] = min(
+                breaker['backoff'] * 2, 
+                get_config_value('discovery', 'breaker_max_backoff', 300))
+    elif (breaker['state'] == 'closed' and 
+            breaker['failures'] >= get_config_value(
+                'discovery', 
+                'breaker_threshold', 
+                3)):
+        breaker['backoff'] = get_config_value('discovery', 'breaker_backoff', 10)
+    else:
+        return
 
-    return response
+    breaker['state'] = 'open'
+    breaker['retry_time'] = int(time.time()) + breaker['backoff']
+    mark_device_changed(device_name)
+    log_message(
+            1,
+            "Opening circuit breaker for %s (failures:%d backoff:%d secs)" % (
+                device_name,
+                breaker['failures'],
+                breaker['backoff']
+                )
+            )
 
+    return
+
+
+def get_due_probes(due_time):
+    # Pop devices due for probe at or before 
+    # the given time. Returns the list of due 
+    # device names and the due time of the next 
+    # scheduled probe (None if nothing scheduled)
+    due_list = []
+
+    with gv_probe_lock:
+        while (len(gv_probe_heap) > 0 and
+                gv_probe_heap[0][0] <= due_time):
+            device_due_time, device_name = heapq.heappop(gv_probe_heap)
+
+            # skip stale entries
+            if gv_probe_due_dict.get(device_name) != device_due_time:
+                continue
+
+            del gv_probe_due_dict[device_name]
+            due_list.append(device_name)
+
+        next_due_time = None
+        if len(gv_probe_heap) > 0:
+            next_due_time = gv_probe_heap[0][0]
+
+    return due_list, next_due_time
+
+
+def update_control_index(device_name, json_data):
+    # Replace the control index entries for device 
+    # with those from its status data. 
+    # json_data of None removes the device entries
+    with gv_control_index_lock:
+        for index_key in gv_device_control_key_dict.pop(device_name, set()):
+            if index_key in gv_control_index:
+                gv_control_index[index_key].pop(device_name, None)
+                if len(gv_control_index[index_key]) == 0:
+                    del gv_control_index[index_key]
+
+        if json_data is None:
+            return
+
+        zone_name = json_data.get('zone')
+        key_set = set()
+        for control in json_data.get('controls', []):
+            index_key = (zone_name, control['name'])
+            if not index_key in gv_control_index:
+                gv_control_index[index_key] = {}
+            gv_control_index[index_key][device_name] = control
+            key_set.add(index_key)
+
+        gv_device_control_key_dict[device_name] = key_set
+
+    return
+
+
+def get_zone_controls(zone_name, control_name):
+    # Get list of (device name, control record) tuples
+    # for devices with the given zone and control
+    with gv_control_index_lock:
+        return list(gv_control_index.get((zone_name, control_name), {}).items())
+
+
+def subscribe_events(callback, type_list = None):
+    # Register callback for change events
+    # optionally limited to a list of event types.
+    # Callbacks are called in the publishing thread 
+    # and should not block
+    type_set = None
+    if type_list is not None:
+        type_set = set(type_list)
+    gv_event_subscriber_list.append((callback, type_set))
+    return
+
+
+def publish_events(event_list):
+    # Deliver change events to subscribers
+    for event in event_list:
+        for callback, type_set in list(gv_event_subscriber_list):
+            if (type_set is not None and 
+                    not event['type'] in type_set):
+                continue
+            try:
+                callback(event)
+            except Exception as ex:
+                log_message(
+                        1,
+                        "Event subscriber %s failed on %s: %s" % (
+                            callback.__name__,
+                            event['type'],
+                            ex
+                            )
+                        )
+    return
+
+
+def build_event(
+        event_type, 
+        device_name, 
+        zone_name, 
+        control_name, 
+        old, 
+        new):
+    # Change event record
+    event = {}
+    event['type'] = event_type
+    event['device'] = device_name
+    event['zone'] = zone_name
+    event['control'] = control_name
+    event['old'] = old
+    event['new'] = new
+    event['time'] = time.time()
+    return event
+
+
+def get_uptime_msecs(json_data):
+    # Device uptime in msecs from its status 
+    # The firmware reports system/uptime_msecs and
+    # API.md documents it as system/millis
+    # returns None if not reported
+    system = json_data.get('system', {})
+    if 'uptime_msecs' in system:
+        return system['uptime_msecs']
+
+    return system.get('millis')
+
+
+def get_activity_age_secs(json_data, control):
+    # Seconds since the last activity on a control
+    # from its activity timestamp relative to device 
+    # uptime (last_activity_msecs from the firmware, 
+    # last_activity_millis in API.md) or the API.md 
+    # last_activity_delta_secs. 
+    # The firmware last_activity is a display string 
+    # and not used. returns 0 if not reported
+    # The device millis counter is an unsigned 32-bit
+    # int so the delta is taken modulo 2^32 as it wraps
+    uptime_msecs = get_uptime_msecs(json_data)
+    for key in ['last_activity_msecs', 'last_activity_millis']:
+        if key in control and uptime_msecs is not None:
+            return ((uptime_msecs - control[key]) % 0x100000000) / 1000
+
+    return control.get('last_activity_delta_secs', 0)
+
+
+def diff_device_status(device_name, old_json_data, json_data):
+    # Compare new device status to the previous one
+    # and return a list of change events:
+    #   zone            device zone changed
+    #   reboot          device uptime went backwards
+    #   control_added   control appeared (or moved zone)
+    #   control_removed control disappeared (or moved zone)
+    #   switch_state    switch state changed
+    #   switch_context  switch context changed
+    #   sensor          sensor readings changed
+    #   control_changed any other control fields changed
+    # Control fields that change on every probe are ignored
+    event_list = []
+    old_zone_name = old_json_data.get('zone')
+    zone_name = json_data.get('zone')
+
+    if old_zone_name != zone_name:
+        event_list.append(
+                build_event(
+                    'zone', 
+                    device_name, 
+                    zone_name, 
+                    None,
+                    old_zone_name, 
+                    zone_name))
+
+    old_uptime_msecs = get_uptime_msecs(old_json_data)
+    uptime_msecs = get_uptime_msecs(json_data)
+    if (old_uptime_msecs is not None and 
+            uptime_msecs is not None and 
+            uptime_msecs < old_uptime_msecs):
+        event_list.append(
+                build_event(
+                    'reboot', 
+                    device_name, 
+                    zone_name, 
+                    None,
+                    old_uptime_msecs, 
+                    uptime_msecs))
+
+    # controls moving zone are treated as 
+    # removed from the old and added to the new zone
+    old_control_dict = {}
+    if old_zone_name == zone_name:
+        for control in old_json_data.get('controls', []):
+            old_control_dict[control['name']] = control
+    else:
+        for control in old_json_data.get('controls', []):
+            event_list.append(
+                    build_event(
+                        'control_removed', 
+                        device_name, 
+                        old_zone_name, 
+                        control['name'],
+                        control, 
+                        None))
+
+    control_name_set = set()
+    for control in json_data.get('controls', []):
+        control_name = control['name']
+        control_name_set.add(control_name)
+
+        if not control_name in old_control_dict:
+            event_list.append(
+                    build_event(
+                        'control_added', 
+                        device_name, 
+                        zone_name, 
+                        control_name,
+                        None, 
+                        control))
+            continue
+
+        old_control = old_control_dict[control_name]
+        if control['type'] == 'switch':
+            if old_control.get('state') != control.get('state'):
+                event_list.append(
+                        build_event(
+                            'switch_state', 
+                            device_name, 
+                            zone_name, 
+                            control_name,
+                            old_control.get('state'), 
+                            control))
+            if old_control.get('context') != control.get('context'):
+                event_list.append(
+                        build_event(
+                            'switch_context', 
+                            device_name, 
+                            zone_name, 
+                            control_name,
+                            old_control.get('context'), 
+                            control))
+            continue
+
+        # changed fields other than the volatile ones
+        delta_dict = {}
+        for key in control:
+            if (not key in gv_volatile_control_fields and 
+                    old_control.get(key) != control[key]):
+                delta_dict[key] = control[key]
+
+        if len(delta_dict) > 0:
+            event_type = 'control_changed'
+            if control['type'] == 'temp/humidity':
+                event_type = 'sensor'
+            old_delta_dict = {key: old_control.get(key) for key in delta_dict}
+            event_list.append(
+                    build_event(
+                        event_type, 
+                        device_name, 
+                        zone_name, 
+                        control_name,
+                        old_delta_dict, 
+                        delta_dict))
+
+    for control_name in old_control_dict:
+        if not control_name in control_name_set:
+            event_list.append(
+                    build_event(
+                        'control_removed', 
+                        device_name, 
+                        zone_name, 
+                        control_name,
+                        old_control_dict[control_name], 
+                        None))
+
+    return event_list
+
+
+def paired_switch_event_handler(event):
+    # Detect state changes on a-side paired switches
+    # and queue propagation of the new state to the 
+    # b-sides. Repeated changes before the paired switch 
+    # agent runs are coalesced with the latest state winning
+    control = event['new']
+    paired_a_key = (event['zone'], event['control'])
+    if (control is None or
+            control['type'] != 'switch' or 
+            not paired_a_key in gv_paired_switch_a_index):
+        return
+
+    # the device reports the time of the last 
+    # state change which lets us include the 
+    # time taken to detect the change
+    # (the event is published once the new status 
+    # is stored in the device record)
+    detected_time = event['time']
+    device = gv_device_dict.get(event['device'])
+    if device is not None:
+        detected_time -= get_activity_age_secs(device['status'], control)
+
+    with gv_paired_switch_lock:
+        for paired_switch in gv_paired_switch_a_index[paired_a_key]:
+            paired_b_key = (paired_switch['b_zone'], paired_switch['b_control'])
+            propagation = {}
+            propagation['a_key'] = paired_a_key
+            propagation['state'] = int(control['state'])
+            propagation['detected_time'] = detected_time
+            gv_paired_switch_pending_dict[paired_b_key] = propagation
+
+    gv_paired_switch_wakeup.set()
+
+    return
+
+
+def track_device_status(device_name, url, json_data):
+    # track device status data and timestamp
+    # Changes from the previous status are published
+    # as events and returned as a list
+    global gv_device_dict
+
+    event_list = []
+
+    # device might have been purged and no longer
+    # tracked in dict.. in which case.. skip
+    if device_name in gv_device_dict:
+        device = gv_device_dict[device_name]
+        event_list = diff_device_status(
+                device_name, 
+                device['status'], 
+                json_data)
+        device['status'] = json_data
+        device['last_updated'] = int(time.time())
+        device['failed_probes'] = 0
+        update_control_index(device_name, json_data)
+        publish_events(event_list)
+
+    return event_list
+
+
+def track_control_program(device_name, control_name, event):
+    global gv_device_dict
+
+    # device might have been purged since the 
+    # program was dispatched.. in which case.. skip
+    device = gv_device_dict.get(device_name)
+    if device is None:
+        return
+
+    if not control_name in device['program_reg']:
+        device['program_reg'][control_name] = {}
+
+    # Track the time we programmed the given control
+    device['program_reg'][control_name][event] = int(time.time())
+    return
+
+
+def sunset_api_time_to_epoch(time_str, local_timezone):
+    # decode UTC time from string, strip last 6 chars first
+    ts_datetime = datetime.datetime.strptime(time_str[:-6], 
+                                             '%Y-%m-%dT%H:%M:%S')
+    # Adjust for UTC source timezone and local timezone
+    # Some odd stuff observed here in that tz.tzlocal() did
+    # not seem to react to actual local timezone on raspberry
+    # pi. So I used tz.gettz to explicitly get UTC and a parm
+    # string for local timezone and throw that into config
+    from_zone = tz.gettz('UTC')
+    to_zone = tz.gettz(local_timezone)
+    ts_datetime = ts_datetime.replace(tzinfo=from_zone)
+    ts_datetime = ts_datetime.astimezone(to_zone)
+
+    # Epoch extraction
+    epoch_time = int(time.mktime(ts_datetime.timetuple()))
+
+    return epoch_time
+
+
+def check_control(
+        device_name,
+        zone_name, 
+        control_name):
+    # Check paired switch state for control
+    # Timed device programs are handled by the
+    # timer agent
+
+    global gv_device_dict
+    global gv_json_config
+
+    # paired switches
+    # anything found on the b-side of the
+    # will have its state to the state of the paired
+    # a-side
+    for paired_switch in gv_paired_switch_index.get((zone_name, control_name), []):
+        a_state = get_control_state(
+                paired_switch['a_zone'], 
+                paired_switch['a_control'])
+        b_state = get_control_state(
+                paired_switch['b_zone'], 
+                paired_switch['b_control'])
+
+        if (a_state != -1 and 
+                b_state != -1 and 
+                a_state != b_state):
+            control_data = {}
+            control_data['name'] = control_name
+            control_data['state'] = a_state
+            log_message(
+                    1,
+                    'Returning paired switch control data.. %s:%s -> %s:%s .. %s' % (
+                        paired_switch['a_zone'], 
+                        paired_switch['a_control'],
+                        paired_switch['b_zone'], 
+                        paired_switch['b_control'],
+                        control_data
+                        )
+                    )
+            return control_data, None
+
+    # fall-through nothing to do
+    return None, None
+
+
+def register_device(device_name, url):
+    # Register a device found by discovery
+    # New devices are added with an empty status
+    # and scheduled for their first probe. 
+    # Known devices that have moved to a new URL
+    # are updated in place and probed right away
+    global gv_device_dict
+
+    now = int(time.time())
+
+    if device_name in gv_device_dict:
+        device = gv_device_dict[device_name]
+
+        # seen again so no longer pending removal
+        device.pop('removed', None)
+
+        if device['url'] == url:
+            return
+
+        old_url = device['url']
+        log_message(
+                1,
+                "Device %s moved %s -> %s" % (
+                    device_name,
+                    old_url,
+                    url
+                    )
+                )
+
+        # the breaker and latencies of the old
+        # address don't apply to the new one
+        unregister_device_url(old_url)
+        device['url'] = url
+        device.pop('breaker', None)
+        with gv_latency_lock:
+            gv_latency_dict.pop(device_name, None)
+        register_device_url(device_name, url)
+        publish_events(
+                [
+                    build_event(
+                        'device_moved', 
+                        device_name, 
+                        device['status'].get('zone'), 
+                        None, 
+                        old_url, 
+                        url)
+                    ]
+                )
+        schedule_probe(device_name, 0)
+        return
+
+    log_message(
+            1,
+            "Discovered %s (%s)" % (
+                device_name,
+                url
+                )
+            )
+
+    # register empty device in global device dict
+    device = {}
+    device['name'] = device_name
+    device['url'] = url
+    device['failed_probes'] = 0
+    device['status'] = {}
+    device['status']['name'] = device_name
+    device['status']['zone'] = 'Unknown'
+    device['status']['controls'] = []
+    device['last_updated'] = now
+    device['program_reg'] = {}
+    gv_device_dict[device_name] = device
+    register_device_url(device_name, url)
+    publish_events(
+            [
+                build_event(
+                    'device_added', 
+                    device_name, 
+                    None, 
+                    None, 
+                    None, 
+                    url)
+                ]
+            )
+
+    # first probe is spread across the probe 
+    # interval to avoid a burst of probes after
+    # discovery
+    schedule_probe(
+            device_name, 
+            random.uniform(
+                0, 
+                gv_json_config['discovery']['device_probe_interval']))
+
+    return
+
+
+def get_service_device_name(name):
+    # Name is formatted 
+    # JBHASD-XXXXXXXX._JBHASD._tcp.local.
+    # So split on '.' and isolate field field
+    fields = name.split('.')
+    return fields[0]
+
+
+def resolve_service(zeroconf, type, name):
+    # Resolve a service to its URL and 
+    # register the device
+    # Runs on the discovery worker pool so
+    # the browser thread is never blocked
+    with gv_resolve_lock:
+        gv_resolve_pending_set.discard(name)
+
+    try:
+        info = zeroconf.get_service_info(
+                type, 
+                name,
+                int(get_config_value('discovery', 'resolve_timeout', 3) * 1000))
+    except Exception as ex:
+        log_message(
+                1,
+                "Error resolving %s: %s" % (
+                    name,
+                    ex
+                    )
+                )
+        return
+
+    if not info or len(info.addresses) == 0:
+        log_message(
+                1,
+                "Failed to resolve %s" % (
+                    name
+                    )
+                )
+        return
+
+    address = socket.inet_ntoa(info.addresses[0])
+    port = info.port
+    url = "http://%s:%d" % (address, port)
+    register_device(get_service_device_name(name), url)
+
+    return
+
+
+class ZeroConfListener(object):  
+    # Browser callbacks hand resolution off to the
+    # discovery worker pool. Repeat announcements 
+    # for a service already waiting to be resolved 
+    # are coalesced
+    def remove_service(self, zeroconf, type, name):
+        # Service withdrawn or its records expired
+        # The device is probed right away and purged
+        # if that probe fails
+        device_name = get_service_device_name(name)
+        if device_name in gv_device_dict:
+            log_message(
+                    1,
+                    "Service removed for %s.. probing" % (
+                        device_name
+                        )
+                    )
+            gv_device_dict[device_name]['removed'] = int(time.time())
+            schedule_probe(device_name, 0)
+        return
+
+    def update_service(self, zeroconf, type, name):
+        # treat update as add
+        # picks up address changes
+        self.add_service(zeroconf, type, name)
+        return
+
+    def add_service(self, zeroconf, type, name):
+        with gv_resolve_lock:
+            if name in gv_resolve_pending_set:
+                return
+            gv_resolve_pending_set.add(name)
+
+        gv_discovery_executor.submit(
+                resolve_service,
+                zeroconf,
+                type,
+                name)
+        return
+
+
+def parse_port_list(port_list):
+    # Ports from a list of port numbers and 
+    # "first-last" range strings
+    # invalid entries are logged and skipped
+    parsed_list = []
+    for port in port_list:
+        try:
+            if type(port) == str and '-' in port:
+                first_port, last_port = port.split('-', 1)
+                parsed_list.extend(range(int(first_port), int(last_port) + 1))
+            else:
+                parsed_list.append(int(port))
+        except (TypeError, ValueError):
+            log_message(
+                    1,
+                    "Skipping invalid sweep port %s" % (
+                        port
+                        )
+                    )
+
+    return parsed_list
+
+
+def load_static_devices():
+    # Static device list from discovery/static_devices
+    # and the optional discovery/static_file
+    # Entries are device URLs or dicts with a url and
+    # optional name. The file can be the NDJSON or CSV 
+    # output of jbhasd_discover.py or a plain list of
+    # URLs, one per line
+    # returns list of (device name or None, url)
+    record_list = []
+    for entry in get_config_value('discovery', 'static_devices', []):
+        if type(entry) == dict:
+            record_list.append(entry)
+        else:
+            record_list.append({'url' : entry})
+
+    static_file = get_config_value('discovery', 'static_file', None)
+    if static_file:
+        try:
+            with open(os.path.expanduser(static_file)) as infile:
+                if static_file.endswith('.csv'):
+                    record_list.extend(csv.DictReader(infile))
+                else:
+                    for line in infile:
+                        line = line.strip()
+                        if line.startswith('{'):
+                            record_list.append(json.loads(line))
+                        elif line:
+                            record_list.append({'url' : line})
+        except Exception as ex:
+            log_message(
+                    1,
+                    "Error loading static devices from %s: %s" % (
+                        static_file,
+                        ex
+                        )
+                    )
+
+    device_list = []
+    for record in record_list:
+        try:
+            if (type(record) != dict or 
+                    not record.get('url', '').startswith('http')):
+                raise ValueError('no device URL')
+            device_list.append(
+                    (record.get('name') or None, 
+                        get_url_base(record['url'])))
+        except (AttributeError, ValueError) as ex:
+            log_message(
+                    1,
+                    "Skipping invalid static device %s: %s" % (
+                        record,
+                        ex
+                        )
+                    )
+
+    return device_list
+
+
+def get_sweep_devices():
+    # URLs for every host and port in the 
+    # discovery/sweep_networks CIDR ranges and 
+    # discovery/sweep_ports
+    # returns list of (None, url)
+    port_list = parse_port_list(
+            get_config_value('discovery', 'sweep_ports', [80]))
+
+    device_list = []
+    for network in get_config_value('discovery', 'sweep_networks', []):
+        try:
+            network = ipaddress.ip_network(network, strict = False)
+        except (TypeError, ValueError) as ex:
+            log_message(
+                    1,
+                    "Skipping invalid sweep network %s: %s" % (
+                        network,
+                        ex
+                        )
+                    )
+            continue
+
+        host_list = list(network.hosts())
+        if len(host_list) == 0:
+            host_list = [network.network_address]
+        for host in host_list:
+            for port in port_list:
+                device_list.append(
+                        (None, 'http://%s:%d' % (host, port)))
+
+    return device_list
+
+
+def check_device_task(device):
+    # Executor task for a static or swept device
+    # so one bad host or URL is skipped rather 
+    # than failing the whole sweep
+    device_name, url, check_port = device
+    try:
+        return check_device_url(device_name, url, check_port)
+    except Exception as ex:
+        log_message(
+                1,
+                "Error checking %s: %s" % (
+                    url,
+                    ex
+                    )
+                )
+        return 0
+
+
+def check_device_url(device_name, url, check_port):
+    # Register a static or swept device
+    # Devices with a known name are registered directly
+    # and left to the probe engine. Otherwise the status
+    # is fetched to get the device name, first checking
+    # the port is open if check_port is set so that a 
+    # sweep passes quickly over empty addresses
+    # returns 1 if a device was registered
+    if device_name is not None:
+        register_device(device_name, url)
+        return 1
+
+    if url in gv_url_name_dict:
+        return 1
+
+    url_timeout = get_config_value('discovery', 'sweep_timeout', 1)
+
+    if check_port:
+        parsed_url = urllib.parse.urlsplit(url)
+        try:
+            sock = socket.create_connection(
+                    (parsed_url.hostname, parsed_url.port),
+                    url_timeout)
+            sock.close()
+        except OSError:
+            return 0
+
+    json_data = get_url(url, url_timeout, 1)
+    if not json_data or not 'name' in json_data:
+        return 0
+
+    register_device(json_data['name'], url)
+    return 1
+
+
+def seed_devices(mode):
+    # Register devices from the static list or 
+    # a sweep of the configured networks
+    # checked in parallel on a worker pool
+    start_time = time.time()
+
+    if mode == 'static':
+        device_list = load_static_devices()
+    else:
+        device_list = get_sweep_devices()
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers = get_config_value('discovery', 'sweep_workers', 100)) as sweep_executor:
+        found_list = list(
+                sweep_executor.map(
+                    check_device_task,
+                    [
+                        (device_name, url, mode == 'sweep') 
+                        for device_name, url in device_list
+                        ]))
+
+    log_message(
+            1,
+            "Discovery (%s).. checked %d URLs, found %d devices in %.1f secs" % (
+                mode,
+                len(device_list),
+                sum(found_list),
+                time.time() - start_time
+                )
+            )
+
+    return
+
+
+def discovery_agent():
+    # Device discovery
+    # discovery/mode selects one of:
+    #   zeroconf  mDNS/DNS-SD browse (default)
+    #   static    configured list of devices
+    #   sweep     scan of configured networks and ports
+    # The static list and sweep are re-checked every
+    # discovery/rescan_interval seconds
+    #
+    # For zeroconf, a long-lived browser re-queries on 
+    # its own backoff schedule and reports services added, 
+    # updated and removed (including TTL expiry) so there
+    # is no need to periodically recreate it
+    global gv_discovery_executor
+
+    if gv_discovery_mode != 'zeroconf':
+        while (1):
+            try:
+                seed_devices(gv_discovery_mode)
+            except Exception:
+                log_message(
+                        1,
+                        "Error in %s discovery:\n%s" % (
+                            gv_discovery_mode,
+                            traceback.format_exc()
+                            )
+                        )
+            time.sleep(get_config_value('discovery', 'rescan_interval', 60))
+
+    gv_discovery_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers = get_config_value('discovery', 'resolve_workers', 4))
+
+    zeroconf = Zeroconf()
+    listener = ZeroConfListener()  
+    browser = ServiceBrowser(
+            zeroconf,
+            "_JBHASD._tcp.local.", 
+            listener)
+
+    while (1):
+        time.sleep(3600)
+
+    return
+
+
+class AsyncResponse(object):
+    # Minimal response object returned by the
+    # async transport. Mimics the parts of 
+    # requests.Response used by get_url() and post_url()
+
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+        self.text = content.decode('utf-8', errors = 'replace')
+
+    def __bool__(self):
+        return self.status_code < 400
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class AsyncDeviceTransport(object):
+    # Runs device HTTP calls on a single asyncio
+    # event loop in its own thread. 
+    # Each device (scheme://host:port) gets a pool of 
+    # keep-alive connections limited by a semaphore
+    # to the device connection limit.
+    # Agents either gather a batch of request coroutines 
+    # on the loop (probe fan-out) or submit a single request
+    # and wait on it (control, configure and commands)
+
+    def __init__(self, connection_limit):
+        self.connection_limit = connection_limit
+
+        # only accessed from the event loop thread
+        self.pool_dict = {}
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+                target = self.run_loop,
+                daemon = True)
+        self.thread.start()
+
+    def run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coroutine):
+        # Run coroutine on the event loop
+        # returns a concurrent.futures.Future
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def gather(self, coroutine_list, timeout):
+        # Run a list of coroutines concurrently on 
+        # the event loop bounded by the timeout.
+        # returns a concurrent.futures.Future for 
+        # the list of results
+        return self.submit(self.gather_coroutines(coroutine_list, timeout))
+
+    def close_pool(self, url_base):
+        # Close pooled connections of a device
+        # (thread safe)
+        self.loop.call_soon_threadsafe(self.close_idle_connections, url_base)
+
+    def http_request(self, method, url, json_data, url_timeout):
+        # blocking request for use by agent threads
+        future = self.submit(
+                self.request(
+                    method, 
+                    url, 
+                    json_data, 
+                    url_timeout))
+        return future.result()
+
+    async def gather_coroutines(self, coroutine_list, timeout):
+        return await asyncio.wait_for(
+                asyncio.gather(*coroutine_list),
+                timeout)
+
+    def get_pool(self, url_base):
+        if not url_base in self.pool_dict:
+            pool = {}
+            pool['semaphore'] = asyncio.Semaphore(self.connection_limit)
+            pool['idle_list'] = []
+            pool['requests'] = 0
+            pool['connections'] = 0
+            self.pool_dict[url_base] = pool
+
+        return self.pool_dict[url_base]
+
+    def close_idle_connections(self, url_base):
+        pool = self.pool_dict.pop(url_base, None)
+        if pool:
+            for reader, writer in pool['idle_list']:
+                writer.close()
+
+        return
+
+    async def request(self, method, url, json_data, url_timeout):
+        # Request on a pooled connection
+        # timeout covers time queued for the device
+        # connection as well as the request itself
+        parsed_url = urllib.parse.urlsplit(url)
+        url_base = get_url_base(url)
+        url_name = gv_url_name_dict.get(url_base)
+        pool = self.get_pool(url_base)
+
+        response = await asyncio.wait_for(
+                self.pooled_request(
+                    pool, 
+                    url_name,
+                    method, 
+                    parsed_url, 
+                    json_data),
+                url_timeout)
+
+        if url_name:
+            track_http_stats(url_name, pool['requests'], pool['connections'])
+
+        return response
+
+    async def pooled_request(self, pool, url_name, method, parsed_url, json_data):
+        async with pool['semaphore']:
+            connection = None
+            while len(pool['idle_list']) > 0:
+                reader, writer = pool['idle_list'].pop()
+                if reader.at_eof() or writer.is_closing():
+                    writer.close()
+                else:
+                    connection = (reader, writer)
+                    break
+
+            reused = connection is not None
+            if not reused:
+                connection = await self.open_connection(pool, parsed_url)
+
+            start_time = time.time()
+            try:
+                try:
+                    response, keep_alive = await self.http_exchange(
+                            connection, 
+                            method, 
+                            parsed_url, 
+                            json_data)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    if not reused:
+                        raise
+
+                    # device closed the idle connection before
+                    # it got our request.. retry once on a 
+                    # fresh connection
+                    connection[1].close()
+                    connection = await self.open_connection(pool, parsed_url)
+                    response, keep_alive = await self.http_exchange(
+                            connection, 
+                            method, 
+                            parsed_url, 
+                            json_data)
+            except BaseException:
+                # includes cancellation on timeout.. the 
+                # connection state is unknown so drop it
+                connection[1].close()
+                raise
+
+            if url_name:
+                track_device_latency(url_name, method, time.time() - start_time)
+
+            pool['requests'] += 1
+            if keep_alive:
+                pool['idle_list'].append(connection)
+            else:
+                connection[1].close()
+
+            return response
+
+    async def open_connection(self, pool, parsed_url):
+        use_ssl = (parsed_url.scheme == 'https')
+        port = parsed_url.port
+        if not port:
+            port = 443 if use_ssl else 80
+
+        connection = await asyncio.open_connection(
+                parsed_url.hostname, 
+                port,
+                ssl = use_ssl)
+        pool['connections'] += 1
+        return connection
+
+    async def http_exchange(self, connection, method, parsed_url, json_data):
+        # Single HTTP/1.1 request/response on a connection
+        # returns the response and whether the connection
+        # can be kept alive for further requests
+        reader, writer = connection
+
+        path = parsed_url.path
+        if not path:
+            path = '/'
+        if parsed_url.query:
+            path += '?' + parsed_url.query
+
+        body = b''
+        header_list = [
+                '%s %s HTTP/1.1' % (method, path),
+                'Host: %s' % (parsed_url.netloc),
+                'Connection: keep-alive',
+                'Accept: */*',
+                ]
+        if json_data is not None:
+            body = json.dumps(json_data).encode('utf-8')
+            header_list.append('Content-Type: application/json')
+        if method == 'POST':
+            header_list.append('Content-Length: %d' % (len(body)))
+
+        request_str = '\r\n'.join(header_list) + '\r\n\r\n'
+        writer.write(request_str.encode('utf-8') + body)
+        await writer.drain()
+
+        # status line
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError('connection closed by device')
+        version, status_code = status_line.split()[:2]
+        status_code = int(status_code)
+
+        # headers
+        header_dict = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, value = line.decode('latin-1').split(':', 1)
+            header_dict[key.strip().lower()] = value.strip()
+
+        keep_alive = (version == b'HTTP/1.1' and 
+                header_dict.get('connection', '').lower() != 'close')
+
+        # body
+        if header_dict.get('transfer-encoding', '').lower() == 'chunked':
+            content = b''
+            while True:
+                chunk_size = int((await reader.readline()).split(b';')[0], 16)
+                if chunk_size == 0:
+                    # skip trailers
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                content += await reader.readexactly(chunk_size)
+                await reader.readline()
+        elif 'content-length' in header_dict:
+            content = await reader.readexactly(
+                    int(header_dict['content-length']))
+        elif method == 'HEAD' or status_code in (204, 304):
+            content = b''
+        else:
+            # body delimited by connection close
+            content = await reader.read()
+            keep_alive = False
+
+        return AsyncResponse(status_code, content), keep_alive
+
+
+def http_request(method, url, json_data, url_timeout):
+    # Issue GET or POST via the async transport if enabled
+    # or else the pooled session for the device.
+    # URLs not belonging to devices use a once-off request
+    # For devices, the given timeout acts as a cap on the 
+    # adaptive timeout derived from device latency
+    url_base = get_url_base(url)
+    url_name = gv_url_name_dict.get(url_base)
+    if url_name:
+        url_timeout = min(url_timeout, get_device_timeout(url_name, method))
+
+    if gv_async_transport:
+        return gv_async_transport.http_request(
+                method, 
+                url, 
+                json_data, 
+                url_timeout)
+
+    session = get_device_session(url_base)
+    if not session:
+        return requests.request(
+                method, 
+                url,
+                json = json_data,
+                timeout = url_timeout)
+
+    try:
+        start_time = time.time()
+        response = session.request(
+                method, 
+                url,
+                json = json_data,
+                timeout = url_timeout)
+        track_device_latency(url_name, method, time.time() - start_time)
+    finally:
+        # connection pool counters give us 
+        # the connection reuse 
+        pool_dict = session.get_adapter(url_base).poolmanager.pools
+        num_requests = 0
+        num_connections = 0
+        for pool_key in pool_dict.keys():
+            pool = pool_dict[pool_key]
+            num_requests += pool.num_requests
+            num_connections += pool.num_connections
+        track_http_stats(url_name, num_requests, num_connections)
+
+    return response
+
+
+def get_url(url, url_timeout, parse_json):
+    # General purpose URL GETer
+    # return contents of page and parsed as json
+    # if the parse_json arg is 1
+
+    # Try to determine the URL name
+    url_name = gv_url_name_dict.get(get_url_base(url), "Unknown")
+
+    response = None
+    try:
+        response = http_request('GET', url, None, url_timeout)
+    except:
+        log_message(
+                1,
+                "Error in GET Name:%s URL:%s" % (
+            url_name, 
+            url
+            )
+                )
+
+    return get_url_response(url_name, url, response, parse_json)
+
+
+async def async_get_url(url, url_timeout, parse_json):
+    # get_url() for coroutines gathered on 
+    # the async transport event loop
+    url_base = get_url_base(url)
+    url_name = gv_url_name_dict.get(url_base, "Unknown")
+    if url_base in gv_url_name_dict:
+        url_timeout = min(url_timeout, get_device_timeout(url_name))
+
+    response = None
+    try:
+        response = await gv_async_transport.request(
+                'GET', 
+                url, 
+                None, 
+                url_timeout)
+    except Exception:
+        log_message(
+                1,
+                "Error in GET Name:%s URL:%s" % (
+            url_name, 
+            url
+            )
+                )
+
+    return get_url_response(url_name, url, response, parse_json)
+
+
+def get_url_response(url_name, url, response, parse_json):
+    # Contents of GET response 
+    # and parsed as json if the parse_json arg is 1
+    response_str = None
+    if response:
+        response_str = response.text
+
+        if parse_json:
+            try:
+                json_data = response.json()
+            except:
+                log_message(
+                        1,
+                        "Error in JSON parse.. Name:%s URL:%s Data:%s" % (
+                            url_name, 
+                            url, 
+                            response_str
+                            )
+                        )
+                return None
+            return json_data
+
+    return response_str
+     
+
+def post_url(url, json_data, url_timeout):
+    # General purpose URL POSTer
+    # for JSON payloads
+    # return contents parsed as json
+
+    log_message(
+            1,
+            "POST %s \n%s\n" % (url, json_data))
+
+    response = None
+    try:
+        response = http_request('POST', url, json_data, url_timeout)
+    except:
+        log_message(
+                1,
+                "Error in POST URL:%s" % (url))
+
+    if response:
+        try:
+            json_data = response.json()
+        except:
+            log_message(
+                    1,
+                    "Error in JSON parse.. URL:%s Data:%s" % (
+                        url, 
+                        response.text
+                        )
+                    )
+            return None
+
+        return json_data
+
+    return response
+
+
+def get_device_queue_stats(device_name):
+    # Queue counters held in the device record
+    # and shown in /data. Called with the queue 
+    # lock held. Returns None for unknown devices
+    if not device_name in gv_device_dict:
+        return None
+
+    device = gv_device_dict[device_name]
+    if not 'queue' in device:
+        device['queue'] = {}
+        device['queue']['depth'] = 0
+        device['queue']['delivered'] = 0
+        device['queue']['superseded'] = 0
+        device['queue']['failed'] = 0
+        device['queue']['retries'] = 0
+
+    return device['queue']
+
+
+def finish_delivery(delivery, state, response = None):
+    # Complete a delivery as delivered, superseded 
+    # or failed. Called with the queue lock held
+    delivery['state'] = state
+    delivery['response'] = response
+    delivery['finished'] = time.time()
+
+    stats = get_device_queue_stats(delivery['device'])
+    if stats is not None:
+        stats['depth'] = max(0, stats['depth'] - 1)
+        stats[state] += 1
+
+    if state != 'delivered':
+        log_message(
+                1,
+                "Delivery %d to %s %s %s (%s attempts:%d)" % (
+                    delivery['id'],
+                    delivery['device'],
+                    delivery['key'],
+                    state,
+                    delivery['source'],
+                    delivery['attempts']
+                    )
+                )
+
+    delivery['done'].set()
+    if delivery['callback'] is not None:
+        gv_device_queue_executor.submit(delivery['callback'], delivery)
+
+    return
+
+
+def queue_device_request(
+        device_name, 
+        kind, 
+        key, 
+        data, 
+        source,
+        deadline_secs = None,
+        callback = None):
+    # Queue a write to a device
+    #   kind 'control': data is control data for /control
+    #                   and key the control name
+    #   kind 'command': key is the URL path and data the 
+    #                   JSON to POST (None for a GET)
+    # Control entries queued together are sent as a 
+    # single /control request. Queuing a request with
+    # the same key as one not yet sent supersedes it.
+    # The optional callback is called with the delivery
+    # when it completes.
+    # Returns the delivery record which has a 'done' 
+    # event and a 'state' of queued, in-flight, delivered,
+    # superseded or failed
+    global gv_device_queue_executor
+    global gv_delivery_id
+
+    if deadline_secs is None:
+        deadline_secs = get_config_value('http', 'queue_deadline', 20)
+
+    with gv_device_queue_lock:
+        if gv_device_queue_executor is None:
+            gv_device_queue_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers = get_config_value('http', 'queue_workers', 20))
+
+        gv_delivery_id += 1
+        delivery = {}
+        delivery['id'] = gv_delivery_id
+        delivery['device'] = device_name
+        delivery['url'] = gv_device_dict.get(device_name, {}).get('url')
+        delivery['kind'] = kind
+        delivery['key'] = key
+        delivery['data'] = data
+        delivery['source'] = source
+        delivery['state'] = 'queued'
+        delivery['attempts'] = 0
+        delivery['created'] = time.time()
+        delivery['deadline'] = delivery['created'] + deadline_secs
+        delivery['finished'] = None
+        delivery['response'] = None
+        delivery['done'] = threading.Event()
+        delivery['callback'] = callback
+
+        if delivery['url'] is None:
+            finish_delivery(delivery, 'failed')
+            return delivery
+
+        if not device_name in gv_device_queue_dict:
+            device_queue = {}
+            device_queue['pending'] = collections.OrderedDict()
+            device_queue['active'] = False
+            gv_device_queue_dict[device_name] = device_queue
+
+        device_queue = gv_device_queue_dict[device_name]
+        stats = get_device_queue_stats(device_name)
+        stats['depth'] += 1
+
+        if key in device_queue['pending']:
+            finish_delivery(device_queue['pending'][key], 'superseded')
+        device_queue['pending'][key] = delivery
+
+        # start the device worker if idle
+        if not device_queue['active']:
+            device_queue['active'] = True
+            gv_device_queue_executor.submit(
+                    drain_device_queue,
+                    device_name)
+
+    return delivery
+
+
+def queue_device_control(device_name, control_data, source, **kwargs):
+    # Queue a control change for a device
+    return queue_device_request(
+            device_name,
+            'control',
+            control_data['name'],
+            control_data,
+            source,
+            **kwargs)
+
+
+def queue_device_command(device_name, path, json_data, source, **kwargs):
+    # Queue a command URL for a device
+    return queue_device_request(
+            device_name,
+            'command',
+            path,
+            json_data,
+            source,
+            **kwargs)
+
+
+def wait_delivery(delivery):
+    # Wait for delivery to complete 
+    # and return its final state
+    delivery['done'].wait(max(0, delivery['deadline'] - time.time()) + 1)
+    return delivery['state']
+
+
+def drain_device_queue(device_name):
+    # Device queue worker
+    # Sends queued requests in order, one at a time.
+    # Consecutive control entries are sent together
+    # as one /control request while commands are sent
+    # on their own. Failed requests go back to the 
+    # front of the queue and are retried after a 
+    # doubling backoff unless superseded or past their 
+    # deadline
+    initial_backoff = get_config_value('http', 'queue_retry_backoff', 0.5)
+    max_backoff = get_config_value('http', 'queue_max_backoff', 8)
+    backoff = initial_backoff
+
+    while (1):
+        with gv_device_queue_lock:
+            device_queue = gv_device_queue_dict[device_name]
+            if len(device_queue['pending']) == 0:
+                device_queue['active'] = False
+                del gv_device_queue_dict[device_name]
+                return
+
+            batch_list = []
+            for key, delivery in device_queue['pending'].items():
+                if delivery['kind'] == 'command':
+                    if len(batch_list) == 0:
+                        batch_list.append(delivery)
+                    break
+                batch_list.append(delivery)
+
+            for delivery in batch_list:
+                del device_queue['pending'][delivery['key']]
+                delivery['state'] = 'in-flight'
+                delivery['attempts'] += 1
+
+        # current device URL if still known
+        url = gv_device_dict.get(device_name, {}).get('url', batch_list[0]['url'])
+
+        try:
+            if batch_list[0]['kind'] == 'command':
+                delivery = batch_list[0]
+                if delivery['data'] is None:
+                    response = get_url(url + delivery['key'], gv_http_timeout_secs, 0)
+                else:
+                    response = post_url(url + delivery['key'], delivery['data'], gv_http_timeout_secs)
+                success = response is not None
+
+            else:
+                json_req = {}
+                json_req['controls'] = [delivery['data'] for delivery in batch_list]
+                response = post_url(url + '/control', 
+                                    json_req,
+                                    gv_http_timeout_secs)
+                success = bool(response)
+                if success:
+                    track_device_status(device_name, url, response)
+
+        except Exception as ex:
+            log_message(
+                    1,
+                    "Error sending to %s: %s" % (device_name, ex))
+            response = None
+            success = False
+
+        now = time.time()
+        retry = False
+        with gv_device_queue_lock:
+            for delivery in reversed(batch_list):
+                if success:
+                    finish_delivery(delivery, 'delivered', response)
+                elif delivery['key'] in device_queue['pending']:
+                    finish_delivery(delivery, 'superseded')
+                elif now + backoff >= delivery['deadline']:
+                    finish_delivery(delivery, 'failed')
+                else:
+                    delivery['state'] = 'queued'
+                    device_queue['pending'][delivery['key']] = delivery
+                    device_queue['pending'].move_to_end(delivery['key'], last = False)
+                    stats = get_device_queue_stats(device_name)
+                    if stats is not None:
+                        stats['retries'] += 1
+                    retry = True
+
+        if not success:
+            mark_device_changed(device_name)
+
+        if retry:
+            time.sleep(backoff)
+            backoff = min(backoff * 2, max_backoff)
+        else:
+            backoff = initial_backoff
+
+
+def get_control_state(zone_name, control_name):
+    global gv_device_dict
+    # Get state of specified control
+    # return 0 or 1 or -1 (not found)
+
+    state = -1
+
+    for device_name, control in get_zone_controls(zone_name, control_name):
+        if control['type'] == 'switch':
+            state = int(control['state'])
+
+    return state
+
+
+def check_automated_devices():
+    # Check b-side of each paired switch
+    for zone_name, control_name in list(gv_paired_switch_index.keys()):
+        for device_name, control in get_zone_controls(zone_name, control_name):
+
+            if (control['type'] != 'switch' or 
+                    not device_name in gv_device_dict):
+                continue
+
+            control_data, event_time = check_control(
+                    device_name,
+                    zone_name, 
+                    control_name)
+ 
+            if (control_data):
+                log_message(
+                        1,
+                        "Automatically setting %s/%s to %s" % (
+                            zone_name,
+                            control_name,
+                            control_data
+                            )
+                        )
+
+                # Queue the change.. repeats are
+                # coalesced while it is pending
+                queue_device_control(device_name, control_data, 'paired')
+
+    return
+
+
+def propagate_paired_switch(paired_b_key, propagation):
+    # Set the b-side devices of a paired switch
+    # to the a-side state and record the end-to-end
+    # latency from a-side change to b-side update
+    b_zone, b_control = paired_b_key
+    updated_devices = 0
+    delivery_list = []
+
+    for device_name, control in get_zone_controls(b_zone, b_control):
+        if (control['type'] != 'switch' or 
+                not device_name in gv_device_dict or
+                int(control['state']) == propagation['state']):
+            continue
+
+        control_data = {}
+        control_data['name'] = b_control
+        control_data['state'] = propagation['state']
+        delivery_list.append(
+                queue_device_control(
+                    device_name, 
+                    control_data, 
+                    'paired',
+                    deadline_secs = gv_http_timeout_secs))
+
+    for delivery in delivery_list:
+        if wait_delivery(delivery) == 'delivered':
+            updated_devices += 1
+
+    if updated_devices > 0:
+        latency = time.time() - propagation['detected_time']
+        with gv_paired_switch_lock:
+            stats = gv_paired_switch_stats
+            stats['avg_latency'] = round(
+                    ((stats['avg_latency'] * stats['propagations']) + latency) / 
+                    (stats['propagations'] + 1), 
+                    3)
+            stats['propagations'] += 1
+            stats['last_latency'] = round(latency, 3)
+            stats['max_latency'] = max(stats['max_latency'], round(latency, 3))
+        mark_data_changed()
+
+        log_message(
+                1,
+                "Paired switch %s/%s -> %s/%s state:%d (%d devices) latency:%.3f secs" % (
+                    propagation['a_key'] + 
+                    paired_b_key + 
+                    (propagation['state'], updated_devices, latency)
+                    )
+                )
+
+    return updated_devices
+
+
+def paired_switch_agent():
+    # Propagates a-side paired switch changes to their
+    # b-sides as they are detected. Waits a short coalesce
+    # window after being woken so that bursts of updates 
+    # result in a single update per b-side
+    paired_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers = 5)
+
+    while (1):
+        gv_paired_switch_wakeup.wait()
+        time.sleep(gv_json_config.get('paired_switch_coalesce_secs', 0.2))
+        gv_paired_switch_wakeup.clear()
+
+        with gv_paired_switch_lock:
+            pending_dict = dict(gv_paired_switch_pending_dict)
+            gv_paired_switch_pending_dict.clear()
+
+        task_dict = {}
+        for paired_b_key in pending_dict:
+            task_dict[paired_b_key] = (
+                    propagate_paired_switch, 
+                    (paired_b_key, pending_dict[paired_b_key]))
+
+        run_concurrent_tasks(
+                paired_executor,
+                task_dict,
+                gv_http_timeout_secs)
+
+    return
+
+
+def get_next_fire_time(event_time, now):
+    # Epoch time of the next occurrence of a HHMM 
+    # local event time. Today's occurrence is still 
+    # returned if within the fire window
+    local_time = time.localtime(now)
+    day_offset = 0
+    while True:
+        fire_time = time.mktime(
+                (
+                    local_time.tm_year,
+                    local_time.tm_mon,
+                    local_time.tm_mday + day_offset,
+                    int(event_time / 100),
+                    event_time % 100,
+                    0, 0, 0, -1
+                    )
+                )
+        if fire_time + gv_timer_fire_window > now:
+            return fire_time
+        day_offset += 1
+
+
+def push_timer(due_time, fire_time, index_version, program_key, compiled_event):
+    # Add timer entry to heap, waking the timer 
+    # agent if it is now the earliest
+    global gv_timer_sequence
+
+    with gv_timer_lock:
+        if index_version != gv_program_index_version:
+            return
+        gv_timer_sequence += 1
+        heapq.heappush(
+                gv_timer_heap, 
+                (
+                    due_time, 
+                    gv_timer_sequence, 
+                    fire_time, 
+                    index_version,
+                    program_key, 
+                    compiled_event
+                    )
+                )
+        if gv_timer_heap[0][1] == gv_timer_sequence:
+            gv_timer_wakeup.set()
+
+    return
+
+
+def build_timer_heap():
+    # Rebuild timer heap with the next fire time
+    # of every compiled program event
+    with gv_timer_lock:
+        gv_timer_heap.clear()
+        index_version = gv_program_index_version
+
+    now = time.time()
+    for program_key in list(gv_program_index.keys()):
+        for compiled_event in gv_program_index[program_key]:
+            fire_time = get_next_fire_time(compiled_event['event_time'], now)
+            push_timer(
+                    fire_time, 
+                    fire_time, 
+                    index_version, 
+                    program_key, 
+                    compiled_event)
+
+    log_message(
+            1,
+            "Timer engine scheduled %d program events" % (
+                len(gv_timer_heap)
+                )
+            )
+
+    return index_version
+
+
+def dispatch_program_event(
+        fire_time, 
+        index_version,
+        program_key, 
+        compiled_event):
+    # Apply program event to all devices with the 
+    # zone/control. Devices already programmed for this
+    # event within the fire window are skipped. 
+    # Changes are queued for delivery with the rest of 
+    # the fire window as the deadline and the program 
+    # is registered against the device once delivered.
+    # If no devices are found, the event is retried 
+    # until the fire window has elapsed. The next 
+    # day's occurrence is then scheduled
+    zone_name, control_name = program_key
+    event_time = compiled_event['event_time']
+    matched_devices = 0
+    now = time.time()
+
+    def program_delivered(delivery):
+        # a superseded program change lost to a 
+        # newer change is treated as handled
+        # devices purged since dispatch are skipped
+        if (delivery['state'] in ('delivered', 'superseded') and
+                delivery['device'] in gv_device_dict):
+            track_control_program(
+                    delivery['device'], 
+                    control_name, 
+                    event_time)
+
+    for device_name, control in get_zone_controls(zone_name, control_name):
+        if not device_name in gv_device_dict:
+            continue
+
+        device = gv_device_dict[device_name]
+        if not control['type'] in ['switch', 'rgb', 'argb']:
+            continue
+
+        matched_devices += 1
+        last_program_epoch = device['program_reg'].get(
+                control_name, {}).get(event_time, 0)
+        if now - last_program_epoch <= gv_timer_fire_window:
+            continue
+
+        control_data = copy.deepcopy(compiled_event['control_data'])
+        control_data['name'] = control_name
+        log_message(
+                1,
+                "Timer event %04d (%s) setting %s/%s/%s to %s" % (
+                    event_time,
+                    compiled_event['time_str'],
+                    device_name,
+                    zone_name,
+                    control_name,
+                    control_data
+                    )
+                )
+
+        queue_device_control(
+                device_name, 
+                control_data, 
+                'timer',
+                deadline_secs = max(
+                    gv_timer_retry_secs, 
+                    fire_time + gv_timer_fire_window - now),
+                callback = program_delivered)
+
+    now = time.time()
+    if (matched_devices == 0 and 
+            now + gv_timer_retry_secs < fire_time + gv_timer_fire_window):
+        push_timer(
+                now + gv_timer_retry_secs, 
+                fire_time, 
+                index_version, 
+                program_key, 
+                compiled_event)
+    else:
+        next_fire_time = get_next_fire_time(
+                event_time, 
+                fire_time + gv_timer_fire_window)
+        push_timer(
+                next_fire_time, 
+                next_fire_time, 
+                index_version, 
+                program_key, 
+                compiled_event)
+
+    return
+
+
+def timer_agent():
+    # Fires compiled device program events at their
+    # scheduled time independent of device probing.
+    # Sleeps until the earliest event on the timer heap
+    # and dispatches due events to a worker pool
+    timer_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers = 5)
+    index_version = -1
+
+    while (1):
+        gv_timer_wakeup.clear()
+
+        # rebuild on program changes
+        if index_version != gv_program_index_version:
+            index_version = build_timer_heap()
+
+        now = time.time()
+        due_list = []
+        with gv_timer_lock:
+            while (len(gv_timer_heap) > 0 and 
+                    gv_timer_heap[0][0] <= now):
+                due_list.append(heapq.heappop(gv_timer_heap))
+
+            sleep_time = None
+            if len(gv_timer_heap) > 0:
+                sleep_time = gv_timer_heap[0][0] - now
+
+        for (due_time, 
+                sequence, 
+                fire_time, 
+                entry_version,
+                program_key, 
+                compiled_event) in due_list:
+            if entry_version != index_version:
+                continue
+            log_message(
+                    1,
+                    "Timer firing %s/%s event %s (latency %.3f secs)" % (
+                        program_key + (
+                            compiled_event['time_str'], 
+                            now - due_time)
+                        )
+                    )
+            timer_executor.submit(
+                    dispatch_program_event,
+                    fire_time, 
+                    entry_version,
+                    program_key, 
+                    compiled_event)
+
+        if sleep_time is None or sleep_time > 0:
+            gv_timer_wakeup.wait(sleep_time)
+
+    return
+
+
+def configure_device(url, device_name):
+
+    log_message(
+            1,
+            "Configure device %s" % (device_name))
+    if (device_name in gv_json_config['devices']): 
+        # matched to stored profile
+        log_message(
+                1,
+                "Matched device %s to stored profile.. configuring" % (device_name
+                                                                       )
+                )
+        # Extract JSON config for device and profile
+        # This is based on taking the profile as the baseline
+        # and updating as defined by the device dict
+        # Pythons deepcopy and update dict calls play a stormer
+        # here for us
+        profile_name = gv_json_config['devices'][device_name]['profile']
+        config_dict = copy.deepcopy(gv_json_config['device_profiles'][profile_name])
+        device_specific_dict = copy.deepcopy(gv_json_config['devices'][device_name])
+
+        # Indicate the origin profile
+        config_dict['profile'] = profile_name
+
+        # Copy over all top-level fields except controls
+        for key in device_specific_dict:
+            if (key != "controls"):
+                config_dict[key] = device_specific_dict[key]
+
+        # Scan through device specific controls
+        # and update defaults taken from profile
+        # Given this is a list, we can't do any kind 
+        # of update as one list will clobber the other.
+        # So for each control in the device specific list
+        # we determine its custom name and then locate it 
+        # in the main config and update the contents
+        # That lets the device config over-ride any or all 
+        # of the attributes in the original profile.
+        # The only special treatment is the custom_name
+        # which lets us rename the control to a desired
+        # alternative but we have to match on the original control
+        # name to start
+        for control in device_specific_dict['controls']:
+            control_name = control['name']
+
+            # Custom name is optional but we just 
+            # default to existing name if not present
+            # also remove that custom_name field
+            # from dict as it will not be sent to the device
+            if 'custom_name' in control:
+                custom_name = control['custom_name']
+                del control['custom_name']
+            else:
+                custom_name = control_name
+
+            # Iterate the device profile controls
+            # match on name, update with the device specific
+            # values and custom name
+            for config_control in config_dict['controls']:
+                if config_control['name'] == control_name:
+                    config_control.update(control)
+                    config_control['name'] = custom_name
+
+
+        # Format config dict to JSON
+        device_config = json.dumps(
+                config_dict, 
+                indent=4, 
+                sort_keys=True)
+        log_message(
+                1,
+                "Sending config (%d bytes):\n%s\n" % (
+                    len(device_config),
+                    device_config
+                    )
+                )
+
+        # POST to /configure function of URL
+        queue_device_command(
+                device_name,
+                '/configure', 
+                config_dict, 
+                'configure')
+
+    else:
+        log_message(
+                1,
+                "ERROR %s not found in device config" % (device_name))
+
+    return
+
+
+def timed_task(fn, args):
+    # Wrapper for tasks run on a worker pool
+    # returns the task result along with its
+    # latency in seconds
+    start_time = time.time()
+    result = fn(*args)
+    return result, time.time() - start_time
+
+
+def run_concurrent_tasks(
+        executor,
+        task_dict,
+        deadline_secs):
+    # Runs a dict of tasks on the given executor
+    # task_dict is keyed on task name (usually a device name)
+    # with each value being a (fn, args) tuple.
+    # Waits up to deadline_secs for the tasks to complete
+    # and returns a dict keyed on task name with the result,
+    # latency and any error for each task.
+    # Tasks still running at the deadline are reported with an 
+    # error and left to complete in the background
+    future_dict = {}
+    for task_name in task_dict:
+        fn, args = task_dict[task_name]
+        future = executor.submit(timed_task, fn, args)
+        future_dict[future] = task_name
+
+    done_set, not_done_set = concurrent.futures.wait(
+            future_dict, 
+            timeout = deadline_secs)
+
+    result_dict = {}
+    for future in future_dict:
+        task_name = future_dict[future]
+        task_result = {}
+        task_result['result'] = None
+        task_result['latency'] = None
+        task_result['error'] = None
+
+        if future in not_done_set:
+            task_result['error'] = 'deadline exceeded'
+        elif future.exception():
+            task_result['error'] = str(future.exception())
+        else:
+            task_result['result'], task_result['latency'] = future.result()
+
+        result_dict[task_name] = task_result
+
+    return result_dict
+
+
+def probe_device(device_name, url_timeout, due_time = None, probe_fetch = None):
+    # Probe status of a single device and schedule
+    # its next probe. The device is rescheduled 
+    # even if the probe raises an exception so it
+    # is never dropped from the probe schedule
+    # due_time is the end of the batch window the 
+    # probe was taken in. Anything falling due by then
+    # is treated as due now and the next probe is always
+    # scheduled after it
+    # probe_fetch is the status already fetched for the
+    # device by fetch_device_probes() if any
+    # returns 'successful', 'configuring', 'failed', 
+    # 'skipped', 'purged' or 'error'
+    if due_time is None:
+        due_time = time.time()
+
+    result = 'error'
+    try:
+        result = probe_device_status(
+                device_name, 
+                url_timeout, 
+                due_time, 
+                probe_fetch)
+    except Exception:
+        log_message(
+                1,
+                'Error probing %s:\n%s' % (
+                    device_name,
+                    traceback.format_exc()
+                    )
+                )
+    finally:
+        if result != 'purged':
+            schedule_next_probe(device_name, due_time)
+
+    return result
+
+
+def schedule_next_probe(device_name, due_time):
+    # Schedule next probe of device after its
+    # probe interval or at its breaker retry time
+    # if the breaker is open. The breaker retry is
+    # capped at the device purge time so that the 
+    # breaker backoff does not delay purging
+    # The probe is never scheduled at or before the
+    # due time of the batch it was taken in so it 
+    # can't be taken again by the next batch
+    device = gv_device_dict.get(device_name)
+    if device is None:
+        return
+
+    breaker = device.get('breaker', {})
+    if breaker.get('state') == 'open':
+        purge_time = device['last_updated'] + get_config_value(
+                'discovery', 
+                'device_purge_timeout', 
+                120)
+        next_time = min(breaker['retry_time'], purge_time)
+    else:
+        next_time = time.time() + get_probe_delay(device_name)
+
+    schedule_probe(
+            device_name, 
+            max(next_time, due_time + gv_probe_min_gap) - time.time())
+
+    return
+
+
+def get_probe_timeout(device_name, url_timeout, due_time):
+    # Timeout to probe device with or None if the 
+    # probe is to be skipped.
+    # Devices with an open circuit breaker are 
+    # skipped until their retry time and then 
+    # given a single half-open probe with a 
+    # shorter timeout. Breaker retry is compared 
+    # to the due time of the probe batch.
+    # Devices whose service was removed are 
+    # probed regardless
+    device = gv_device_dict[device_name]
+    breaker = get_breaker(device)
+
+    if (breaker['state'] == 'open' and 
+            due_time < breaker['retry_time'] and
+            not 'removed' in device):
+        return None
+
+    if breaker['state'] == 'open':
+        breaker['state'] = 'half-open'
+        url_timeout = min(
+                url_timeout, 
+                get_config_value('discovery', 'breaker_probe_timeout', 2))
+
+    return url_timeout
+
+
+def fetch_device_probes(device_name_list, url_timeout, due_time, deadline_secs):
+    # Fetch status of a batch of devices on the 
+    # async transport. The GETs are gathered on the event
+    # loop rather than holding a worker thread each
+    # returns a dict keyed on device name with the probe 
+    # timeout (None if skipped) and fetched json data
+    fetch_dict = {}
+    fetch_name_list = []
+    coroutine_list = []
+    for device_name in device_name_list:
+        if not device_name in gv_device_dict:
+            continue
+
+        probe_fetch = {}
+        probe_fetch['timeout'] = get_probe_timeout(
+                device_name, 
+                url_timeout, 
+                due_time)
+        probe_fetch['json_data'] = None
+        fetch_dict[device_name] = probe_fetch
+
+        if probe_fetch['timeout'] is not None:
+            fetch_name_list.append(device_name)
+            coroutine_list.append(
+                    async_get_url(
+                        gv_device_dict[device_name]['url'], 
+                        probe_fetch['timeout'], 
+                        1))
+
+    if len(coroutine_list) > 0:
+        future = gv_async_transport.gather(coroutine_list, deadline_secs)
+        try:
+            json_data_list = future.result()
+        except Exception:
+            log_message(
+                    1,
+                    "Probe fetch of %d devices failed (%s)" % (
+                        len(coroutine_list),
+                        traceback.format_exc()
+                        )
+                    )
+            json_data_list = [None] * len(coroutine_list)
+
+        for device_name, json_data in zip(fetch_name_list, json_data_list):
+            fetch_dict[device_name]['json_data'] = json_data
+
+    return fetch_dict
+
+
+def probe_device_status(device_name, url_timeout, due_time, probe_fetch = None):
+    # Probe status of a single device 
+    # and track the result. Devices not heard 
+    # from within the purge timeout are purged.
+    # Purge times are compared to the due time 
+    # of the probe batch.
+    # Devices whose service was removed are 
+    # purged if their probe fails
+    # The status is fetched here unless already
+    # fetched by fetch_device_probes()
+    # returns 'successful', 'configuring', 'failed', 
+    # 'skipped' or 'purged'
+    global gv_device_dict
+
+    if not device_name in gv_device_dict:
+        return 'purged'
+
+    device = gv_device_dict[device_name]
+    url = device['url']
+    result = 'failed'
+
+    if probe_fetch is None:
+        probe_fetch = {}
+        probe_fetch['timeout'] = get_probe_timeout(
+                device_name, 
+                url_timeout, 
+                due_time)
+        probe_fetch['json_data'] = None
+        if probe_fetch['timeout'] is not None:
+            probe_fetch['json_data'] = get_url(url, probe_fetch['timeout'], 1)
+
+    json_data = probe_fetch['json_data']
+    if probe_fetch['timeout'] is None:
+        result = 'skipped'
+    elif (json_data and 
+            'name' in json_data and
+            json_data.get('configured') == 0):
+        # device answered but is waiting on its 
+        # config.. neither a success nor a failure
+        # for the breaker
+        result = 'configuring'
+    else:
+        track_breaker_result(
+                device_name, 
+                json_data and 'name' in json_data)
+
+    if result == 'skipped':
+        pass
+    elif result == 'configuring':
+        # Configure device
+        configure_device(url, json_data['name'])
+    elif (json_data and 'name' in json_data):
+        # Track what we got back
+        event_list = track_device_status(json_data['name'], url, json_data)
+        result = 'successful'
+
+        # Adapt probe interval based on 
+        # status change since last probe
+        update_probe_interval(
+                device_name, 
+                any(is_activity_event(event) for event in event_list))
+
+    else:
+        device['failed_probes'] += 1
+        device['last_failed_probe'] = time.time()
+        mark_device_changed(device_name)
+        log_message(
+                1,
+                'Failed to probe: %s .. response:%s' % (
+                    url,
+                    json_data
+                    )
+                )
+
+    # Purge devices whose service was removed
+    # and no longer respond
+    if (result == 'failed' and 
+            'removed' in device):
+        reason = "service removed.. device %s (%s) not responding" % (
+                device_name, 
+                url)
+        purge_device(device_name, reason)
+        return 'purged'
+
+    if result == 'successful':
+        device.pop('removed', None)
+
+    # Purge dead devices
+    last_updated = int(due_time) - device['last_updated']
+    if last_updated >= get_config_value('discovery', 'device_purge_timeout', 120):
+        reason = "expired.. device %s (%s) last updated %d seconds ago" % (
+                device_name, 
+                url,
+                last_updated)
+        purge_device(device_name, reason)
+        return 'purged'
+
+    return result
+
+
+def probe_agent():
+    # Probes discovered devices as they fall due
+    # on the probe schedule heap, storing their status.
+    # Due probes are batched and fanned out across 
+    # a pool of workers with each batch bounded by a deadline
+    global gv_json_config
+    global gv_device_dict
+    global gv_probe_executor
+    global gv_probe_workers
+
+    next_housekeeping_time = 0
+
+    # loop forever
+    while (1):
+        # (re)create the worker pool if the 
+        # configured size has changed
+        probe_workers = get_config_value('discovery', 'probe_workers', 20)
+        if probe_workers != gv_probe_workers:
+            if gv_probe_executor:
+                gv_probe_executor.shutdown(wait = False)
+            log_message(
+                    1,
+                    "Starting probe engine with %d workers" % (
+                        probe_workers
+                        )
+                    )
+            gv_probe_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers = probe_workers)
+            gv_probe_workers = probe_workers
+
+        # Per-cycle deadline also caps the timeout of each 
+        # probe so no single device can hold up the cycle
+        probe_deadline = get_config_value('discovery', 'probe_deadline', 10)
+        url_timeout = min(gv_http_timeout_secs, probe_deadline)
+        probe_start = time.time()
+
+        # Take all probes due now and those falling due 
+        # within the batch window
+        batch_window = get_config_value('discovery', 'probe_batch_window', 1)
+        gv_probe_wakeup.clear()
+        due_list, next_due_time = get_due_probes(probe_start + batch_window)
+
+        # With the async transport the status GETs 
+        # are gathered on its event loop and only the
+        # processing of results uses the worker pool
+        fetch_dict = {}
+        if gv_async_transport:
+            fetch_dict = fetch_device_probes(
+                    due_list, 
+                    url_timeout, 
+                    probe_start + batch_window,
+                    probe_deadline)
+
+        task_dict = {}
+        for device_name in due_list:
+            task_dict[device_name] = (
+                    probe_device, 
+                    (
+                        device_name, 
+                        url_timeout, 
+                        probe_start + batch_window,
+                        fetch_dict.get(device_name)
+                        )
+                    )
+
+        result_dict = run_concurrent_tasks(
+                gv_probe_executor,
+                task_dict,
+                probe_deadline)
+
+        successful_probes = 0
+        configuring_probes = 0
+        failed_probes = 0
+        skipped_probes = 0
+        purged_devices = 0
+        for device_name in result_dict:
+            result = result_dict[device_name]['result']
+            if result == 'successful':
+                successful_probes += 1
+            elif result == 'configuring':
+                configuring_probes += 1
+            elif result == 'skipped':
+                skipped_probes += 1
+            elif result == 'purged':
+                purged_devices += 1
+            else:
+                failed_probes += 1
+
+        probe_time = time.time() - probe_start
+
+        if len(result_dict) > 0:
+            log_message(
+                    1,
+                    "Probe.. successful:%d configuring:%d failed:%d skipped:%d purged:%d time:%.3f secs" % (
+                        successful_probes,
+                        configuring_probes,
+                        failed_probes,
+                        skipped_probes,
+                        purged_devices,
+                        probe_time
+                        )
+                    )
+
+        # Automated devices
+        now = time.time()
+        if now >= next_housekeeping_time:
+            check_automated_devices()
+            next_housekeeping_time = now + gv_probe_housekeeping_secs
+
+        # Sleep until the next probe is due
+        # capped by the housekeeping interval
+        # New schedule entries will wake us early
+        sleep_time = next_housekeeping_time - time.time()
+        if next_due_time is not None:
+            sleep_time = min(sleep_time, next_due_time - time.time())
+        if sleep_time > 0:
+            gv_probe_wakeup.wait(sleep_time)
+
+    return
+
+
+def send_device_controls(device_name, control_list):
+    # Queue a list of control changes to a device
+    # and wait for delivery
+    # returns the device status or None on failure
+    delivery_list = []
+    for control_data in control_list:
+        delivery_list.append(
+                queue_device_control(
+                    device_name, 
+                    control_data, 
+                    'console',
+                    deadline_secs = get_config_value(
+                        'http', 
+                        'command_deadline', 
+                        gv_http_timeout_secs)))
+
+    json_data = None
+    for delivery in delivery_list:
+        state = wait_delivery(delivery)
+        if state == 'failed':
+            return None
+        if state == 'delivered':
+            json_data = delivery['response']
+
+    return json_data
+
+
+def send_device_command(device_name, path):
+    # Queue a device command (reboot, reconfigure, apmode)
+    # and wait for delivery
+    # The response is not tracked other than to 
+    # report success
+    delivery = queue_device_command(
+            device_name, 
+            path, 
+            None, 
+            'console',
+            deadline_secs = get_config_value(
+                'http', 
+                'command_deadline', 
+                gv_http_timeout_secs))
+
+    return wait_delivery(delivery) == 'delivered'
+
+
+def get_command_executor():
+    # Shared executor for console and batch fan-outs
+    # created on first use and sized by http/command_workers
+    global gv_command_executor
+
+    with gv_command_executor_lock:
+        if gv_command_executor is None:
+            gv_command_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers = get_config_value('http', 'command_workers', 10))
+
+    return gv_command_executor
+
+
+def run_device_tasks(task_dict, job = None):
+    # Runs a dict of per-device tasks concurrently 
+    # bounded by the http/command_deadline and returns
+    # a dict of per-device result, latency and error.
+    # Task functions return a true value on success.
+    # If a job is given, each device result is recorded
+    # against it as it completes
+    if job is not None:
+        start_job_progress(job, list(task_dict.keys()))
+        task_dict = {
+                device_name: (job_task, (job, device_name, fn, args)) 
+                for device_name, (fn, args) in task_dict.items()}
+
+    result_dict = run_concurrent_tasks(
+            get_command_executor(),
+            task_dict,
+            get_config_value('http', 'command_deadline', gv_http_timeout_secs))
+
+    device_result_dict = {}
+    for device_name, task_result in result_dict.items():
+        device_result = {}
+        if task_result['error'] is None and task_result['result']:
+            device_result['result'] = 'successful'
+        else:
+            device_result['result'] = 'failed'
+        if task_result['error'] is not None:
+            device_result['error'] = task_result['error']
+        if task_result['latency'] is not None:
+            device_result['latency'] = round(task_result['latency'], 3)
+        device_result_dict[device_name] = device_result
+
+    return device_result_dict
+
+
+def process_console_action(
+        device_name, 
+        zone, 
+        control_name, 
+        reboot, 
+        reconfig, 
+        apmode, 
+        state, 
+        rgb_program,
+        argb_program,
+        rolling = None,
+        job = None):
+    # Console API actions
+    # Device requests are gathered into a dict of tasks
+    # keyed on device name and run concurrently 
+    # returns a dict with per-device results
+    # Progress is recorded against the job if given
+    # Reboots and reconfigures of all devices are done 
+    # as a rolling operation unless disabled by the 
+    # rolling arg or fleet config
+
+    global gv_device_dict
+    global gv_json_config
+
+    # dict of device name to command path used to bulk 
+    # handle simple URL API calls for GET
+    # use cases.. reboot. reconfigure, apmode
+    command_path_dict = {}
+    reboot_all = 0
+
+    # dict of device name to control data list
+    # for control changes
+    device_control_dict = {}
+
+    if (device_name and reboot):
+
+        if device_name == 'all':
+            log_message(
+                    1,
+                    "Rebooting all devices")
+            if is_rolling(rolling):
+                return run_rolling_operation(
+                        'reboot',
+                        list(gv_device_dict.keys()),
+                        job)
+
+            for device_name in gv_device_dict:
+                log_message(
+                        1,
+                        "Rebooting %s" % (device_name))
+
+                command_path_dict[device_name] = '/reboot'
+
+            # devices are purged once the reboots are sent
+            reboot_all = 1
+
+        elif device_name in gv_device_dict:
+            log_message(
+                    1,
+                    "Rebooting %s" % (device_name))
+
+            command_path_dict[device_name] = '/reboot'
+            
+    elif (device_name and reconfig):
+
+        if device_name == 'all':
+            log_message(
+                    1,
+                    "Reconfiguring all devices")
+            if is_rolling(rolling):
+                return run_rolling_operation(
+                        'reconfigure',
+                        list(gv_device_dict.keys()),
+                        job)
+
+            for device_name in gv_device_dict:
+                log_message(
+                        1,
+                        "Reconfiguring %s" % (device_name))
+
+                command_path_dict[device_name] = '/reconfigure'
+
+            # Dont purge devices here as the probe stage will
+            # invoke the reconfigure
+
+        elif device_name in gv_device_dict:
+            log_message(
+                    1,
+                    "Reconfiguring %s" % (device_name))
+
+            command_path_dict[device_name] = '/reconfigure'
+
+            # Dont purge device_name here as the probe stage will
+            # invoke the reconfigure
+
+    elif (device_name and apmode):
+
+        if device_name in gv_device_dict:
+            log_message(
+                    1,
+                    "Rebooting %s into AP Mode" % (device_name))
+
+            command_path_dict[device_name] = '/apmode'
+
+    elif (device_name and zone and control_name and state):
+
+        if device_name in gv_device_dict:
+            log_message(
+                    1,
+                    "Manually setting %s/%s/%s to state:%s" % (
+                        device_name,
+                        zone,
+                        control_name,
+                        state
+                        )
+                    )
+
+            control_data = {}
+            control_data['name'] = control_name
+            control_data['state'] = state
+            device_control_dict[device_name] = [control_data]
+
+    elif (zone and control_name and state):
 
-def get_control_state(zone_name, control_name):
-    global gv_device_dict
-    # Get state of specified control
-    # return 0 or 1 or -1 (not found)
+        # Devices with the zone/control
+        for device_name, control in get_zone_controls(zone, control_name):
+            if not device_name in gv_device_dict:
+                continue
 
-    state = -1
+            url = gv_device_dict[device_name]['url']
 
-    device_list = list(gv_device_dict.keys())
-    for device_name in device_list:
-        device = gv_device_dict[device_name]
+            log_message(
+                    1,
+                    "Manually setting (%s) %s/%s/%s to state:%s" % (
+                        url,
+                        device_name,
+                        zone,
+                        control_name,
+                        state
+                        )
+                    )
 
-        json_data = device['status']
-        device_zone_name = json_data['zone']
+            control_data = {}
+            control_data['name'] = control_name
+            control_data['state'] = state
+            device_control_dict[device_name] = [control_data]
 
-        if (device_zone_name != zone_name):
-            continue
+    elif (device_name and zone and control_name and rgb_program):
 
-        # Control name check 
-        for control in json_data['controls']:
-            device_control_name = control['name']
-            device_control_type = control['type']
+        if device_name in gv_device_dict:
+            log_message(
+                    1,
+                    "Manually setting %s/%s/%s to rgb_program:%s" % (
+                        device_name,
+                        zone,
+                        control_name,
+                        rgb_program
+                        )
+                    )
 
-            if (device_control_type == 'switch' and 
-                    device_control_name == control_name):
-                state = int(control['state'])
+            if ('rgb_programs' in gv_json_config and 
+                    rgb_program in gv_json_config['rgb_programs']):
 
-    return state
+                control_data = {}
+                control_data['name'] = control_name
+                control_data['program'] = gv_json_config['rgb_programs'][rgb_program]
+                device_control_dict[device_name] = [control_data]
 
+            else:
+                log_message(
+                        1,
+                        "program not found")
 
-def check_automated_devices():
-    device_list = list(gv_device_dict.keys())
-    # get time in hhmm format
-    for device_name in device_list:
-        device = gv_device_dict[device_name]
+    elif (zone and control_name and rgb_program):
+        if ('rgb_programs' in gv_json_config and 
+            rgb_program in gv_json_config['rgb_programs']):
 
-        json_data = device['status']
-        zone_name = json_data['zone']
-        url = device['url']
+            # Devices with the zone/control
+            for device_name, control in get_zone_controls(zone, control_name):
+                if not device_name in gv_device_dict:
+                    continue
 
-        # Control status check 
-        for control in json_data['controls']:
-            control_name = control['name']
-            control_type = control['type']
+                url = gv_device_dict[device_name]['url']
 
-            # ignore controls that cannot be programmed
-            if not control_type in ['switch', 'rgb', 'argb']:
-                continue
+                log_message(
+                        1,
+                        "Manually setting (%s) %s/%s/%s to rgb_program:%s" % (
+                            url,
+                            device_name,
+                            zone,
+                            control_name,
+                            rgb_program
+                            )
+                        )
 
-            control_data, event_time = check_control(
-                    device_name,
-                    zone_name, 
-                    control_name)
- 
-            if (control_data):
+                control_data = {}
+                control_data['name'] = control_name
+                control_data['program'] = gv_json_config['rgb_programs'][rgb_program]
+                device_control_dict[device_name] = [control_data]
+
+        else:
+            log_message(
+                    1,
+                    "program not found")
+
+    elif (device_name and zone and control_name and argb_program):
+
+        if device_name in gv_device_dict:
+            log_message(
+                    1,
+                    "Manually setting %s/%s/%s to argb_program:%s" % (
+                        device_name,
+                        zone,
+                        control_name,
+                        argb_program
+                        )
+                    )
+
+            if ('argb_programs' in gv_json_config and 
+                    argb_program in gv_json_config['argb_programs']):
+
+                control_data = {}
+                control_data['name'] = control_name
+                control_data['program'] = gv_json_config['argb_programs'][argb_program]
+                device_control_dict[device_name] = [control_data]
+
+            else:
                 log_message(
                         1,
-                        "Automatically setting %s/%s to %s" % (
-                            zone_name,
+                        "program not found")
+
+    elif (zone and control_name and argb_program):
+        if ('argb_programs' in gv_json_config and 
+            argb_program in gv_json_config['argb_programs']):
+
+            # Devices with the zone/control
+            for device_name, control in get_zone_controls(zone, control_name):
+                if not device_name in gv_device_dict:
+                    continue
+
+                url = gv_device_dict[device_name]['url']
+
+                log_message(
+                        1,
+                        "Manually setting (%s) %s/%s/%s to argb_program:%s" % (
+                            url,
+                            device_name,
+                            zone,
                             control_name,
-                            control_data
+                            argb_program
                             )
                         )
 
-                # Build controls request
-                json_req = {}
-                json_req['controls'] = []
-                json_req['controls'].append(control_data)
-                json_data = post_url(url + '/control', 
-                                     json_req,
-                                     gv_http_timeout_secs)
-                if (json_data):
-                    track_device_status(device_name, url, json_data)
-                    if event_time:
-                        track_control_program(device_name, control_name, event_time)
+                control_data = {}
+                control_data['name'] = control_name
+                control_data['program'] = gv_json_config['argb_programs'][argb_program]
+                device_control_dict[device_name] = [control_data]
+
+        else:
+            log_message(
+                    1,
+                    "program not found")
+
+    task_dict = {}
+    for device_name, control_list in device_control_dict.items():
+        task_dict[device_name] = (
+                send_device_controls, 
+                (device_name, control_list))
+
+    # Bulk stuff
+    for device_name, path in command_path_dict.items():
+        log_message(
+                1,
+                "Issuing command %s:%s" % (
+            device_name,
+            path))
+
+        task_dict[device_name] = (send_device_command, (device_name, path))
+
+    result_dict = {}
+    result_dict['devices'] = run_device_tasks(task_dict, job)
+
+    if reboot_all:
+        purge_all_devices()
+
+    return result_dict
+
 
+def is_rolling(rolling):
+    # rolling API arg with the fleet config as default
+    if rolling is None:
+        return get_config_value('fleet', 'rolling', 1) == 1
+    return str(rolling) == '1'
+
+
+def get_device_uptime_msecs(device_name):
+    # Device uptime from status if reported
+    if not device_name in gv_device_dict:
+        return None
+    return get_uptime_msecs(gv_device_dict[device_name]['status'])
+
+
+def is_device_healthy(device_name, sent_time, sent_uptime_msecs):
+    # Check if a device has come back after a rolling 
+    # reboot or reconfigure sent at sent_time. 
+    # The device must have been probed successfully 
+    # since then and be seen to have rebooted, either
+    # by its uptime being lower than when sent or by 
+    # a failed probe since then followed by a 
+    # successful one. A device answering throughout 
+    # without its uptime resetting has not rebooted
+    if not device_name in gv_device_dict:
+        return False
+
+    device = gv_device_dict[device_name]
+    if (device['last_updated'] < sent_time or
+            get_breaker(device)['state'] != 'closed'):
+        return False
+
+    uptime_msecs = get_device_uptime_msecs(device_name)
+    if (sent_uptime_msecs is not None and
+            uptime_msecs is not None and
+            uptime_msecs < sent_uptime_msecs):
+        return True
+
+    # failed_probes is reset by the next 
+    # successful probe
+    return (device.get('last_failed_probe', 0) >= sent_time and
+            device['failed_probes'] == 0)
+
+
+def update_fleet_operation(**kwargs):
+    # Update rolling operation progress
+    with gv_fleet_lock:
+        gv_fleet_operation.update(kwargs)
+    mark_data_changed()
     return
 
 
-def configure_device(url, device_name):
+def run_rolling_operation(operation, device_name_list, job = None):
+    # Rolling reboot or reconfigure
+    # Devices are processed in waves of fleet/wave_size.
+    # Each wave is sent its command and then probed every 
+    # fleet/wave_probe_interval seconds until all devices 
+    # are healthy again or fleet/wave_timeout expires 
+    # before the next wave starts. With fleet/abort_on_failure
+    # set, devices that fail or do not recover stop the 
+    # operation and the remaining devices are skipped.
+    # returns a dict with the per-device results
+    global gv_fleet_operation
+
+    wave_size = max(1, get_config_value('fleet', 'wave_size', 5))
+    wave_timeout = get_config_value('fleet', 'wave_timeout', 180)
+    wave_probe_interval = get_config_value('fleet', 'wave_probe_interval', 5)
+    abort_on_failure = get_config_value('fleet', 'abort_on_failure', 1)
+    path = '/%s' % (operation)
+
+    result_dict = {}
+    result_dict['devices'] = {}
+
+    with gv_fleet_lock:
+        if (gv_fleet_operation is not None and 
+                gv_fleet_operation['state'] == 'running'):
+            result_dict['error'] = 'rolling %s already running' % (
+                    gv_fleet_operation['operation'])
+            return result_dict
+
+        wave_list = [
+                sorted(device_name_list)[i:i + wave_size] 
+                for i in range(0, len(device_name_list), wave_size)]
+
+        gv_fleet_operation = {}
+        gv_fleet_operation['operation'] = operation
+        gv_fleet_operation['state'] = 'running'
+        gv_fleet_operation['started'] = int(time.time())
+        gv_fleet_operation['finished'] = None
+        gv_fleet_operation['wave'] = 0
+        gv_fleet_operation['waves'] = len(wave_list)
+        gv_fleet_operation['wave_devices'] = []
+        gv_fleet_operation['total'] = len(device_name_list)
+        gv_fleet_operation['healthy'] = 0
+        gv_fleet_operation['failed'] = 0
+    mark_data_changed()
 
     log_message(
             1,
-            "Configure device %s" % (device_name))
-    if (device_name in gv_json_config['devices']): 
-        # matched to stored profile
+            "Rolling %s of %d devices in %d waves" % (
+                operation,
+                len(device_name_list),
+                len(wave_list)
+                )
+            )
+
+    healthy_devices = 0
+    failed_devices = 0
+    state = 'done'
+
+    for wave_index, wave in enumerate(wave_list):
+        update_fleet_operation(
+                wave = wave_index + 1,
+                wave_devices = wave)
+
+        # note uptime before sending so 
+        # we can tell when each has rebooted
+        sent_time = int(time.time())
+        sent_uptime_dict = {
+                device_name: get_device_uptime_msecs(device_name) 
+                for device_name in wave}
+
+        task_dict = {}
+        for device_name in wave:
+            task_dict[device_name] = (send_device_command, (device_name, path))
+        send_result_dict = run_device_tasks(task_dict, job)
+
+        pending_list = []
+        for device_name in wave:
+            device_result = send_result_dict[device_name]
+            result_dict['devices'][device_name] = device_result
+            if device_result['result'] == 'successful':
+                device_result['health'] = 'pending'
+                pending_list.append(device_name)
+            else:
+                device_result['health'] = 'failed'
+
+        # wait for devices to come back
+        # probing them regularly
+        wave_end_time = time.time() + wave_timeout
+        while len(pending_list) > 0 and time.time() < wave_end_time:
+            for device_name in pending_list:
+                schedule_probe(device_name, wave_probe_interval)
+            time.sleep(wave_probe_interval)
+
+            for device_name in list(pending_list):
+                if is_device_healthy(
+                        device_name, 
+                        sent_time, 
+                        sent_uptime_dict[device_name]):
+                    result_dict['devices'][device_name]['health'] = 'healthy'
+                    pending_list.remove(device_name)
+
+        wave_failures = 0
+        for device_name in wave:
+            device_result = result_dict['devices'][device_name]
+            if device_result['health'] == 'healthy':
+                healthy_devices += 1
+            else:
+                if device_result['health'] == 'pending':
+                    device_result['health'] = 'timeout'
+                failed_devices += 1
+                wave_failures += 1
+
+        update_fleet_operation(
+                healthy = healthy_devices,
+                failed = failed_devices)
+
         log_message(
                 1,
-                "Matched device %s to stored profile.. configuring" % (device_name
-                                                                       )
+                "Rolling %s wave %d/%d complete.. healthy:%d failed:%d" % (
+                    operation,
+                    wave_index + 1,
+                    len(wave_list),
+                    len(wave) - wave_failures,
+                    wave_failures
+                    )
                 )
-        # Extract JSON config for device and profile
-        # This is based on taking the profile as the baseline
-        # and updating as defined by the device dict
-        # Pythons deepcopy and update dict calls play a stormer
-        # here for us
-        profile_name = gv_json_config['devices'][device_name]['profile']
-        config_dict = copy.deepcopy(gv_json_config['device_profiles'][profile_name])
-        device_specific_dict = copy.deepcopy(gv_json_config['devices'][device_name])
 
-        # Indicate the origin profile
-        config_dict['profile'] = profile_name
+        if wave_failures > 0 and abort_on_failure:
+            state = 'aborted'
+            for skipped_wave in wave_list[wave_index + 1:]:
+                for device_name in skipped_wave:
+                    result_dict['devices'][device_name] = {
+                            'result': 'skipped',
+                            'health': 'skipped'
+                            }
+            break
+
+    update_fleet_operation(
+            state = state,
+            finished = int(time.time()),
+            wave_devices = [])
 
-        # Copy over all top-level fields except controls
-        for key in device_specific_dict:
-            if (key != "controls"):
-                config_dict[key] = device_specific_dict[key]
+    log_message(
+            1,
+            "Rolling %s %s.. healthy:%d failed:%d" % (
+                operation,
+                state,
+                healthy_devices,
+                failed_devices
+                )
+            )
 
-        # Scan through device specific controls
-        # and update defaults taken from profile
-        # Given this is a list, we can't do any kind 
-        # of update as one list will clobber the other.
-        # So for each control in the device specific list
-        # we determine its custom name and then locate it 
-        # in the main config and update the contents
-        # That lets the device config over-ride any or all 
-        # of the attributes in the original profile.
-        # The only special treatment is the custom_name
-        # which lets us rename the control to a desired
-        # alternative but we have to match on the original control
-        # name to start
-        for control in device_specific_dict['controls']:
-            control_name = control['name']
+    return result_dict
 
-            # Custom name is optional but we just 
-            # default to existing name if not present
-            # also remove that custom_name field
-            # from dict as it will not be sent to the device
-            if 'custom_name' in control:
-                custom_name = control['custom_name']
-                del control['custom_name']
-            else:
-                custom_name = control_name
 
-            # Iterate the device profile controls
-            # match on name, update with the device specific
-            # values and custom name
-            for config_control in config_dict['controls']:
-                if config_control['name'] == control_name:
-                    config_control.update(control)
-                    config_control['name'] = custom_name
+def get_action_control_data(action, control_name):
+    # Control data for a batch action
+    # using state, rgb_program or argb_program.
+    # Returns None for unknown programs or 
+    # actions without any of these
+    control_data = {}
+    control_data['name'] = control_name
 
+    if 'state' in action:
+        control_data['state'] = action['state']
 
-        # Format config dict to JSON
-        device_config = json.dumps(
-                config_dict, 
-                indent=4, 
-                sort_keys=True)
+    elif 'rgb_program' in action:
+        if not action['rgb_program'] in gv_json_config.get('rgb_programs', {}):
+            return None
+        control_data['program'] = gv_json_config['rgb_programs'][action['rgb_program']]
+
+    elif 'argb_program' in action:
+        if not action['argb_program'] in gv_json_config.get('argb_programs', {}):
+            return None
+        control_data['program'] = gv_json_config['argb_programs'][action['argb_program']]
+
+    else:
+        return None
+
+    return control_data
+
+
+def get_action_targets(action):
+    # List of (device name, control name) targets
+    # for a batch action.
+    #   device & control: that device control
+    #   zone & control:   devices with that zone control
+    #   zone only:        all switches in that zone 
+    #                     (state actions only)
+    device_name = action.get('device')
+    zone_name = action.get('zone')
+    control_name = action.get('control')
+    target_list = []
+
+    if device_name is not None:
+        if (control_name is not None and 
+                device_name in gv_device_dict):
+            for control in gv_device_dict[device_name]['status']['controls']:
+                if (control['name'] == control_name and 
+                        (zone_name is None or 
+                            gv_device_dict[device_name]['status']['zone'] == zone_name)):
+                    target_list.append((device_name, control_name))
+
+    elif zone_name is not None and control_name is not None:
+        for device_name, control in get_zone_controls(zone_name, control_name):
+            target_list.append((device_name, control_name))
+
+    elif zone_name is not None and 'state' in action:
+        with gv_control_index_lock:
+            control_key_list = [
+                    control_key for control_key in gv_control_index 
+                    if control_key[0] == zone_name]
+
+        for control_key in control_key_list:
+            for device_name, control in get_zone_controls(*control_key):
+                if control['type'] == 'switch':
+                    target_list.append((device_name, control_key[1]))
+
+    return target_list
+
+
+def process_batch_actions(action_list, job = None):
+    # Batch API
+    # Resolves each action to device controls and 
+    # groups them so that each device gets a single
+    # /control request. Later actions on the same 
+    # device control override earlier ones.
+    # Returns a dict of per-device results with the
+    # resulting device status and a list of errors
+    # for actions that could not be applied
+    device_control_dict = {}
+    error_list = []
+
+    for index, action in enumerate(action_list):
+        if not isinstance(action, dict):
+            error_list.append(
+                    {
+                        'action': index, 
+                        'error': 'action is not an object'
+                        }
+                    )
+            continue
+
+        target_list = get_action_targets(action)
+        if len(target_list) == 0:
+            error_list.append(
+                    {
+                        'action': index, 
+                        'error': 'no matching device controls'
+                        }
+                    )
+            continue
+
+        for device_name, control_name in target_list:
+            control_data = get_action_control_data(action, control_name)
+            if control_data is None:
+                error_list.append(
+                        {
+                            'action': index, 
+                            'error': 'invalid state or program'
+                            }
+                        )
+                break
+
+            if not device_name in device_control_dict:
+                device_control_dict[device_name] = collections.OrderedDict()
+            device_control_dict[device_name][control_name] = control_data
+
+    task_dict = {}
+    for device_name, control_dict in device_control_dict.items():
         log_message(
                 1,
-                "Sending config (%d bytes):\n%s\n" % (
-                    len(device_config),
-                    device_config
+                "Batch setting %d controls on %s" % (
+                    len(control_dict),
+                    device_name
                     )
                 )
 
-        # POST to /configure function of URL
-        requests.post(url + '/configure', 
-                      json = config_dict, 
-                      timeout = gv_http_timeout_secs)
+        task_dict[device_name] = (
+                send_device_controls, 
+                (device_name, list(control_dict.values())))
+
+    result_dict = {}
+    result_dict['devices'] = run_device_tasks(task_dict, job)
+    result_dict['errors'] = error_list
+
+    # add the controls set and resulting
+    # status for each device
+    for device_name, device_result in result_dict['devices'].items():
+        device_result['controls'] = list(device_control_dict[device_name].keys())
+        if (device_result['result'] == 'successful' and 
+                device_name in gv_device_dict):
+            device_result['status'] = gv_device_dict[device_name]['status']
+
+    return result_dict
+
+
+def get_job_summary(job):
+    # Short form of job record for events
+    summary = {}
+    summary['id'] = job['id']
+    summary['state'] = job['state']
+    summary['progress'] = dict(job['progress'])
+    return summary
+
+
+def publish_job_event(job):
+    # job progress as a change event
+    with gv_job_lock:
+        summary = get_job_summary(job)
+
+    event = build_event(
+            'job', 
+            None, 
+            None, 
+            None, 
+            None, 
+            summary)
+    event['job'] = job['id']
+    publish_events([event])
+    return
+
+
+def start_job_progress(job, device_name_list):
+    # Record the devices a job is waiting on
+    with gv_job_lock:
+        job['progress']['total'] += len(device_name_list)
+        for device_name in device_name_list:
+            job['devices'][device_name] = {'result': 'pending'}
+
+    publish_job_event(job)
+    return
+
 
+def job_task(job, device_name, fn, args):
+    # Wrapper for device tasks run for a job
+    # recording the device result on completion
+    start_time = time.time()
+    result = fn(*args)
+
+    device_result = {}
+    if result:
+        device_result['result'] = 'successful'
     else:
+        device_result['result'] = 'failed'
+    device_result['latency'] = round(time.time() - start_time, 3)
+
+    with gv_job_lock:
+        job['devices'][device_name] = device_result
+        job['progress']['completed'] += 1
+
+    publish_job_event(job)
+    return result
+
+
+def run_job(job, fn, args):
+    # Job executor wrapper
+    # runs the job function with the job and 
+    # records its returned dict in the job
+    with gv_job_lock:
+        job['state'] = 'running'
+        job['started'] = time.time()
+    publish_job_event(job)
+
+    try:
+        result_dict = fn(*args, job = job)
+        state = 'done'
+    except Exception as ex:
         log_message(
                 1,
-                "ERROR %s not found in device config" % (device_name))
+                "Job %d failed: %s" % (job['id'], ex))
+        result_dict = {}
+        state = 'failed'
 
-    return
+    with gv_job_lock:
+        job.update(result_dict)
+        job['state'] = state
+        job['finished'] = time.time()
+    publish_job_event(job)
 
+    log_message(
+            1,
+            "Job %d %s in %.3f secs" % (
+                job['id'],
+                state,
+                job['finished'] - job['started']
+                )
+            )
+    return
 
-def probe_agent():
-    # iterate set of discovered device URLs
-    # and probe their status values, storing in a dictionary
-    global gv_json_config
-    global gv_device_dict
 
-    # loop forever
+def submit_job(job_type, request, fn, args):
+    # Queue a job to run the given function
+    # and return the new job record
+    global gv_job_executor
+    global gv_job_id
+
+    with gv_job_lock:
+        if gv_job_executor is None:
+            gv_job_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers = get_config_value('http', 'job_workers', 4))
+
+        gv_job_id += 1
+        job = {}
+        job['id'] = gv_job_id
+        job['type'] = job_type
+        job['request'] = request
+        job['state'] = 'queued'
+        job['created'] = time.time()
+        job['started'] = None
+        job['finished'] = None
+        job['progress'] = {'total': 0, 'completed': 0}
+        job['devices'] = {}
+        gv_job_dict[job['id']] = job
+
+        # drop the oldest finished jobs
+        for job_id in list(gv_job_dict.keys()):
+            if len(gv_job_dict) <= gv_job_history:
+                break
+            if gv_job_dict[job_id]['state'] in ('done', 'failed'):
+                del gv_job_dict[job_id]
+
+    publish_job_event(job)
+    gv_job_executor.submit(run_job, job, fn, args)
+
+    return job
+
+
+def get_job(job_id, wait_secs = 0):
+    # Copy of job record
+    # optionally waiting up to wait_secs for 
+    # the job to finish
+    # returns None for unknown jobs
+    end_time = time.time() + wait_secs
     while (1):
-        # iterate set of discovered device URLs as snapshot list
-        # avoids issues if the set is updated mid-way
-        successful_probes = 0
-        failed_probes = 0
-        purged_urls = 0
-        control_changes = 0
-        for device_name in list(gv_device_dict.keys()):
+        with gv_job_lock:
+            if not job_id in gv_job_dict:
+                return None
+            job = copy.deepcopy(gv_job_dict[job_id])
+
+        if (job['state'] in ('done', 'failed') or 
+                time.time() >= end_time):
+            return job
+
+        time.sleep(0.1)
+
+
+def mark_data_changed():
+    # Flag the /data snapshot for rebuild
+    global gv_data_changed
+
+    gv_data_changed = True
+    return
+
 
-            if not device_name in gv_device_dict:
-                continue
+def mark_device_changed(device_name):
+    # Flag the /data snapshot for rebuild
+    # with the given device logged as changed
+    gv_data_changed_device_set.add(device_name)
+    mark_data_changed()
+    return
 
-            device = gv_device_dict[device_name]
-            now = int(time.time())
 
-            # skip any devices recently probed
-            if now - device['last_updated'] < gv_json_config['discovery']['device_probe_interval']:
-                continue
+def data_change_event_handler(event):
+    # Change event subscriber for /data
+    # job events are not part of the data
+    if event['type'] == 'job':
+        return
 
-            url = device['url']
-            json_data = get_url(url, gv_http_timeout_secs, 1)
-            if (json_data and 'name' in json_data):
-                device_name = json_data['name']
-                if ('configured' in json_data and
-                        json_data['configured'] == 0):
-                    # Configure device
-                    configure_device(url, device_name)
-                else:
-                    successful_probes += 1
-                    # Track what we got back
-                    # this is done after the compare above to ensure old is 
-                    # checked against new
-                    track_device_status(device_name, url, json_data)
+    if event['device'] is not None:
+        mark_device_changed(event['device'])
+    else:
+        mark_data_changed()
+    return
 
-            else:
-                failed_probes += 1
-                device['failed_probes'] += 1
-                log_message(
-                        1,
-                        'Failed to probe: %s .. response:%s' % (
-                            url,
-                            json_data
-                            )
-                        )
-        
-        # Purge dead devices and URLs
-        now = int(time.time())
 
-        # iterate the known devices with status values 
-        # that were previously recorded. 
-        # Check for expired timestamps and purge
-        device_name_list = list(gv_device_dict.keys())
-        purged_devices = 0
-        for device_name in device_name_list:
-            device = gv_device_dict[device_name]
+def sse_event_handler(event):
+    # Change event subscriber for /events
+    # serializes the event and wakes up streams
+    global gv_sse_event_id
 
-            last_updated = now - device['last_updated']
-            if last_updated >= gv_json_config['discovery']['device_purge_timeout']:
-                purged_devices += 1
-                reason = "expired.. device %s (%s) last updated %d seconds ago" % (
-                        device_name, 
-                        device['url'],
-                        last_updated)
-                purge_device(device_name, reason)
+    with gv_sse_lock:
+        gv_sse_event_id += 1
+        gv_sse_event_log.append(
+                (gv_sse_event_id, json.dumps(event)))
 
-        # Automated devices
-        check_automated_devices()
+    if gv_sse_loop is not None:
+        gv_sse_loop.call_soon_threadsafe(wake_sse_streams)
+    return
 
-        log_message(
-                1,
-                "Probe.. successful:%d failed:%d purged:%d" % (
-                    successful_probes,
-                    failed_probes,
-                    purged_devices
-                    )
-                )
 
-        # loop sleep interval
-        time.sleep(2)
+def log_data_change(version, device_name, change):
+    # Append to the /data change log
+    # raising the delta floor as old 
+    # entries fall off the end
+    global gv_data_change_log_floor
 
+    if len(gv_data_change_log) == gv_data_change_log.maxlen:
+        gv_data_change_log_floor = gv_data_change_log[0][0]
+    gv_data_change_log.append((version, device_name, change))
     return
 
 
-def process_console_action(
-        device_name, 
-        zone, 
-        control_name, 
-        reboot, 
-        reconfig, 
-        apmode, 
-        state, 
-        rgb_program,
-        argb_program):
+def build_data_dict():
+    # Dashboard data
+    # device program registers are internal to 
+    # the timer engine and are left out
+    # (list copies as probe threads modify the dicts)
+    device_dict = {}
+    for device_name, device in list(gv_device_dict.items()):
+        device_dict[device_name] = {
+                key: value for key, value in list(device.items()) 
+                if key != 'program_reg'}
+
+    data_dict = {}
+    data_dict['devices'] = device_dict
+    data_dict['rgb_programs'] = list(gv_json_config['rgb_programs'].keys())
+    data_dict['argb_programs'] = list(gv_json_config['argb_programs'].keys())
+    data_dict['system'] = {}
+    data_dict['system']['startup_time'] = gv_startup_time
+    data_dict['system']['sunrise_time'] = gv_actual_sunrise_time
+    data_dict['system']['sunset_time'] = gv_actual_sunset_time
+    data_dict['system']['sunset_offset'] = gv_json_config['sunset']['offset']
+    data_dict['system']['paired_switch_stats'] = gv_paired_switch_stats
+    data_dict['system']['fleet_operation'] = gv_fleet_operation
+
+    return data_dict
+
+
+def get_data_snapshot():
+    # Current /data snapshot
+    # rebuilt if marked changed or past max age
+    # so that last_updated times keep moving
+    global gv_data_changed
+    global gv_data_version
+    global gv_data_snapshot
+
+    with gv_data_lock:
+        now = time.time()
+        max_age_expired = (
+                gv_data_snapshot is not None and 
+                now - gv_data_snapshot['built'] >= get_config_value(
+                    'web', 
+                    'data_max_age', 
+                    30))
+
+        if (gv_data_snapshot is None or 
+                gv_data_changed or 
+                max_age_expired):
+            gv_data_changed = False
+            gv_data_version += 1
+
+            data_dict = build_data_dict()
+
+            # log changed and purged devices against 
+            # this version. Devices that have only been 
+            # probed since are not logged as their 
+            # last_updated times are sent separately 
+            # in deltas
+            changed_device_set = set(gv_data_changed_device_set)
+            gv_data_changed_device_set.difference_update(changed_device_set)
+
+            for device_name in sorted(changed_device_set):
+                if device_name in data_dict['devices']:
+                    log_data_change(gv_data_version, device_name, 'changed')
+                else:
+                    log_data_change(gv_data_version, device_name, 'purged')
 
-    global gv_device_dict
-    global gv_json_config
+            data_dict['delta'] = 0
+            data_dict['version'] = gv_data_version
+            data_dict['epoch'] = gv_startup_epoch
 
-    # list used to buok handle
-    # simple URL API calls for GET
-    # use cases.. reboot. reconfigure, apmode
-    command_url_list = []
-    reboot_all = 0
-    reconfig_all = 0
+            json_str = json.dumps(data_dict, indent = 4)
+            json_bytes = json_str.encode('utf-8')
 
-    if (device_name and reboot):
+            snapshot = {}
+            snapshot['version'] = gv_data_version
+            snapshot['etag'] = '"%d-%d"' % (gv_startup_epoch, gv_data_version)
+            snapshot['data_dict'] = data_dict
+            snapshot['json'] = json_bytes
+            snapshot['gzip'] = gzip.compress(json_bytes)
+            snapshot['built'] = now
+            snapshot['delta_dict'] = {}
+            gv_data_snapshot = snapshot
 
-        if device_name == 'all':
             log_message(
                     1,
-                    "Rebooting all devices")
-            reboot_all = 1
-            for device_name in gv_device_dict:
-                url = gv_device_dict[device_name]['url']
+                    "Rebuilt /data snapshot version:%d size:%d gzip:%d changes:%d" % (
+                        gv_data_version,
+                        len(snapshot['json']),
+                        len(snapshot['gzip']),
+                        len(changed_device_set)
+                        )
+                    )
 
-                log_message(
-                        1,
-                        "Rebooting %s" % (device_name))
+        return gv_data_snapshot
+
+
+def get_data_delta(snapshot, since):
+    # Delta of the given snapshot since the given
+    # version containing only the devices changed or 
+    # purged since then and a compact map of device
+    # name to last_updated time for liveness.
+    # Returns None if the version 
+    # is older than the change log covers or newer than 
+    # the snapshot. Deltas are cached on the snapshot 
+    # as dashboards will tend to ask for the same one
+    with gv_data_lock:
+        if (since < gv_data_change_log_floor or 
+                since > snapshot['version']):
+            return None
 
-                command_url_list.append('%s/reboot' % (url))
-            purge_all_devices()
+        if since in snapshot['delta_dict']:
+            return snapshot['delta_dict'][since]
+
+        change_dict = {}
+        for version, device_name, change in gv_data_change_log:
+            if since < version <= snapshot['version']:
+                change_dict[device_name] = change
+
+        data_dict = snapshot['data_dict']
+        delta_data_dict = {}
+        delta_data_dict['delta'] = 1
+        delta_data_dict['version'] = snapshot['version']
+        delta_data_dict['epoch'] = gv_startup_epoch
+        delta_data_dict['since'] = since
+        delta_data_dict['devices'] = {}
+        delta_data_dict['purged'] = []
+        delta_data_dict['last_updated'] = {
+                device_name: device['last_updated']
+                for device_name, device in data_dict['devices'].items()}
+        for device_name, change in change_dict.items():
+            if (change == 'changed' and 
+                    device_name in data_dict['devices']):
+                delta_data_dict['devices'][device_name] = data_dict['devices'][device_name]
+            else:
+                delta_data_dict['purged'].append(device_name)
 
-        elif device_name in gv_device_dict:
-            url = gv_device_dict[device_name]['url']
+        for key in data_dict:
+            if not key in delta_data_dict:
+                delta_data_dict[key] = data_dict[key]
 
-            log_message(
-                    1,
-                    "Rebooting %s" % (device_name))
+        json_str = json.dumps(delta_data_dict, indent = 4)
+        json_bytes = json_str.encode('utf-8')
 
-            command_url_list.append('%s/reboot' % (url))
-            
-    elif (device_name and reconfig):
+        delta = {}
+        delta['etag'] = '"%d-%d-%d"' % (
+                gv_startup_epoch, 
+                snapshot['version'],
+                since)
+        delta['json'] = json_bytes
+        delta['gzip'] = gzip.compress(json_bytes)
+        snapshot['delta_dict'][since] = delta
 
-        if device_name == 'all':
-            log_message(
-                    1,
-                    "Reconfiguring all devices")
-            reconfig_all = 1
-            for device_name in gv_device_dict:
-                url = gv_device_dict[device_name]['url']
+        return delta
 
-                log_message(
-                        1,
-                        "Reconfiguring %s" % (device_name))
 
-                command_url_list.append('%s/reconfigure' % (url))
+class web_console_data_handler(object):
+    @cherrypy.expose()
 
-            # Dont purge devices here as the probe stage will
-            # invoke the reconfigure
+    def index(self, since=None, epoch=None):
 
-        elif device_name in gv_device_dict:
-            url = gv_device_dict[device_name]['url']
+        log_message(
+                1,
+                "json client:%s:%d params:%s" % (
+                    cherrypy.request.remote.ip,
+                    cherrypy.request.remote.port,
+                    cherrypy.request.params
+                    )
+                )
 
-            log_message(
-                    1,
-                    "Reconfiguring %s" % (device_name))
+        snapshot = get_data_snapshot()
+        body = snapshot
+
+        # Delta since a given version
+        # falls back on the full snapshot if the 
+        # version is out of range or from a previous 
+        # run of the server
+        if (since is not None and 
+                since.isdigit() and
+                (epoch is None or epoch == str(gv_startup_epoch))):
+            delta = get_data_delta(snapshot, int(since))
+            if delta is not None:
+                body = delta
+
+        # Clients revalidate every time using the 
+        # ETag and get a 304 if the snapshot is unchanged
+        response = cherrypy.response
+        response.headers['ETag'] = body['etag']
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['X-Data-Version'] = str(snapshot['version'])
+
+        if_none_match = cherrypy.request.headers.get('If-None-Match', '')
+        if body['etag'] in [
+                tag.strip() for tag in if_none_match.split(',')]:
+            response.status = 304
+            return b''
+
+        accept_encoding = cherrypy.request.headers.get('Accept-Encoding', '')
+        if 'gzip' in accept_encoding:
+            response.headers['Content-Encoding'] = 'gzip'
+            return body['gzip']
+
+        return body['json']
 
-            command_url_list.append('%s/reconfigure' % (url))
+    # Force trailling slash off on called URL
+    index._cp_config = {'tools.trailing_slash.on': False}
 
-            # Dont purge device_name here as the probe stage will
-            # invoke the reconfigure
 
-    elif (device_name and apmode):
+def wake_sse_streams():
+    # Wake all streams waiting for events
+    # called on the event loop thread
+    global gv_sse_new_event
 
-        if device_name in gv_device_dict:
-            url = gv_device_dict[device_name]['url']
+    gv_sse_new_event.set()
+    gv_sse_new_event = asyncio.Event()
+    return
 
-            log_message(
-                    1,
-                    "Rebooting %s into AP Mode" % (device_name))
 
-            command_url_list.append('%s/apmode' % (url))
+def issue_sse_token():
+    # Single-use token for an /events stream
+    # expired tokens are dropped as we go
+    now = time.time()
+    token = secrets.token_urlsafe(16)
 
-    elif (device_name and zone and control_name and state):
+    with gv_sse_lock:
+        for expired_token in [
+                key for key, expiry in gv_sse_token_dict.items() 
+                if expiry < now]:
+            del gv_sse_token_dict[expired_token]
+        gv_sse_token_dict[token] = now + 30
 
-        if device_name in gv_device_dict:
-            url = gv_device_dict[device_name]['url']
+    return token
 
-            log_message(
-                    1,
-                    "Manually setting %s/%s/%s to state:%s" % (
-                        device_name,
-                        zone,
-                        control_name,
-                        state
-                        )
-                    )
 
-            control_data = {}
-            control_data['name'] = control_name
-            control_data['state'] = state
-            json_req = {}
-            json_req['controls'] = []
-            json_req['controls'].append(control_data)
-            json_data = post_url(url + '/control', 
-                                 json_req,
-                                 gv_http_timeout_secs)
-            if (json_data):
-                track_device_status(device_name, url, json_data)
+def use_sse_token(token):
+    # Check and consume a stream token
+    with gv_sse_lock:
+        expiry = gv_sse_token_dict.pop(token, 0)
 
-    elif (zone and control_name and state):
+    return expiry >= time.time()
 
-        # Check all devices
-        for device_name in gv_device_dict:
-            json_data = gv_device_dict[device_name]['status']
-
-            if ('zone' in json_data and 
-                    json_data['zone'] == zone and
-                    'controls' in json_data):
-                for control in json_data['controls']:
-                    if control['name'] == control_name:
-                        url = gv_device_dict[device_name]['url']
-
-                        log_message(
-                                1,
-                                "Manually setting (%s) %s/%s/%s to state:%s" % (
-                                    url,
-                                    device_name,
-                                    zone,
-                                    control_name,
-                                    state
-                                    )
-                                )
 
-                        control_data = {}
-                        control_data['name'] = control_name
-                        control_data['state'] = state
-                        json_req = {}
-                        json_req['controls'] = []
-                        json_req['controls'].append(control_data)
-                        json_data = post_url(url + '/control', 
-                                             json_req,
-                                             gv_http_timeout_secs)
-                        if (json_data):
-                            track_device_status(device_name, url, json_data)
+def get_sse_events(last_event_id):
+    # Events in the log after the given ID
+    # events are appended in ID order
+    # so we work back from the end
+    pending_list = []
+    with gv_sse_lock:
+        for event_id, event_str in reversed(gv_sse_event_log):
+            if event_id <= last_event_id:
+                break
+            pending_list.append((event_id, event_str))
 
-    elif (device_name and zone and control_name and rgb_program):
+    pending_list.reverse()
+    return pending_list
 
-        if device_name in gv_device_dict:
-            url = gv_device_dict[device_name]['url']
 
-            log_message(
-                    1,
-                    "Manually setting %s/%s/%s to rgb_program:%s" % (
-                        device_name,
-                        zone,
-                        control_name,
-                        rgb_program
-                        )
-                    )
+async def sse_write(writer, data):
+    # Write to a stream and wait for it to drain
+    # Clients that cannot take data within the 
+    # heartbeat interval are dropped
+    writer.write(data)
+    await asyncio.wait_for(
+            writer.drain(), 
+            get_config_value('web', 'sse_heartbeat', 15))
+    return
 
-            if ('rgb_programs' in gv_json_config and 
-                    rgb_program in gv_json_config['rgb_programs']):
 
-                control_data = {}
-                control_data['name'] = control_name
-                control_data['program'] = gv_json_config['rgb_programs'][rgb_program]
-                json_req = {}
-                json_req['controls'] = []
-                json_req['controls'].append(control_data)
-                json_data = post_url(url + '/control', 
-                                     json_req,
-                                     gv_http_timeout_secs)
-                if (json_data):
-                    track_device_status(device_name, url, json_data)
+async def sse_response(writer, status, header_list = []):
+    # Simple (non-stream) response
+    header_list = [
+            'HTTP/1.1 %s' % (status),
+            'Access-Control-Allow-Origin: *',
+            'Access-Control-Allow-Headers: Last-Event-ID',
+            'Content-Length: 0',
+            'Connection: close',
+            ] + header_list
+    await sse_write(writer, ('\r\n'.join(header_list) + '\r\n\r\n').encode('utf-8'))
+    return
 
-            else:
-                log_message(
-                        1,
-                        "program not found")
 
-    elif (zone and control_name and rgb_program):
-        if ('rgb_programs' in gv_json_config and 
-            rgb_program in gv_json_config['rgb_programs']):
+async def sse_stream(writer, last_event_id):
+    # A single /events stream
+    # Sends events after the given event ID, resuming 
+    # streams after reconnects. If that ID has left the
+    # event log or is from a previous server run, a 
+    # resync event tells the client to fetch /data again.
+    # Comment heartbeats keep idle connections alive and
+    # streams end after a max lifetime for the client to 
+    # reconnect
+    heartbeat_secs = get_config_value('web', 'sse_heartbeat', 15)
+    end_time = time.time() + get_config_value('web', 'sse_max_lifetime', 300)
+
+    header_list = [
+            'HTTP/1.1 200 OK',
+            'Content-Type: text/event-stream',
+            'Cache-Control: no-cache',
+            'X-Accel-Buffering: no',
+            'Access-Control-Allow-Origin: *',
+            'Connection: close',
+            ]
+    await sse_write(writer, ('\r\n'.join(header_list) + '\r\n\r\n').encode('utf-8'))
+
+    # reconnect delay for the client
+    await sse_write(writer, b'retry: 5000\n\n')
+
+    with gv_sse_lock:
+        oldest_event_id = gv_sse_event_id - len(gv_sse_event_log)
+        resync = (last_event_id is not None and
+                (last_event_id < oldest_event_id or 
+                    last_event_id > gv_sse_event_id))
+        if last_event_id is None or resync:
+            last_event_id = gv_sse_event_id
+
+    if resync:
+        await sse_write(
+                writer, 
+                ('id: %d\nevent: resync\ndata: {}\n\n' % (
+                    last_event_id)).encode('utf-8'))
+
+    while time.time() < end_time:
+        new_event = gv_sse_new_event
+        pending_list = get_sse_events(last_event_id)
+
+        if len(pending_list) == 0:
+            try:
+                await asyncio.wait_for(
+                        new_event.wait(), 
+                        min(heartbeat_secs, max(0, end_time - time.time())))
+            except asyncio.TimeoutError:
+                await sse_write(writer, b': heartbeat\n\n')
+            continue
 
-            # Check all devices
-            for device_name in gv_device_dict:
-                json_data = gv_device_dict[device_name]['status']
-
-                if ('zone' in json_data and 
-                        json_data['zone'] == zone and
-                        'controls' in json_data):
-                    for control in json_data['controls']:
-                        if control['name'] == control_name:
-                            url = gv_device_dict[device_name]['url']
-
-                            log_message(
-                                    1,
-                                    "Manually setting (%s) %s/%s/%s to rgb_program:%s" % (
-                                        url,
-                                        device_name,
-                                        zone,
-                                        control_name,
-                                        rgb_program
-                                        )
-                                    )
-
-                            control_data = {}
-                            control_data['name'] = control_name
-                            control_data['program'] = gv_json_config['rgb_programs'][rgb_program]
-                            json_req = {}
-                            json_req['controls'] = []
-                            json_req['controls'].append(control_data)
-                            json_data = post_url(url + '/control', 
-                                                 json_req,
-                                                 gv_http_timeout_secs)
-                            if (json_data):
-                                track_device_status(device_name, url, json_data)
+        chunk_list = []
+        for event_id, event_str in pending_list:
+            chunk_list.append('id: %d\ndata: %s\n\n' % (event_id, event_str))
+            last_event_id = event_id
+        await sse_write(writer, ''.join(chunk_list).encode('utf-8'))
 
-        else:
-            log_message(
-                    1,
-                    "program not found")
+    return
 
-    elif (device_name and zone and control_name and argb_program):
 
-        if device_name in gv_device_dict:
-            url = gv_device_dict[device_name]['url']
+async def sse_connection(reader, writer):
+    # Handle a connection to the /events stream server
+    # Streams need a token from the authenticated 
+    # /events handler which redirects clients here.
+    # The stream slot is taken only once the stream 
+    # starts and is released when it ends
+    global gv_sse_stream_count
 
-            log_message(
-                    1,
-                    "Manually setting %s/%s/%s to argb_program:%s" % (
-                        device_name,
-                        zone,
-                        control_name,
-                        argb_program
-                        )
-                    )
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 10)
+        header_dict = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), 10)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, _, value = line.decode('latin-1').partition(':')
+            header_dict[key.strip().lower()] = value.strip()
+
+        field_list = request_line.decode('latin-1').split()
+        if len(field_list) < 2:
+            return
+        method = field_list[0]
+        parsed_url = urllib.parse.urlsplit(field_list[1])
+        param_dict = dict(urllib.parse.parse_qsl(parsed_url.query))
+
+        # CORS preflight for the Last-Event-ID header
+        # as streams are cross-origin from the console
+        if method == 'OPTIONS':
+            await sse_response(
+                    writer, 
+                    '204 No Content',
+                    ['Access-Control-Allow-Methods: GET'])
+            return
+
+        if method != 'GET':
+            await sse_response(
+                    writer, 
+                    '405 Method Not Allowed',
+                    ['Allow: GET, OPTIONS'])
+            return
+
+        if parsed_url.path.rstrip('/') != '/events':
+            await sse_response(writer, '404 Not Found')
+            return
+
+        if not use_sse_token(param_dict.get('token')):
+            await sse_response(writer, '403 Forbidden')
+            return
+
+        if gv_sse_stream_count >= get_config_value(
+                'web', 
+                'sse_max_streams', 
+                200):
+            await sse_response(
+                    writer, 
+                    '503 Service Unavailable',
+                    ['Retry-After: 60'])
+            return
+
+        last_event_id = header_dict.get(
+                'last-event-id', 
+                param_dict.get('last_event_id'))
+        if last_event_id is not None and last_event_id.isdigit():
+            last_event_id = int(last_event_id)
+        else:
+            last_event_id = None
 
-            if ('argb_programs' in gv_json_config and 
-                    argb_program in gv_json_config['argb_programs']):
+        gv_sse_stream_count += 1
+        try:
+            await sse_stream(writer, last_event_id)
+        finally:
+            gv_sse_stream_count -= 1
 
-                control_data = {}
-                control_data['name'] = control_name
-                control_data['program'] = gv_json_config['argb_programs'][argb_program]
-                json_req = {}
-                json_req['controls'] = []
-                json_req['controls'].append(control_data)
-                json_data = post_url(url + '/control', 
-                                     json_req,
-                                     gv_http_timeout_secs)
-                if (json_data):
-                    track_device_status(device_name, url, json_data)
+    except (OSError, ValueError, asyncio.TimeoutError):
+        # client gone, bad request or 
+        # too slow to take data
+        pass
 
-            else:
-                log_message(
-                        1,
-                        "program not found")
+    finally:
+        writer.close()
 
-    elif (zone and control_name and argb_program):
-        if ('argb_programs' in gv_json_config and 
-            argb_program in gv_json_config['argb_programs']):
+    return
 
-            # Check all devices
-            for device_name in gv_device_dict:
-                json_data = gv_device_dict[device_name]['status']
-
-                if ('zone' in json_data and 
-                        json_data['zone'] == zone and
-                        'controls' in json_data):
-                    for control in json_data['controls']:
-                        if control['name'] == control_name:
-                            url = gv_device_dict[device_name]['url']
-
-                            log_message(
-                                    1,
-                                    "Manually setting (%s) %s/%s/%s to argb_program:%s" % (
-                                        url,
-                                        device_name,
-                                        zone,
-                                        control_name,
-                                        argb_program
-                                        )
-                                    )
-
-                            control_data = {}
-                            control_data['name'] = control_name
-                            control_data['program'] = gv_json_config['argb_programs'][argb_program]
-                            json_req = {}
-                            json_req['controls'] = []
-                            json_req['controls'].append(control_data)
-                            json_data = post_url(url + '/control', 
-                                                 json_req,
-                                                 gv_http_timeout_secs)
-                            if (json_data):
-                                track_device_status(device_name, url, json_data)
 
-        else:
-            log_message(
-                    1,
-                    "program not found")
+def sse_agent():
+    # Serves /events streams from a single asyncio
+    # event loop so that open streams don't each 
+    # hold a web server thread
+    # If the server can't be started (port in use, bad
+    # SSL config) event push is disabled and /events 
+    # answers 503 leaving the web console to poll
+    global gv_sse_loop
+    global gv_sse_new_event
 
-    # Bulk stuff
-    for url in command_url_list:
+    sse_port = get_config_value(
+            'web', 
+            'sse_port', 
+            gv_json_config['web']['port'] + 1)
+
+    log_message(
+            1,
+            'Starting event stream server.. port:%d' % (
+                sse_port)
+            )
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    gv_sse_new_event = asyncio.Event()
+    try:
+        ssl_context = None
+        if 'ssl' in gv_json_config['web']:
+            ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            ssl_context.load_cert_chain(
+                    gv_json_config['web']['ssl']['cert'],
+                    gv_json_config['web']['ssl']['key'])
+
+        loop.run_until_complete(
+                asyncio.start_server(
+                    sse_connection, 
+                    '0.0.0.0', 
+                    sse_port, 
+                    ssl = ssl_context))
+    except (OSError, ssl.SSLError) as ex:
         log_message(
                 1,
-                "Issuing command url:%s" % (
-            url))
+                'Failed to start event stream server on port %d (%s).. '
+                'event push disabled' % (
+                    sse_port,
+                    ex)
+                )
+        loop.close()
+        return
 
-        # Not going to track response data
-        # for bulk operations
-        get_url(url, gv_http_timeout_secs, 1)
+    gv_sse_loop = loop
+    loop.run_forever()
 
-    return 
+    return
 
 
-class web_console_data_handler(object):
+class web_console_events_handler(object):
     @cherrypy.expose()
 
-    def index(self):
-        global gv_startup_time
-        global gv_actual_sunrise_time
-        global gv_actual_sunset_time
+    def index(self, last_event_id = None):
 
         log_message(
                 1,
-                "json client:%s:%d params:%s" % (
+                "events client:%s:%d headers:%s" % (
                     cherrypy.request.remote.ip,
                     cherrypy.request.remote.port,
-                    cherrypy.request.params
+                    cherrypy.request.headers.get('Last-Event-ID')
                     )
                 )
 
-        data_dict = {}
-        data_dict['devices'] = gv_device_dict
-        data_dict['rgb_programs'] = list(gv_json_config['rgb_programs'].keys())
-        data_dict['argb_programs'] = list(gv_json_config['argb_programs'].keys())
-        data_dict['system'] = {}
-        data_dict['system']['startup_time'] = gv_startup_time
-        data_dict['system']['sunrise_time'] = gv_actual_sunrise_time
-        data_dict['system']['sunset_time'] = gv_actual_sunset_time
-        data_dict['system']['sunset_offset'] = gv_json_config['sunset']['offset']
-
-        return json.dumps(data_dict, indent = 4)
+        # HEAD would otherwise be served as a GET
+        if cherrypy.request.method != 'GET':
+            cherrypy.response.headers['Allow'] = 'GET'
+            raise cherrypy.HTTPError(405)
+
+        # event stream server not running
+        if gv_sse_loop is None:
+            raise cherrypy.HTTPError(503)
+
+        # Streams are served by the event stream server
+        # on its own port. The client is redirected there
+        # with a single-use token standing in for the 
+        # authentication done here and its last event ID
+        last_event_id = cherrypy.request.headers.get(
+                'Last-Event-ID', 
+                last_event_id)
+        param_dict = {}
+        param_dict['token'] = issue_sse_token()
+        if last_event_id is not None and last_event_id.isdigit():
+            param_dict['last_event_id'] = last_event_id
+
+        host = urllib.parse.urlsplit(
+                '//' + cherrypy.request.headers.get(
+                    'Host', 
+                    cherrypy.request.local.name)).hostname
+        if ':' in host:
+            host = '[%s]' % (host)
+
+        scheme = 'https' if 'ssl' in gv_json_config['web'] else 'http'
+        sse_port = get_config_value(
+                'web', 
+                'sse_port', 
+                gv_json_config['web']['port'] + 1)
+        raise cherrypy.HTTPRedirect(
+                '%s://%s:%d/events?%s' % (
+                    scheme,
+                    host,
+                    sse_port,
+                    urllib.parse.urlencode(param_dict)),
+                307)
 
     # Force trailling slash off on called URL
-    index._cp_config = {'tools.trailing_slash.on': False}
+    index._cp_config = {
+            'tools.trailing_slash.on': False,
+            }
+
+
+def get_wait_secs(wait):
+    # wait API parameter in seconds
+    # capped at the command deadline
+    try:
+        wait_secs = float(wait)
+    except (TypeError, ValueError):
+        return 0
+
+    return max(0, min(
+        wait_secs, 
+        get_config_value('http', 'command_deadline', gv_http_timeout_secs)))
+
+
+def job_response(job):
+    # JSON response for a job record
+    cherrypy.response.headers['Content-Type'] = 'application/json'
+    return json.dumps(job, indent = 4).encode('utf-8')
 
 
 class web_console_api_handler(object):
@@ -1273,7 +5033,9 @@ class web_console_api_handler(object):
               reboot=None,
               reconfig=None,
               update=None,
-              apmode=None):
+              apmode=None,
+              rolling=None,
+              wait=None):
 
         log_message(
                 1,
@@ -1284,23 +5046,79 @@ class web_console_api_handler(object):
                     )
                 )
 
-        # process actions if present
-        process_console_action(device, 
-                               zone, 
-                               control, 
-                               reboot, 
-                               reconfig,
-                               apmode, 
-                               state, 
-                               rgb_program,
-                               argb_program)
-
-        # Return nothing
-        return ""
+        # queue actions as a job and return the
+        # job, optionally waiting for it to finish
+        job = submit_job(
+                'action',
+                dict(cherrypy.request.params),
+                process_console_action,
+                (device, 
+                 zone, 
+                 control, 
+                 reboot, 
+                 reconfig,
+                 apmode, 
+                 state, 
+                 rgb_program,
+                 argb_program,
+                 rolling))
+
+        return job_response(get_job(job['id'], get_wait_secs(wait)))
 
     # Force trailling slash off on called URL
     index._cp_config = {'tools.trailing_slash.on': False}
 
+    @cherrypy.expose()
+
+    def batch(self, wait=None):
+        # JSON POST of {"actions": [...]}
+        # queued as a job
+        log_message(
+                1,
+                "json client:%s:%d batch" % (
+                    cherrypy.request.remote.ip,
+                    cherrypy.request.remote.port
+                    )
+                )
+
+        if cherrypy.request.method != 'POST':
+            raise cherrypy.HTTPError(405, 'POST required')
+
+        try:
+            json_req = json.loads(cherrypy.request.body.read())
+            action_list = json_req['actions']
+            if not isinstance(action_list, list):
+                raise ValueError('actions is not a list')
+        except Exception as ex:
+            raise cherrypy.HTTPError(400, 'Invalid batch request: %s' % (ex))
+
+        job = submit_job(
+                'batch',
+                json_req,
+                process_batch_actions,
+                (action_list,))
+
+        return job_response(get_job(job['id'], get_wait_secs(wait)))
+
+    @cherrypy.expose()
+
+    def jobs(self, job_id=None, wait=None):
+        # Job status by ID or list of 
+        # recent job summaries
+        if job_id is None:
+            with gv_job_lock:
+                job_list = [get_job_summary(job) for job in gv_job_dict.values()]
+            return job_response(job_list)
+
+        if not job_id.isdigit():
+            raise cherrypy.HTTPError(404, 'Unknown job')
+
+        job = get_job(int(job_id), get_wait_secs(wait))
+        if job is None:
+            raise cherrypy.HTTPError(404, 'Unknown job')
+
+        return job_response(job)
+
 
 def web_server(dev_mode):
 
@@ -1390,6 +5208,9 @@ def web_server(dev_mode):
     # webhook for action API
     cherrypy.tree.mount(web_console_api_handler(), '/api', api_conf)
 
+    # change event stream
+    cherrypy.tree.mount(web_console_events_handler(), '/events', api_conf)
+
     # Cherrypy main loop
     cherrypy.engine.start()
     cherrypy.engine.block()
@@ -1418,63 +5239,136 @@ def thread_exception_wrapper(
 
 # main()
 gv_startup_time = time.asctime()
+gv_startup_epoch = int(time.time())
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description = 'JBHASD Web Server'
+            )
+
+    parser.add_argument(
+            '--dev', 
+            help = 'Enable Development mode', 
+            action = 'store_true'
+            )
+
+    parser.add_argument(
+            '--async_transport', 
+            help = 'Use asyncio transport for device I/O', 
+            action = 'store_true'
+            )
 
-parser = argparse.ArgumentParser(
-        description = 'JBHASD Web Server'
-        )
-
-parser.add_argument(
-        '--dev', 
-        help = 'Enable Development mode', 
-        action = 'store_true'
-        )
-
-args = vars(parser.parse_args())
-dev_mode = args['dev']
-
-# Thread management 
-executor = concurrent.futures.ThreadPoolExecutor(
-        max_workers = 20)
-future_dict = {}
-
-future_dict['Config Agent'] = executor.submit(
-        thread_exception_wrapper,
-        config_agent)
-
-# Allow some grace for config to load
-time.sleep(5)
-
-# device discovery thread
-future_dict['Discovery Agent'] = executor.submit(
-        thread_exception_wrapper,
-        discovery_agent)
-
-# device probe thread
-future_dict['Status Probe Agent'] = executor.submit(
-        thread_exception_wrapper,
-        probe_agent)
-
-# web server thread
-future_dict['Web Server'] = executor.submit(
-        thread_exception_wrapper,
-        web_server,
-        dev_mode)
-
-# main loop
-while (True):
-    exception_dict = {}
-    for key in future_dict:
-        future = future_dict[key]
-        if future.done():
-            if future.exception():
-                exception_dict[key] = future.exception()
-
-    if (len(exception_dict) > 0):
+    parser.add_argument(
+            '--discovery_mode', 
+            help = 'Device discovery mode (overrides discovery/mode)', 
+            choices = ['zeroconf', 'static', 'sweep'],
+            default = None
+            )
+
+    args = vars(parser.parse_args())
+    dev_mode = args['dev']
+
+    # Thread management 
+    executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers = 20)
+    future_dict = {}
+
+    future_dict['Config Agent'] = executor.submit(
+            thread_exception_wrapper,
+            config_agent)
+
+    # Allow some grace for config to load
+    time.sleep(5)
+
+    # Optional asyncio transport for device I/O
+    if (args['async_transport'] or 
+            get_config_value('http', 'async_transport', 0)):
+        device_connection_limit = get_config_value(
+                'http', 
+                'device_connection_limit', 
+                1)
+        log_message(
+                1,
+                "Starting async transport (device connection limit:%d)" % (
+                    device_connection_limit
+                    )
+                )
+        gv_async_transport = AsyncDeviceTransport(device_connection_limit)
+
+    # change event subscribers
+    # registered before the discovery and probe agents
+    # start so no events from the first probes are missed
+    subscribe_events(data_change_event_handler)
+    subscribe_events(sse_event_handler)
+    subscribe_events(
+            paired_switch_event_handler,
+            ['switch_state', 'control_added'])
+
+    # device discovery thread
+    if args['discovery_mode']:
+        gv_discovery_mode = args['discovery_mode']
+    else:
+        gv_discovery_mode = get_config_value('discovery', 'mode', 'zeroconf')
+    if not gv_discovery_mode in ['zeroconf', 'static', 'sweep']:
         log_message(
                 1,
-                'Exceptions Detected:\n%s' % (
-                    exception_dict)
+                "Unknown discovery mode %s.. using zeroconf" % (
+                    gv_discovery_mode
+                    )
                 )
-        os._exit(1) 
-        
-    time.sleep(5)
+        gv_discovery_mode = 'zeroconf'
+    log_message(
+            1,
+            "Discovery mode:%s" % (
+                gv_discovery_mode
+                )
+            )
+
+    future_dict['Discovery Agent'] = executor.submit(
+            thread_exception_wrapper,
+            discovery_agent)
+
+    # device probe thread
+    future_dict['Status Probe Agent'] = executor.submit(
+            thread_exception_wrapper,
+            probe_agent)
+
+    # paired switch propagation thread
+    future_dict['Paired Switch Agent'] = executor.submit(
+            thread_exception_wrapper,
+            paired_switch_agent)
+
+    # timed device programs thread
+    future_dict['Timer Agent'] = executor.submit(
+            thread_exception_wrapper,
+            timer_agent)
+
+    # event stream server thread
+    future_dict['SSE Agent'] = executor.submit(
+            thread_exception_wrapper,
+            sse_agent)
+
+    # web server thread
+    future_dict['Web Server'] = executor.submit(
+            thread_exception_wrapper,
+            web_server,
+            dev_mode)
+
+    # main loop
+    while (True):
+        exception_dict = {}
+        for key in future_dict:
+            future = future_dict[key]
+            if future.done():
+                if future.exception():
+                    exception_dict[key] = future.exception()
+
+        if (len(exception_dict) > 0):
+            log_message(
+                    1,
+                    'Exceptions Detected:\n%s' % (
+                        exception_dict)
+                    )
+            os._exit(1) 
+
+        time.sleep(5)
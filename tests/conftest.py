@@ -0,0 +1,84 @@
+# Shared fixtures for the JBHASD tests
+#
+# Tests run against the device simulator (jbhasd_device_sim.py)
+# started once per session as a subprocess.
+# The web server is imported as a module, its main section
+# only runs when it is invoked as a script
+
+import os
+import sys
+import time
+import socket
+import subprocess
+import pytest
+
+gv_repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, gv_repo_dir)
+
+# simulated devices listen on 9000 upwards
+gv_sim_base_port = 9000
+gv_sim_devices = 50
+
+
+def wait_for_port(port, timeout):
+    # Wait for a TCP port on localhost to accept
+    # connections, returns True if it did
+    end_time = time.time() + timeout
+    while time.time() < end_time:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout = 1):
+                return True
+        except OSError:
+            time.sleep(0.2)
+
+    return False
+
+
+@pytest.fixture(scope = 'session')
+def sim():
+    # Device simulator subprocess
+    # yields a list of (device name, url) tuples
+    process = subprocess.Popen(
+            [sys.executable, os.path.join(gv_repo_dir, 'jbhasd_device_sim.py')],
+            cwd = gv_repo_dir,
+            stdout = subprocess.DEVNULL,
+            stderr = subprocess.DEVNULL)
+
+    # simulated device servers start in no particular order
+    for port in range(gv_sim_base_port, gv_sim_base_port + gv_sim_devices):
+        if not wait_for_port(port, 30):
+            process.kill()
+            pytest.skip('device simulator did not start')
+
+    device_list = []
+    for id in range(0, gv_sim_devices):
+        device_list.append((
+            '_JBHASD-BEEFED%02X' % (id),
+            'http://127.0.0.1:%d' % (gv_sim_base_port + id)))
+
+    yield device_list
+
+    process.terminate()
+    try:
+        process.wait(timeout = 10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+@pytest.fixture
+def server():
+    # Web server module with its default config
+    # and no devices
+    import jbhasd_web_server as server
+
+    server.gv_json_config = server.set_default_config()
+    server.purge_all_devices()
+    del server.gv_event_subscriber_list[:]
+
+    yield server
+
+    if server.gv_async_transport:
+        server.gv_async_transport.loop.call_soon_threadsafe(
+                server.gv_async_transport.loop.stop)
+        server.gv_async_transport = None
+    server.purge_all_devices()
@@ -0,0 +1,95 @@
+# Async device transport against the device simulator
+
+import time
+import threading
+
+
+def start_transport(server, connection_limit = 1):
+    server.gv_async_transport = server.AsyncDeviceTransport(connection_limit)
+    return server.gv_async_transport
+
+
+def test_requests_reuse_keep_alive_connection(server, sim):
+    start_transport(server)
+    device_name, url = sim[0]
+    server.register_device(device_name, url)
+
+    for i in range(0, 5):
+        json_data = server.get_url(url + '/status', 5, 1)
+        assert json_data['name'] == device_name
+
+    http_stats = server.gv_device_dict[device_name]['http_stats']
+    assert http_stats['requests'] == 5
+    assert http_stats['connections'] == 1
+    assert http_stats['reused_connections'] == 4
+    assert server.gv_device_dict[device_name]['latency']['samples'] == 5
+
+
+def test_post_shares_device_connection(server, sim):
+    start_transport(server)
+    device_name, url = sim[1]
+    server.register_device(device_name, url)
+
+    json_data = server.get_url(url, 5, 1)
+    control = json_data['controls'][0]
+    json_data = server.post_url(
+            url + '/control', 
+            {'controls': [{'name': control['name'], 'state': 1}]},
+            5)
+    assert json_data['name'] == device_name
+
+    http_stats = server.gv_device_dict[device_name]['http_stats']
+    assert http_stats['requests'] == 2
+    assert http_stats['connections'] == 1
+    assert server.gv_device_dict[device_name]['post_latency']['samples'] == 1
+
+
+def test_gathered_requests_respect_connection_limit(server, sim):
+    transport = start_transport(server, connection_limit = 2)
+    device_name, url = sim[2]
+    server.register_device(device_name, url)
+
+    coroutine_list = [
+            server.async_get_url(url, 5, 1) for i in range(0, 10)
+            ]
+    json_data_list = transport.gather(coroutine_list, 10).result()
+
+    assert [json_data['name'] for json_data in json_data_list] == [device_name] * 10
+    http_stats = server.gv_device_dict[device_name]['http_stats']
+    assert http_stats['requests'] == 10
+    assert http_stats['connections'] <= 2
+
+
+def test_probe_fan_out_runs_on_event_loop(server, sim):
+    start_transport(server)
+    for device_name, url in sim:
+        server.register_device(device_name, url)
+    device_name_list = [device_name for device_name, url in sim]
+
+    thread_count = threading.active_count()
+    due_time = time.time()
+    fetch_dict = server.fetch_device_probes(device_name_list, 5, due_time, 10)
+    assert threading.active_count() == thread_count
+
+    for device_name in device_name_list:
+        assert fetch_dict[device_name]['json_data']['name'] == device_name
+        result = server.probe_device(
+                device_name, 
+                5, 
+                due_time, 
+                fetch_dict[device_name])
+        assert result == 'successful'
+        assert server.gv_device_dict[device_name]['failed_probes'] == 0
+
+
+def test_probe_fan_out_unreachable_device(server, sim):
+    start_transport(server)
+    server.register_device('DEAD', 'http://127.0.0.1:8999')
+    due_time = time.time()
+
+    fetch_dict = server.fetch_device_probes(['DEAD'], 1, due_time, 5)
+    assert fetch_dict['DEAD']['json_data'] is None
+
+    result = server.probe_device('DEAD', 1, due_time, fetch_dict['DEAD'])
+    assert result == 'failed'
+    assert server.gv_device_dict['DEAD']['failed_probes'] == 1
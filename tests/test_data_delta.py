@@ -0,0 +1,97 @@
+# /data?since deltas merged as done by the web console
+
+import copy
+import json
+
+
+def merge_delta(data_dict, delta_dict):
+    # Merge of a delta into the previous 
+    # data as done in www/dash.html
+    for device_name in delta_dict['devices']:
+        data_dict['devices'][device_name] = delta_dict['devices'][device_name]
+    for device_name in delta_dict['purged']:
+        del data_dict['devices'][device_name]
+    for device_name in delta_dict['last_updated']:
+        if device_name in data_dict['devices']:
+            data_dict['devices'][device_name]['last_updated'] = (
+                    delta_dict['last_updated'][device_name])
+    for key in delta_dict:
+        if not key in ['devices', 'purged', 'last_updated']:
+            data_dict[key] = delta_dict[key]
+
+    return data_dict
+
+
+def probe_sim_devices(server, device_list):
+    for device_name, url in device_list:
+        server.register_device(device_name, url)
+        assert server.probe_device(device_name, 5) == 'successful'
+
+
+def test_delta_merge_matches_full_data(server, sim):
+    server.subscribe_events(server.data_change_event_handler)
+    probe_sim_devices(server, sim[0:5])
+    snapshot = server.get_data_snapshot()
+    data_dict = json.loads(snapshot['json'])
+
+    # device 0 changes a control
+    changed_name = sim[0][0]
+    json_data = copy.deepcopy(server.gv_device_dict[changed_name]['status'])
+    control = json_data['controls'][0]
+    control['state'] = 1 - control.get('state', 0)
+    control['context'] = 'network'
+    server.track_device_status(changed_name, sim[0][1], json_data)
+
+    # device 1 is purged
+    purged_name = sim[1][0]
+    server.purge_device(purged_name, 'test')
+
+    # device 2 is only probed again
+    probed_name = sim[2][0]
+    server.gv_device_dict[probed_name]['last_updated'] += 5
+
+    # device 5 is discovered
+    probe_sim_devices(server, sim[5:6])
+    added_name = sim[5][0]
+
+    new_snapshot = server.get_data_snapshot()
+    assert new_snapshot['version'] > snapshot['version']
+    delta = server.get_data_delta(new_snapshot, data_dict['version'])
+    delta_dict = json.loads(delta['json'])
+    full_data_dict = json.loads(new_snapshot['json'])
+
+    assert delta_dict['delta'] == 1
+    assert sorted(delta_dict['devices']) == sorted([changed_name, added_name])
+    assert delta_dict['purged'] == [purged_name]
+    assert len(delta['json']) < len(new_snapshot['json'])
+
+    merged_dict = merge_delta(data_dict, delta_dict)
+    assert merged_dict['version'] == full_data_dict['version']
+    assert sorted(merged_dict['devices']) == sorted(full_data_dict['devices'])
+    for device_name, device in full_data_dict['devices'].items():
+        merged_device = merged_dict['devices'][device_name]
+        assert merged_device['status'] == device['status']
+        assert merged_device['last_updated'] == device['last_updated']
+
+
+def test_delta_out_of_range(server, sim):
+    server.subscribe_events(server.data_change_event_handler)
+    probe_sim_devices(server, sim[0:1])
+    snapshot = server.get_data_snapshot()
+
+    # newer than the snapshot
+    assert server.get_data_delta(snapshot, snapshot['version'] + 1) is None
+
+    # older than the change log covers
+    floor = server.gv_data_change_log_floor
+    server.gv_data_change_log_floor = snapshot['version']
+    try:
+        assert server.get_data_delta(snapshot, snapshot['version'] - 1) is None
+    finally:
+        server.gv_data_change_log_floor = floor
+
+    # no changes since the snapshot
+    delta_dict = json.loads(
+            server.get_data_delta(snapshot, snapshot['version'])['json'])
+    assert delta_dict['devices'] == {}
+    assert delta_dict['purged'] == []
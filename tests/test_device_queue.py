@@ -0,0 +1,125 @@
+# Per-device write queues against the device simulator
+
+import time
+import collections
+
+# nothing listens here
+gv_dead_url = 'http://127.0.0.1:8999'
+
+
+def hold_device_queue(server, device_name):
+    # Mark the device queue busy so queued requests
+    # wait for drain_device_queue() to be run by the test
+    with server.gv_device_queue_lock:
+        device_queue = {}
+        device_queue['pending'] = collections.OrderedDict()
+        device_queue['active'] = True
+        server.gv_device_queue_dict[device_name] = device_queue
+
+
+def get_sim_device(server, sim, index):
+    device_name, url = sim[index]
+    server.register_device(device_name, url)
+    assert server.probe_device(device_name, 5) == 'successful'
+    return device_name, url
+
+
+def test_superseded_controls_coalesce(server, sim):
+    device_name, url = get_sim_device(server, sim, 3)
+    control_name = server.gv_device_dict[device_name]['status']['controls'][0]['name']
+
+    hold_device_queue(server, device_name)
+    delivery_list = [
+            server.queue_device_control(
+                device_name, 
+                {'name': control_name, 'state': state},
+                'test')
+            for state in [1, 0, 1]
+            ]
+    server.drain_device_queue(device_name)
+
+    assert [delivery['state'] for delivery in delivery_list] == [
+            'superseded', 'superseded', 'delivered']
+    assert delivery_list[2]['attempts'] == 1
+
+    json_data = server.get_url(url, 5, 1)
+    control = [
+            control for control in json_data['controls'] 
+            if control['name'] == control_name][0]
+    assert control['state'] == 1
+
+    queue_stats = server.gv_device_dict[device_name]['queue']
+    assert queue_stats['depth'] == 0
+    assert queue_stats['superseded'] == 2
+    assert queue_stats['delivered'] == 1
+
+
+def test_queued_controls_sent_together(server, sim):
+    for index in range(0, len(sim)):
+        device_name, url = get_sim_device(server, sim, index)
+        control_list = server.gv_device_dict[device_name]['status']['controls']
+        if len(control_list) >= 2:
+            break
+    assert len(control_list) >= 2
+
+    requests_before = server.gv_device_dict[device_name]['http_stats']['requests']
+    hold_device_queue(server, device_name)
+    delivery_list = [
+            server.queue_device_control(
+                device_name, 
+                {'name': control['name'], 'state': 1},
+                'test')
+            for control in control_list[0:2]
+            ]
+    server.drain_device_queue(device_name)
+
+    assert [delivery['state'] for delivery in delivery_list] == [
+            'delivered', 'delivered']
+
+    # one /control request for both
+    http_stats = server.gv_device_dict[device_name]['http_stats']
+    assert http_stats['requests'] == requests_before + 1
+    assert delivery_list[0]['response'] is delivery_list[1]['response']
+
+
+def test_undeliverable_control_fails_at_deadline(server):
+    server.gv_json_config['http']['queue_retry_backoff'] = 0.2
+    server.register_device('DEAD', gv_dead_url)
+
+    delivery = server.queue_device_control(
+            'DEAD', 
+            {'name': 'Switch', 'state': 1},
+            'test',
+            deadline_secs = 1)
+
+    assert server.wait_delivery(delivery) == 'failed'
+    assert delivery['attempts'] >= 2
+    assert server.gv_device_dict['DEAD']['queue']['retries'] >= 1
+
+
+def test_retry_superseded_by_newer_control(server):
+    server.gv_json_config['http']['queue_retry_backoff'] = 1
+    server.register_device('DEAD', gv_dead_url)
+
+    delivery = server.queue_device_control(
+            'DEAD', 
+            {'name': 'Switch', 'state': 1},
+            'test',
+            deadline_secs = 10)
+
+    # wait for the first attempt to fail and
+    # the retry to be queued
+    end_time = time.time() + 5
+    while (delivery['attempts'] == 0 or 
+            delivery['state'] != 'queued'):
+        assert time.time() < end_time
+        time.sleep(0.05)
+
+    new_delivery = server.queue_device_control(
+            'DEAD', 
+            {'name': 'Switch', 'state': 0},
+            'test',
+            deadline_secs = 0.5)
+
+    assert delivery['state'] == 'superseded'
+    assert server.wait_delivery(new_delivery) == 'failed'
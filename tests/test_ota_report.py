@@ -0,0 +1,45 @@
+# OTA rollout report writes under concurrency
+
+import os
+import json
+import concurrent.futures
+
+import jbhasd_ota_update as ota
+
+
+def record_result(report, report_file, device_name):
+    # as done by run_device() for each device
+    with ota.report_lock:
+        report['devices'][device_name] = {'name': device_name, 'status': 'updated'}
+    ota.save_report(report, report_file)
+
+
+def test_save_report_concurrent_writers(tmp_path):
+    report_file = str(tmp_path / 'ota_report.json')
+    report = {}
+    report['devices'] = {}
+    device_name_list = ['device-%03d' % (id) for id in range(0, 200)]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers = 16) as executor:
+        future_list = [
+                executor.submit(record_result, report, report_file, device_name)
+                for device_name in device_name_list
+                ]
+        for future in future_list:
+            # raises if a writer lost its tmp file to another
+            future.result()
+
+    # last writer saw every device
+    saved_report = ota.load_report(report_file)
+    assert sorted(saved_report['devices']) == device_name_list
+    assert os.listdir(str(tmp_path)) == ['ota_report.json']
+
+
+def test_save_report_replaces_existing(tmp_path):
+    report_file = str(tmp_path / 'ota_report.json')
+    with open(report_file, 'w') as outfile:
+        outfile.write('not json')
+
+    ota.save_report({'devices': {}}, report_file)
+    with open(report_file) as infile:
+        assert json.load(infile) == {'devices': {}}
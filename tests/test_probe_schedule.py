@@ -0,0 +1,107 @@
+# Probe scheduler and circuit breaker interaction
+
+import time
+import pytest
+
+# nothing listens here
+gv_dead_url = 'http://127.0.0.1:8999'
+
+
+def open_breaker(server, device_name, retry_time, backoff = 1):
+    breaker = server.get_breaker(server.gv_device_dict[device_name])
+    breaker['state'] = 'open'
+    breaker['failures'] = 3
+    breaker['backoff'] = backoff
+    breaker['retry_time'] = retry_time
+    return breaker
+
+
+def run_probe_batches(server, run_secs):
+    # Probe batches as run by probe_agent() 
+    # returns the number of probes made
+    batch_window = server.get_config_value('discovery', 'probe_batch_window', 1)
+    end_time = time.time() + run_secs
+    probe_count = 0
+    while time.time() < end_time:
+        due_time = time.time() + batch_window
+        due_list, next_due_time = server.get_due_probes(due_time)
+        for device_name in due_list:
+            server.probe_device(device_name, 1, due_time)
+            probe_count += 1
+
+        if next_due_time is None:
+            break
+        time.sleep(min(max(0, next_due_time - time.time()), 0.5))
+
+    return probe_count
+
+
+def test_breaker_retry_inside_batch_window_is_probed(server):
+    server.register_device('DEAD', gv_dead_url)
+    now = time.time()
+    breaker = open_breaker(server, 'DEAD', now + 0.5)
+
+    due_time = now + 1
+    assert server.probe_device('DEAD', 1, due_time) == 'failed'
+
+    # failed half-open probe re-opens with double the backoff
+    assert breaker['state'] == 'open'
+    assert breaker['backoff'] == 2
+    assert server.gv_probe_due_dict['DEAD'] > due_time
+
+
+def test_skipped_probe_rescheduled_after_batch_window(server):
+    server.register_device('DEAD', gv_dead_url)
+    now = time.time()
+    open_breaker(server, 'DEAD', now + 30)
+
+    due_time = now + 1
+    assert server.probe_device('DEAD', 1, due_time) == 'skipped'
+    assert server.gv_probe_due_dict['DEAD'] == pytest.approx(now + 30)
+
+    due_list, next_due_time = server.get_due_probes(due_time)
+    assert due_list == []
+
+
+def test_breaker_retry_capped_at_purge_time(server):
+    server.register_device('DEAD', gv_dead_url)
+    now = time.time()
+    server.gv_device_dict['DEAD']['last_updated'] = int(now) - 100
+    open_breaker(server, 'DEAD', now + 300)
+
+    assert server.probe_device('DEAD', 1, now + 1) == 'skipped'
+    purge_time = int(now) - 100 + server.get_config_value(
+            'discovery', 
+            'device_purge_timeout', 
+            120)
+    assert server.gv_probe_due_dict['DEAD'] == pytest.approx(purge_time)
+
+
+def test_open_breaker_does_not_spin_probe_batches(server):
+    server.gv_json_config['discovery']['breaker_threshold'] = 1
+    server.gv_json_config['discovery']['breaker_backoff'] = 1
+    server.register_device('DEAD', gv_dead_url)
+    server.schedule_probe('DEAD', 0)
+
+    # first probe opens the breaker and the half-open
+    # retries back off 1, 2 secs.. so a handful of 
+    # probes at most in 3 secs
+    probe_count = run_probe_batches(server, 3)
+    assert 1 <= probe_count <= 4
+    assert server.gv_device_dict['DEAD']['breaker']['state'] == 'open'
+
+
+def test_half_open_probe_closes_breaker(server, sim):
+    device_name, url = sim[0]
+    server.register_device(device_name, url)
+    now = time.time()
+    breaker = open_breaker(server, device_name, now - 1)
+
+    assert server.probe_device(device_name, 5, now) == 'successful'
+    assert breaker['state'] == 'closed'
+    assert breaker['failures'] == 0
+    assert server.gv_device_dict[device_name]['status']['name'] == device_name
+
+    # back on its probe interval
+    due_delay = server.gv_probe_due_dict[device_name] - time.time()
+    assert due_delay >= server.gv_json_config['discovery']['min_probe_interval'] - 1